@@ -10,27 +10,529 @@ This script requires that `gql` be installed within the Python
 environment you are running this script in.
 """
 
+import bisect
+import collections
+import csv
+import datetime as dt
+import hashlib
+import http.server
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import requests
 from gql import Client, gql
+from gql.transport.exceptions import TransportQueryError, TransportServerError
 from gql.transport.requests import RequestsHTTPTransport
+from graphql import FieldNode, GraphQLError, OperationDefinitionNode
 
-# Initialize HTTP transport with ConneX GraphQL server in localhost.
+# Parquet export is only available when 'pyarrow' is installed
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Updating the adapter statistics cache from MQTT is only available when 'paho.mqtt' is installed
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+# ConneX GraphQL server in localhost.
 # Replace 'localhost' with the IP address of the ConneX Server machine if
 # the server is running in a different machine.
-transport = RequestsHTTPTransport(url="http://localhost:5001/graphql")
+CONNEX_GRAPHQL_URL = "http://localhost:5001/graphql"
+
+# Version of the ConneX Server, it is part of the schema cache key so a new
+# schema is fetched after the server is upgraded. The cached schema is also fetched
+# again when a query does not match it, e.g. after a server upgrade without updating it
+CONNEX_VERSION = "3.0.6"
+
+# Folder where the GraphQL schema fetched from the server is cached, and maximum
+# age in seconds of the cached schema before fetching it again (0 disables the cache)
+SCHEMA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".connex")
+SCHEMA_CACHE_MAX_AGE = 24 * 60 * 60
+
+# The GraphQL client is initialized on first use by get_client()
+client = None
+client_lock = threading.Lock()
+
+# True while the schema of the client is the one read from the schema cache
+schema_from_cache = False
+
+# Maximum number of adapters to query in a single batched 'latestAdapterStatistics' request
+ADAPTER_STATISTICS_BATCH_SIZE = 50
+
+# Maximum number of items the server returns in one page of the 'messages' query
+MESSAGES_PAGE_SIZE = 50
+
+# Number of pages fetched at the same time when exporting messages concurrently
+EXPORT_WORKERS = 4
+
+# Number of time range shards the sharded export splits the messages in, number of processes
+# decoding the message payloads (None = one per CPU core), and maximum number of pages of a shard
+# kept in memory while waiting for the previous shards to be written
+EXPORT_SHARDS = 16
+DECODE_WORKERS = None
+EXPORT_SHARD_PAGES = 40
+
+# Number of attempts and initial delay in seconds (doubled after each attempt) for retried queries
+QUERY_RETRIES = 3
+QUERY_RETRY_BACKOFF = 0.5
+
+# Size in bytes of the write buffer of exported CSV files, and number of rows written
+# to exported Parquet files at once
+EXPORT_BUFFER_SIZE = 1024 * 1024
+EXPORT_BATCH_ROWS = 10000
+
+# Columns of the exported reports, name and type (the type is used for Parquet files)
+HANDLER_COLUMNS = [("handler.Id", "int64"), ("handler.Name", "string"), ("handler.Identifier", "string"), 
+                   ("handler.Type", "string"), ("handler.ipAddress", "string"), ("handler.hostName", "string"), 
+                   ("handler.machineFactory", "string")]
+PROGRAMMER_COLUMNS = [("programmer.Id", "int64"), ("programmer.Name", "string"), ("programmer.Identifier", "string"), 
+                      ("programmer.Type", "string"), ("programmer.ipAddress", "string"), ("handler.Name", "string")]
+ADAPTER_COLUMNS = [("adapter.Id", "int64"), ("adapter.Identifier", "string"), ("adapter.Type", "string"), 
+                   ("programmer.Name", "string")]
+ADAPTER_STATISTICS_COLUMNS = [("adapter.Identifier", "string"), ("adapter.Type", "string"), ("cleanCount", "int64"), 
+                              ("lifetimeActuationCount", "int64"), ("lifetimeContinuityFailCount", "int64"), 
+                              ("lifetimeFailCount", "int64"), ("lifetimePassCount", "int64"), ("socketIndex", "int64"), 
+                              ("adapterState", "string")]
+TOPOLOGY_COLUMNS = [("adapter.Identifier", "string"), ("adapter.Type", "string"), ("programmer.Name", "string"), 
+                    ("programmer.ipAddress", "string"), ("handler.Name", "string"), ("handler.ipAddress", "string")]
+MESSAGE_COLUMNS = [("timestamp", "string"), ("topic", "string"), ("payloadAsString", "string")]
+FLAT_MESSAGE_COLUMNS = [("timestamp", "string"), ("topic", "string"), ("field", "string"), ("value", "string")]
+
+# Seconds a topology snapshot returned by get_topology() is reused before querying the server again
+TOPOLOGY_TTL = 60
+
+# Seconds the adapter statistics kept by AdapterStatisticsCache are used before querying the server
+# again, and MQTT topic of the programming complete messages that keep them updated
+ADAPTER_STATISTICS_TTL = 300
+PROGRAMMING_COMPLETE_TOPIC = "connex/programmer/+/legacy/programmingcomplete"
+
+# Address the metrics endpoint listens on, only this computer by default, use "0.0.0.0"
+# to allow a Prometheus server in another computer to read the metrics
+METRICS_HOST = "127.0.0.1"
+
+# Upper bounds in seconds of the query execution time histogram buckets
+METRICS_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Each worker thread needs its own client, a client can only run one query at a time
+thread_clients = threading.local()
+
+# Maximum number of ad-hoc query documents kept parsed and validated
+ADHOC_QUERY_CACHE_SIZE = 32
+
+# Named query documents with GraphQL variables, each one is parsed and validated
+# against the schema only the first time it is used
+QUERIES = {
+    'adapterIdentifiers': """
+        query { 
+            adapters {
+                entity{
+                    entityIdentifier
+                }
+            }
+        }
+    """,
+    'latestAdapterStatistics': """
+        query ($entityIdentifier: String!) {
+            latestAdapterStatistics(
+                entityIdentifier: $entityIdentifier
+            )
+            {
+                adapterId
+                cleanCount
+                lifetimeActuationCount
+                lifetimeContinuityFailCount
+                lifetimeFailCount
+                lifetimePassCount
+                socketIndex
+                adapterState
+            }
+        }
+    """,
+    'messages': """
+        query ($take: Int!, $skip: Int!) {
+            messages (take:$take skip:$skip 
+                order: {
+                    timestamp: ASC
+                } ) {
+                totalCount
+                items {
+                    topic 
+                    timestamp 
+                    payloadAsString 
+                }
+                pageInfo {
+                    hasNextPage
+                }
+            }
+        }
+    """,
+    'messagesTimeRange': """
+        query {
+            first: messages (take:1 order: { timestamp: ASC }) {
+                items {
+                    timestamp
+                }
+            }
+            last: messages (take:1 order: { timestamp: DESC }) {
+                items {
+                    timestamp
+                }
+            }
+        }
+    """,
+    'messagesByTopic': """
+        query ($take: Int!, $skip: Int!, $topicContains: String!) { 
+            messages (take:$take skip:$skip
+                where: { 
+                    topic: { 
+                        contains: $topicContains
+                    } 
+                } ) {
+                totalCount
+                items {
+                    topic 
+                    timestamp 
+                    payloadAsString 
+                }
+                pageInfo {
+                    hasNextPage
+                }
+            }
+        }
+    """,
+    'topology': """
+        query {
+            systems {
+                handlerId
+                entity{
+                  entityIdentifier
+                  entityName
+                }
+                handlerType
+                ipAddress
+                hostName
+                machineFactory
+            }
+            programmers {
+                programmerId  
+                entity {
+                    entityName
+                    entityIdentifier
+                }
+                programmerType
+                ipAddress
+                handler {
+                    handlerId
+                }
+            }
+            adapters {
+                adapterKey
+                adapterId
+                entity{
+                    entityIdentifier
+                }
+                programmer{
+                    programmerId
+                }
+            }
+        }
+    """,
+}
+
+# Parsed and validated documents, named ones by name and ad-hoc ones, with their query name, by request
+# string (least recently used first)
+named_documents = {}
+adhoc_documents = collections.OrderedDict()
+documents_lock = threading.RLock()
 
-# Initialize the GraphQL client, fetch the schema to validate queries
-client = Client(transport=transport, fetch_schema_from_transport=True)
+# Time spent parsing, validating and executing queries, by query name (the name given by the caller,
+# or the operation name or queried fields for ad-hoc queries), with the queries failed and the
+# histogram of the execution times
+query_stats = collections.defaultdict(lambda: {'count': 0, 'errors': 0, 'parse': 0.0, 'validate': 0.0, 'execute': 0.0,
+                                               'buckets': [0] * (len(METRICS_LATENCY_BUCKETS) + 1)})
+stats_lock = threading.Lock()
 
-# Issue GraphQL query to ConneX server and wait for a response
-def connex_gql_query(request_string):
+# Last topology snapshot returned by get_topology() and the time it was taken
+topology_cache = {'topology': None, 'time': 0}
+
+# Adapter statistics cache used by latest_statistics_all_adapters_cached_query(), created on first use
+adapter_statistics_cache = None
+
+# Documents already validated against the schema, by object id
+validated_documents = {}
+
+# Helper class to skip validating again on every execution the documents already validated by compile_document()
+class PrevalidatedClient(Client):
+    def validate(self, document):
+        if id(document) not in validated_documents:
+            super().validate(document)
+
+# Path of the schema cache file for the configured ConneX server and version
+def schema_cache_file():
+    key = hashlib.sha256(f"{CONNEX_GRAPHQL_URL}|{CONNEX_VERSION}".encode()).hexdigest()[:16]
+    return os.path.join(SCHEMA_CACHE_DIR, f"ConneXGraphQL-schema-{key}.json")
+
+# Read the cached schema, returns None when there is no cached schema or it has expired
+def load_schema_cache():
+    try:
+        with open(schema_cache_file()) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('url') != CONNEX_GRAPHQL_URL or cache.get('version') != CONNEX_VERSION:
+        return None
+    if time.time() - cache.get('fetched', 0) > SCHEMA_CACHE_MAX_AGE:
+        return None
+    return cache['introspection']
+
+# Save the schema fetched from the server, replacing the cache file only once the new one is complete
+def save_schema_cache(introspection):
+    os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+    cache_file = schema_cache_file()
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump({'url': CONNEX_GRAPHQL_URL, 'version': CONNEX_VERSION, 
+                   'fetched': time.time(), 'introspection': introspection}, f)
+    os.replace(cache_file + ".tmp", cache_file)
+
+# Get the GraphQL client, initializing it the first time it is needed
+def get_client():
+    global client, schema_from_cache
+    with client_lock:
+        if client == None:
+            # Initialize HTTP transport with ConneX GraphQL server
+            transport = RequestsHTTPTransport(url=CONNEX_GRAPHQL_URL)
+            introspection = load_schema_cache() if SCHEMA_CACHE_MAX_AGE > 0 else None
+            if introspection == None:
+                # Initialize the GraphQL client, fetch the schema to validate queries
+                new_client = PrevalidatedClient(transport=transport, fetch_schema_from_transport=True)
+                # Connecting the client fetches the schema, keep it for the next runs
+                with new_client:
+                    pass
+                if SCHEMA_CACHE_MAX_AGE > 0:
+                    save_schema_cache(new_client.introspection)
+            else:
+                # Initialize the GraphQL client with the cached schema to validate queries
+                new_client = PrevalidatedClient(transport=transport, introspection=introspection)
+            schema_from_cache = introspection != None
+            client = new_client
+    return client
+
+# Forget the cached schema and the documents validated against it, so the next query fetches
+# the schema from the server again. Returns False when the schema was already fetched from the
+# server, as fetching it again would not change the result of the query
+def refresh_schema():
+    global client, schema_from_cache
+    with client_lock:
+        if not schema_from_cache:
+            return False
+        try:
+            os.remove(schema_cache_file())
+        except OSError:
+            pass
+        client = None
+        schema_from_cache = False
+    with documents_lock:
+        named_documents.clear()
+        adhoc_documents.clear()
+        validated_documents.clear()
+    print("The query does not match the cached GraphQL schema, fetching the schema again...", file=sys.stderr)
+    return True
+
+# Add the time spent on one step of a query to the query statistics
+def add_query_stat(name, step, elapsed):
+    with stats_lock:
+        query_stats[name][step] = query_stats[name][step] + elapsed
+
+# Parse a query document and validate it against the schema, the time spent is added to the
+# query statistics of 'name', or of the name found from the document when it is None
+def compile_document(request_string, name):
+    start = time.perf_counter()
+    document = gql(request_string)
+    parsed = time.perf_counter()
+    if name == None:
+        name = document_name(document)
+    try:
+        get_client().validate(document)
+    except GraphQLError:
+        # The cached schema may be older than the server, validate again with the current one
+        if not refresh_schema():
+            raise
+        get_client().validate(document)
+    validated_documents[id(document)] = document
+    add_query_stat(name, 'parse', parsed - start)
+    add_query_stat(name, 'validate', time.perf_counter() - parsed)
+    return document
+
+# Get the parsed and validated document of a named query
+def named_document(name):
+    with documents_lock:
+        if name not in named_documents:
+            named_documents[name] = compile_document(QUERIES[name], name)
+        return named_documents[name]
+
+# Name of an ad-hoc query in the query statistics: the name of its operation, or the fields it
+# queries when the operation has no name, e.g. 'systems' or 'latestAdapterStatistics'
+def document_name(document):
+    for definition in document.definitions:
+        if isinstance(definition, OperationDefinitionNode):
+            if definition.name != None:
+                return definition.name.value
+            fields = []
+            for selection in definition.selection_set.selections:
+                if isinstance(selection, FieldNode) and selection.name.value not in fields:
+                    fields.append(selection.name.value)
+            return "+".join(fields) or 'adhoc'
+    return 'adhoc'
+
+# Get the parsed and validated document of an ad-hoc query and its query name, keeping the most 
+# recently used ones. The name is found from the document when 'name' is not given
+def adhoc_document(request_string, name=None):
+    with documents_lock:
+        if request_string in adhoc_documents:
+            adhoc_documents.move_to_end(request_string)
+        else:
+            document = compile_document(request_string, name)
+            adhoc_documents[request_string] = (document, name or document_name(document))
+            if len(adhoc_documents) > ADHOC_QUERY_CACHE_SIZE:
+                _, (evicted, _) = adhoc_documents.popitem(last=False)
+                del validated_documents[id(evicted)]
+        return adhoc_documents[request_string]
+
+# Execute a parsed query document and wait for a response
+def execute_document(document, name, variables, gql_client):
+    if gql_client == None:
+        gql_client = get_client()
+    start = time.perf_counter()
+    failed = True
+    try:
+        result = gql_client.execute(document, variable_values=variables, parse_result=True)
+        failed = False
+        return result
+    except TransportQueryError as e:
+        # A query returning partial data with its errors, e.g. a batch where some adapters have no
+        # statistics, is only counted as failed when it returns no data at all
+        failed = e.data == None or all(value == None for value in e.data.values())
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        with stats_lock:
+            stats = query_stats[name]
+            stats['execute'] = stats['execute'] + elapsed
+            stats['count'] = stats['count'] + 1
+            stats['errors'] = stats['errors'] + failed
+            stats['buckets'][bisect.bisect_left(METRICS_LATENCY_BUCKETS, elapsed)] += 1
+
+# Execute a query document, given by a function returning it with its query name. When the server
+# rejects the query without returning any data, e.g. a field removed by a server upgrade, and the query
+# was validated with the cached schema, the schema is fetched again and the query issued once more
+def execute_checked_document(get_document, variables, gql_client):
+    try:
+        return execute_document(*get_document(), variables, gql_client)
+    except TransportQueryError as e:
+        if e.data != None or not refresh_schema():
+            raise
+        return execute_document(*get_document(), variables, gql_client)
+
+# Issue GraphQL query to ConneX server and wait for a response, 'name' is the name of the query
+# in the query statistics, by default its operation name or the fields it queries
+def connex_gql_query(request_string, gql_client=None, variables=None, name=None):
     # print(request_string)
-    query = gql(request_string)
-    result = client.execute(query, parse_result=True)    
+    result = execute_checked_document(lambda: adhoc_document(request_string, name), variables, gql_client)
     # print(result)
     return result
 
+# Issue one of the named GraphQL queries in QUERIES to ConneX server and wait for a response
+def connex_gql_named_query(name, variables=None, gql_client=None):
+    return execute_checked_document(lambda: (named_document(name), name), variables, gql_client)
+
+# Issue GraphQL query to ConneX server, retrying when the server can not be reached or fails.
+# 'query_function' is connex_gql_query or connex_gql_named_query, called with the given arguments.
+def connex_gql_query_with_retry(query_function, *args, retries=QUERY_RETRIES, backoff=QUERY_RETRY_BACKOFF):
+    for attempt in range(retries):
+        try:
+            return query_function(*args)
+        except (TransportServerError, requests.exceptions.RequestException) as e:
+            # Errors returned by the GraphQL server for the query itself are not retried
+            if attempt == retries - 1:
+                raise
+            print(f"Query failed ({e}), retrying in {backoff} seconds...", file=sys.stderr)
+            time.sleep(backoff)
+            backoff = backoff * 2
+
+# Get the GraphQL client of the current worker thread, reusing the schema already fetched
+def thread_client():
+    if not hasattr(thread_clients, 'client') or thread_clients.client.schema is not get_client().schema:
+        thread_clients.client = PrevalidatedClient(transport=RequestsHTTPTransport(url=CONNEX_GRAPHQL_URL), 
+                                                   schema=get_client().schema)
+    return thread_clients.client
+
+# Helper class to write report rows with a fixed set of columns to the console, a CSV file or a
+# Parquet file (when the file name ends with '.parquet'). Missing values are written as None,
+# which is an empty field in CSV and a null in Parquet.
+class ExportWriter:
+    def __init__(self, columns, output_file=None):
+        self.columns = columns
+        self.parquet = output_file != None and output_file.endswith(".parquet")
+        if self.parquet:
+            if pyarrow == None:
+                raise RuntimeError("Writing Parquet files requires the 'pyarrow' library")
+            self.schema = pyarrow.schema([(name, pyarrow.type_for_alias(column_type)) for name, column_type in columns])
+            self.writer = pyarrow.parquet.ParquetWriter(output_file, self.schema)
+            self.rows = []
+        else:
+            if output_file != None:
+                self.file = open(output_file, "w", newline="", encoding="utf-8", buffering=EXPORT_BUFFER_SIZE)
+            else:
+                self.file = sys.stdout
+            self.writer = csv.writer(self.file, lineterminator="\n")
+            # Write header row
+            self.writer.writerow([name for name, _ in columns])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Write one row, with one value per column in the same order as the columns
+    def write(self, row):
+        if self.parquet:
+            self.rows.append(row)
+            if len(self.rows) == EXPORT_BATCH_ROWS:
+                self.flush_rows()
+        else:
+            self.writer.writerow(row)
+
+    # Write rows already formatted as CSV text by format_csv_rows(), only for CSV output
+    def write_csv_text(self, text):
+        self.file.write(text)
+
+    # Write the rows kept for the Parquet file as one row group
+    def flush_rows(self):
+        if self.rows:
+            values = list(zip(*self.rows))
+            arrays = [pyarrow.array(values[index], type=field.type) for index, field in enumerate(self.schema)]
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        if self.parquet:
+            self.flush_rows()
+            self.writer.close()
+        elif self.file is not sys.stdout:
+            self.file.close()
+
 # Query for all handlers in the system
-def handlers_query(): 
+def handlers_query(output_file=None): 
     # Uses 'systems' query : "Look up all the known PSV systems connected to this instance of ConneX." 
 
     # In this example we are querying for all programmers in the system. 
@@ -51,23 +553,16 @@ def handlers_query():
                 machineFactory
             }
         }
-    """
+    """, name='handlers'
     )          
-    # Print header row
-    print("handler.Id,handler.Name,handler.Identifier,handler.Type,handler.ipAddress,handler.hostName,handler.machineFactory")
-    handlers_list = handlers['systems']
-    for handler in handlers_list:
-        # Print the handlers as a list of comma separated values
-        print(str(handler['handlerId']) 
-          + "," + handler['entity']['entityName'] 
-          + "," + handler['entity']['entityIdentifier']
-          + "," + handler['handlerType'] 
-          + "," + handler['ipAddress']   
-          + "," + handler['hostName']
-          + "," + handler['machineFactory'])
+    # Output the handlers as a list of comma separated values
+    with ExportWriter(HANDLER_COLUMNS, output_file) as export:
+        for handler in handlers['systems']:
+            export.write((handler['handlerId'], handler['entity']['entityName'], handler['entity']['entityIdentifier'],
+                          handler['handlerType'], handler['ipAddress'], handler['hostName'], handler['machineFactory']))
 
 # Query for all programmers in the system
-def programmers_query(): 
+def programmers_query(output_file=None): 
     # Uses 'programmers' query : "Look up all the known programmers connected to this instance of ConneX." 
 
     # In this example we are querying for all programmers in the system. 
@@ -91,30 +586,85 @@ def programmers_query():
 	            }
             }
         }
-    """
+    """, name='programmers'
     )          
-    # Print header row
-    print("programmer.Id,programmer.Name,programmer.Identifier,programmer.Type,programmer.ipAddress,handler.Name")
-    programmers_list = programmers['programmers']
-    for programmer in programmers_list:
-        handler = programmer['handler']
-        # Print the programmers as a list of comma separated values
-        if handler == None:
-            print(str(programmer['programmerId']) 
-              + "," + programmer['entity']['entityName'] 
-              + "," + programmer['entity']['entityIdentifier']
-              + "," + programmer['programmerType'] 
-              + "," + programmer['ipAddress'])
-        else:
-            print(str(programmer['programmerId']) 
-              + "," + programmer['entity']['entityName'] 
-              + "," + programmer['entity']['entityIdentifier']
-              + "," + programmer['programmerType'] 
-              + "," + programmer['ipAddress']              
-              + "," + programmer['handler']['entity']['entityName'])
-            
+    # Output the programmers as a list of comma separated values, the handler name
+    # is left empty for programmers not connected to a handler
+    with ExportWriter(PROGRAMMER_COLUMNS, output_file) as export:
+        for programmer in programmers['programmers']:
+            handler = programmer['handler']
+            export.write((programmer['programmerId'], programmer['entity']['entityName'], programmer['entity']['entityIdentifier'],
+                          programmer['programmerType'], programmer['ipAddress'], 
+                          handler['entity']['entityName'] if handler != None else None))
+
+# Helper class to look up handlers, programmers and adapters of a topology snapshot
+class ConneXTopology:
+    def __init__(self, result):
+        self.handlers = result['systems']
+        self.programmers = result['programmers']
+        self.adapters = result['adapters']
+        # Index the entities by id, and by entityIdentifier and ipAddress for each kind of entity, 
+        # e.g. by_ip_address['programmer'][ip], as a handler and a programmer can share an address
+        self.handlers_by_id = {handler['handlerId']: handler for handler in self.handlers}
+        self.programmers_by_id = {programmer['programmerId']: programmer for programmer in self.programmers}
+        self.by_identifier = {'handler': {}, 'programmer': {}, 'adapter': {}}
+        self.by_ip_address = {'handler': {}, 'programmer': {}, 'adapter': {}}
+        for kind, entities in (('handler', self.handlers), ('programmer', self.programmers), ('adapter', self.adapters)):
+            for entity in entities:
+                if entity['entity']['entityIdentifier'] != None:
+                    self.by_identifier[kind][entity['entity']['entityIdentifier']] = entity
+                if entity.get('ipAddress') != None:
+                    self.by_ip_address[kind][entity['ipAddress']] = entity
+        # Link the programmers of each handler and the adapters of each programmer
+        self.programmers_by_handler = {handler_id: [] for handler_id in self.handlers_by_id}
+        self.adapters_by_programmer = {programmer_id: [] for programmer_id in self.programmers_by_id}
+        for programmer in self.programmers:
+            if programmer['handler'] != None:
+                self.programmers_by_handler.setdefault(programmer['handler']['handlerId'], []).append(programmer)
+        for adapter in self.adapters:
+            if adapter['programmer'] != None:
+                self.adapters_by_programmer.setdefault(adapter['programmer']['programmerId'], []).append(adapter)
+
+    # Get the handler a programmer is connected to, None if it is not connected to a handler
+    def programmer_handler(self, programmer):
+        if programmer['handler'] == None:
+            return None
+        return self.handlers_by_id.get(programmer['handler']['handlerId'])
+
+    # Get the programmer an adapter is connected to, None if it is not connected to a programmer
+    def adapter_programmer(self, adapter):
+        if adapter['programmer'] == None:
+            return None
+        return self.programmers_by_id.get(adapter['programmer']['programmerId'])
+
+# Get a snapshot of all handlers, programmers and adapters in the system, reusing the 
+# last one when it was taken less than 'max_age' seconds ago
+def get_topology(max_age=TOPOLOGY_TTL):
+    if topology_cache['topology'] == None or time.monotonic() - topology_cache['time'] > max_age:
+        topology_cache['topology'] = ConneXTopology(connex_gql_named_query('topology'))
+        topology_cache['time'] = time.monotonic()
+    return topology_cache['topology']
+
+# Query for all handlers, programmers and adapters in the system in a single request
+def topology_query(output_file=None):
+    # Uses 'systems', 'programmers' and 'adapters' queries in the same request.
+
+    # In this example we get a topology snapshot with get_topology() and output a list of
+    # comma separated values of all the adapters joined with their programmer and handler.
+    # Empty values are left for adapters not connected to a programmer or handler.
+    topology = get_topology()
+    with ExportWriter(TOPOLOGY_COLUMNS, output_file) as export:
+        for adapter in topology.adapters:
+            programmer = topology.adapter_programmer(adapter)
+            handler = topology.programmer_handler(programmer) if programmer != None else None
+            export.write((adapter['entity']['entityIdentifier'], adapter['adapterId'],
+                          programmer['entity']['entityName'] if programmer != None else None,
+                          programmer['ipAddress'] if programmer != None else None,
+                          handler['entity']['entityName'] if handler != None else None,
+                          handler['ipAddress'] if handler != None else None))
+
 # Query for all adapters in the system 
-def adapters_query():    
+def adapters_query(output_file=None):    
     # Uses 'adapters' query : "Look up all the known adapters connected to this instance of ConneX."
 
     # In this example we are querying for all adapters in the system. 
@@ -136,26 +686,115 @@ def adapters_query():
                 }
             }
         }
-    """
+    """, name='adapters'
     )          
-    # Print header row
-    print("adapter.Id,adapter.Identifier,adapter.Type,programmer.Name")
-    adapters_list = adapters['adapters'] 
-    for adapter in adapters_list:          
-        programmer = adapter['programmer']
-        # Print the adapters as a list of comma separated values
-        if programmer == None:
-            print(str(adapter['adapterKey'])
-              + "," + str(adapter['entity']['entityIdentifier']) 
-              + "," + adapter['adapterId'])
-        else:
-            print(str(adapter['adapterKey'])
-              + "," + str(adapter['entity']['entityIdentifier']) 
-              + "," + adapter['adapterId']
-              + "," + programmer['entity']['entityName'])              
+    # Output the adapters as a list of comma separated values, the programmer name
+    # is left empty for adapters not connected to a programmer
+    with ExportWriter(ADAPTER_COLUMNS, output_file) as export:
+        for adapter in adapters['adapters']:
+            programmer = adapter['programmer']
+            export.write((adapter['adapterKey'], adapter['entity']['entityIdentifier'], adapter['adapterId'],
+                          programmer['entity']['entityName'] if programmer != None else None))
+
+# Get the row of latest statistics of one adapter, when the adapter has no statistics
+# only the adapter identifier is set
+def adapter_statistics_row(entity_identifier, statistics):
+    if statistics == None:
+        return (entity_identifier, None, None, None, None, None, None, None, None)
+    return (entity_identifier, statistics['adapterId'], statistics['cleanCount'], statistics['lifetimeActuationCount'],
+            statistics['lifetimeContinuityFailCount'], statistics['lifetimeFailCount'], statistics['lifetimePassCount'],
+            statistics['socketIndex'], statistics['adapterState'])
+
+# Helper class to keep the latest statistics of the adapters in memory, by adapter serial number
+# (the entityIdentifier of the adapter). Every 'programmingcomplete' MQTT message has the same
+# counters returned by the 'latestAdapterStatistics' query, so when the cache is subscribed to
+# them with start_mqtt() the statistics are kept up to date without querying the ConneX Server.
+# The server is only queried for adapters not in the cache or not updated for 'max_age' seconds.
+class AdapterStatisticsCache:
+    def __init__(self, max_age=ADAPTER_STATISTICS_TTL):
+        self.max_age = max_age
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.mqtt_client = None
+
+    # Store the statistics of an adapter, with the same fields of the 'latestAdapterStatistics' query
+    def update(self, entity_identifier, statistics):
+        with self.lock:
+            self.entries[entity_identifier] = (time.monotonic(), statistics)
+
+    # Update the statistics of the adapter from the payload of a 'programmingcomplete' message
+    def update_from_programming_complete(self, payload):
+        for record in json.loads(payload):
+            adapter = (record.get('Programmer') or {}).get('Adapter')
+            if not adapter or not adapter.get('AdapterSerialNumber'):
+                continue
+            # The counters are strings in the MQTT payload
+            self.update(adapter['AdapterSerialNumber'], {
+                'adapterId': adapter.get('AdapterId'),
+                'cleanCount': int(adapter['CleanCount']),
+                'lifetimeActuationCount': int(adapter['LifetimeActuationCount']),
+                'lifetimeContinuityFailCount': int(adapter['LifetimeContinuityFailCount']),
+                'lifetimeFailCount': int(adapter['LifetimeFailCount']),
+                'lifetimePassCount': int(adapter['LifetimePassCount']),
+                'socketIndex': int(adapter['SocketIndex']),
+                'adapterState': adapter['AdapterState'].upper(),
+            })
+
+    # Get the latest statistics of an adapter, from the cache when they are recent enough,
+    # otherwise from the ConneX Server. Returns None when the adapter has no statistics
+    def get(self, entity_identifier):
+        with self.lock:
+            entry = self.entries.get(entity_identifier)
+            if entry != None and time.monotonic() - entry[0] <= self.max_age:
+                self.hits = self.hits + 1
+                return entry[1]
+            self.misses = self.misses + 1
+        try:
+            statistics = connex_gql_named_query('latestAdapterStatistics', {'entityIdentifier': entity_identifier})['latestAdapterStatistics']
+        except TransportQueryError:
+            # Adapter without statistics, also cached so it is not queried again until it expires
+            statistics = None
+        self.update(entity_identifier, statistics)
+        return statistics
+
+    # Percentage of the statistics served from the cache
+    def hit_rate(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return 100.0 * self.hits / total if total > 0 else 0.0
+
+    # Subscribe to the 'programmingcomplete' messages of the ConneX MQTT Broker, the cache is
+    # updated with each message in the background thread of the MQTT client
+    def start_mqtt(self, host="localhost", port=1883):
+        if mqtt == None:
+            raise RuntimeError("Updating the adapter statistics from MQTT requires the 'paho.mqtt' library")
+
+        def on_connect(client, userdata, flags, rc):
+            client.subscribe(PROGRAMMING_COMPLETE_TOPIC)
+
+        def on_message(client, userdata, msg):
+            try:
+                self.update_from_programming_complete(msg.payload)
+            except (ValueError, KeyError, AttributeError) as e:
+                print(f"Invalid programming complete message: {e}", file=sys.stderr)
+
+        self.mqtt_client = mqtt.Client(client_id=f"connex-graphql-statistics-{os.getpid()}")
+        self.mqtt_client.on_connect = on_connect
+        self.mqtt_client.on_message = on_message
+        self.mqtt_client.connect(host, port, 60)
+        self.mqtt_client.loop_start()
+
+    # Unsubscribe from the MQTT Broker
+    def stop_mqtt(self):
+        if self.mqtt_client != None:
+            self.mqtt_client.disconnect()
+            self.mqtt_client.loop_stop()
+            self.mqtt_client = None
 
 # Query for latest statistics of all adapters in the system
-def latest_statistics_all_adapters_query():    
+def latest_statistics_all_adapters_query(output_file=None):    
     # Uses 'adapters' query : "Look up all the known adapters connected to this instance of ConneX."
     # Uses 'latestAdapterStatistics' query : "Get the latest metric entries for the specified adapter."
 
@@ -164,61 +803,97 @@ def latest_statistics_all_adapters_query():
     # latest statistics.
     
     # First, issue a query to get the entityIdentifier of each adapter
-    adapters = connex_gql_query(
-        """
-        query { 
-            adapters {
-                entity{
-                    entityIdentifier
-                }
-            }
-        }
-    """
-    )      
-    # Print header row
-    print("adapter.Identifier,adapter.Type,cleanCount,lifetimeActuationCount,lifetimeContinuityFailCount,lifetimeFailCount,lifetimePassCount,socketIndex,adapterState")
-    adapters_list = adapters['adapters']       
-    for adapter in adapters_list:
-        # Next, query the latest statistics for each valid adapter
-        if adapter['entity']['entityIdentifier'] != None:
+    adapters = connex_gql_named_query('adapterIdentifiers')
+    with ExportWriter(ADAPTER_STATISTICS_COLUMNS, output_file) as export:
+        for adapter in adapters['adapters']:
+            # Next, query the latest statistics for each valid adapter
+            if adapter['entity']['entityIdentifier'] != None:
+                try:
+                    adapter_stats = connex_gql_named_query('latestAdapterStatistics', 
+                        {'entityIdentifier': adapter['entity']['entityIdentifier']})
+                except:
+                    # When adapter has no statistics set to None to display only the adapter identifier
+                    adapter_stats = {'latestAdapterStatistics':None}
+                    
+                # Output the statistics as a list of comma separated values
+                export.write(adapter_statistics_row(adapter['entity']['entityIdentifier'], adapter_stats['latestAdapterStatistics']))
+
+# Query for latest statistics of all adapters in the system, batching several adapters per request
+def latest_statistics_all_adapters_batched_query(batch_size=ADAPTER_STATISTICS_BATCH_SIZE, output_file=None):
+    # Uses 'adapters' query : "Look up all the known adapters connected to this instance of ConneX."
+    # Uses 'latestAdapterStatistics' query : "Get the latest metric entries for the specified adapter."
+
+    # This example produces the same output as latest_statistics_all_adapters_query(), but instead 
+    # of issuing one request per adapter, it packs up to 'batch_size' 'latestAdapterStatistics' 
+    # selections in a single request using GraphQL aliases (a0, a1, ...). When the statistics of 
+    # one adapter can not be resolved, the server returns null for that alias only, and the rest 
+    # of the batch is still used, the batch is never retried.
+
+    # First, issue a query to get the entityIdentifier of each adapter
+    adapters = connex_gql_named_query('adapterIdentifiers')
+    identifiers = [adapter['entity']['entityIdentifier'] for adapter in adapters['adapters'] 
+                   if adapter['entity']['entityIdentifier'] != None]
+    round_trips = 0
+    with ExportWriter(ADAPTER_STATISTICS_COLUMNS, output_file) as export:
+        for start in range(0, len(identifiers), batch_size):
+            batch = identifiers[start:start + batch_size]
+            # Next, build one aliased selection per adapter in the batch, the identifiers are 
+            # passed as variables ($e0, $e1, ...) so all the batches of the same size share 
+            # the same query document, which is parsed and validated only once
+            declarations = ", ".join(f"$e{index}: String!" for index in range(len(batch)))
+            selections = "".join(
+                """
+                    a{0}: latestAdapterStatistics(entityIdentifier: $e{0}) {{
+                        adapterId
+                        cleanCount
+                        lifetimeActuationCount
+                        lifetimeContinuityFailCount
+                        lifetimeFailCount
+                        lifetimePassCount
+                        socketIndex
+                        adapterState
+                    }}""".format(index) for index in range(len(batch)))
+            variables = {f"e{index}": identifier for index, identifier in enumerate(batch)}
             try:
-                adapter_stats = connex_gql_query(
-                    """
-                    query {{
-                        latestAdapterStatistics(
-                            entityIdentifier: \"{}\"
-                        )
-                        {{
-                            adapterId
-                            cleanCount
-                            lifetimeActuationCount
-                            lifetimeContinuityFailCount
-                            lifetimeFailCount
-                            lifetimePassCount
-                            socketIndex
-                            adapterState
-                        }}
-                    }}
-                """.format(adapter['entity']['entityIdentifier'])
-                )
-            except:
-                # When adapter has no statistics set to None to display only the adapter identifier
-                adapter_stats = {'latestAdapterStatistics':None}
-                
-            # Print the statistics as a list of comma separated values
-            if adapter_stats['latestAdapterStatistics'] == None:
-                print(adapter['entity']['entityIdentifier'])
-            else:
-                print(adapter['entity']['entityIdentifier']
-                  + "," + str(adapter_stats['latestAdapterStatistics']['adapterId']) 
-                  + "," + str(adapter_stats['latestAdapterStatistics']['cleanCount'])
-                  + "," + str(adapter_stats['latestAdapterStatistics']['lifetimeActuationCount'])
-                  + "," + str(adapter_stats['latestAdapterStatistics']['lifetimeContinuityFailCount'])
-                  + "," + str(adapter_stats['latestAdapterStatistics']['lifetimeFailCount'])
-                  + "," + str(adapter_stats['latestAdapterStatistics']['lifetimePassCount'])
-                  + "," + str(adapter_stats['latestAdapterStatistics']['socketIndex'])
-                  + "," + str(adapter_stats['latestAdapterStatistics']['adapterState']))
-    
+                batch_stats = connex_gql_query("query (" + declarations + ") {" + selections + "\n}", variables=variables,
+                                               name='latestAdapterStatisticsBatch')
+            except TransportQueryError as e:
+                # Some adapters have no statistics, keep the partial data returned with the errors
+                batch_stats = e.data or {}
+            round_trips = round_trips + 1
+            # Output the statistics as a list of comma separated values
+            for index, identifier in enumerate(batch):
+                export.write(adapter_statistics_row(identifier, batch_stats.get(f"a{index}")))
+    # Compare with the one request per adapter issued by latest_statistics_all_adapters_query()
+    print(f"Adapters: {len(identifiers)}, statistics requests: {round_trips}, round trips saved: {len(identifiers) - round_trips}", file=sys.stderr)
+
+# Query for latest statistics of all adapters in the system, reading them from the adapter statistics cache
+def latest_statistics_all_adapters_cached_query(output_file=None, mqtt_host=None, mqtt_port=1883):
+    # Uses 'adapters' query : "Look up all the known adapters connected to this instance of ConneX."
+    # Uses 'latestAdapterStatistics' query : "Get the latest metric entries for the specified adapter."
+
+    # This example produces the same output as latest_statistics_all_adapters_query(), but the
+    # statistics are read from the AdapterStatisticsCache, which only queries the ConneX Server
+    # for the adapters not seen in a 'programmingcomplete' message during the last
+    # 'ADAPTER_STATISTICS_TTL' seconds. When 'mqtt_host' is given, the cache is subscribed to the
+    # ConneX MQTT Broker the first time, and keeps being updated for the next calls.
+    global adapter_statistics_cache
+    if adapter_statistics_cache == None:
+        adapter_statistics_cache = AdapterStatisticsCache()
+        if mqtt_host != None:
+            adapter_statistics_cache.start_mqtt(mqtt_host, mqtt_port)
+
+    # First, issue a query to get the entityIdentifier of each adapter
+    adapters = connex_gql_named_query('adapterIdentifiers')
+    with ExportWriter(ADAPTER_STATISTICS_COLUMNS, output_file) as export:
+        for adapter in adapters['adapters']:
+            # Next, get the latest statistics for each valid adapter
+            if adapter['entity']['entityIdentifier'] != None:
+                statistics = adapter_statistics_cache.get(adapter['entity']['entityIdentifier'])
+                export.write(adapter_statistics_row(adapter['entity']['entityIdentifier'], statistics))
+    print(f"Adapter statistics cache hits: {adapter_statistics_cache.hits}, misses: {adapter_statistics_cache.misses}, "
+          f"hit rate: {adapter_statistics_cache.hit_rate():.1f}%", file=sys.stderr)
+
 # Query all MQTT messages with topic "programmingcomplete"
 def programmingcomplete_query():
     # Uses 'messages' query : "Get all MQTT messages using paging (maximum of 50 items per page)."
@@ -229,28 +904,8 @@ def programmingcomplete_query():
     keep_reading = True
     skip = 0
     while keep_reading:        
-        messages = connex_gql_query(
-            """
-            query {{ 
-                messages (take:50 skip:{}
-                    where: {{ 
-                        topic: {{ 
-                            contains: "programmingcomplete"               
-                        }} 
-                    }} ) {{
-                    totalCount
-                    items {{
-                        topic 
-                        timestamp 
-                        payloadAsString 
-                    }}
-                    pageInfo {{
-                        hasNextPage
-                    }}
-                }}
-            }}
-        """.format(skip)
-        )        
+        messages = connex_gql_named_query('messagesByTopic', 
+            {'take': MESSAGES_PAGE_SIZE, 'skip': skip, 'topicContains': "programmingcomplete"})
         # In first query, print total number of messages found
         if skip == 0:
             total_messages = messages['messages']['totalCount']
@@ -261,7 +916,7 @@ def programmingcomplete_query():
             print(message['timestamp'] + " | " + message['topic'] + " | " + message['payloadAsString'])        
         # Check if there are more pages to read
         keep_reading = messages['messages']['pageInfo']['hasNextPage']
-        skip = skip + 50
+        skip = skip + MESSAGES_PAGE_SIZE
 
 # Query all MQTT messages in the database
 def allmessages_query():
@@ -273,26 +928,7 @@ def allmessages_query():
     keep_reading = True
     skip = 0
     while keep_reading:        
-        messages = connex_gql_query(
-            """
-            query {{
-                messages (take:50 skip:{} 
-                    order: {{
-                        timestamp: ASC
-                    }} ) {{
-                    totalCount
-                    items {{
-                        topic 
-                        timestamp 
-                        payloadAsString 
-                    }}
-                    pageInfo {{
-                        hasNextPage
-                    }}
-                }}
-            }}
-        """.format(skip)
-        )        
+        messages = connex_gql_named_query('messages', {'take': MESSAGES_PAGE_SIZE, 'skip': skip})
         # In first query, print total number of messages found
         if skip == 0:
             pending_messages = messages['messages']['totalCount']
@@ -303,10 +939,412 @@ def allmessages_query():
             print(message['timestamp'] + " | " + message['topic'] + " | " + message['payloadAsString'])        
         # Check if there are more pages to read
         keep_reading = messages['messages']['pageInfo']['hasNextPage']
-        skip = skip + 50
+        skip = skip + MESSAGES_PAGE_SIZE
         
+# Build the 'where' filter of a 'messages' query from a list of filter conditions
+def messages_where_filter(conditions):
+    if not conditions:
+        return ""
+    if len(conditions) == 1:
+        return "where: " + conditions[0]
+    return "where: { and: [ " + ", ".join(conditions) + " ] }"
+
+# Fetch the page of MQTT messages following a message cursor, sorted by timestamp and topic,
+# only the messages with timestamp before 'until' when given. 'name' is the name of the query 
+# in the query statistics
+def messages_page_query(cursor, topic_contains=None, until=None, page_size=MESSAGES_PAGE_SIZE, gql_client=None, name='messagesPage'):
+    declarations = ["$take: Int!", "$skip: Int!"]
+    conditions = []
+    # The messages already read with the cursor timestamp are read again, see message_cursor_pending()
+    skip = 0 if 'seen' in cursor and cursor['skip'] < page_size else cursor.get('skip', 0)
+    variables = {'take': page_size, 'skip': skip}
+    if cursor.get('timestamp') != None:
+        declarations.append("$timestamp: DateTime!")
+        conditions.append("{ timestamp: { gte: $timestamp } }")
+        variables['timestamp'] = cursor['timestamp']
+    if until != None:
+        declarations.append("$until: DateTime!")
+        conditions.append("{ timestamp: { lt: $until } }")
+        variables['until'] = until
+    if topic_contains != None:
+        declarations.append("$topicContains: String!")
+        conditions.append("{ topic: { contains: $topicContains } }")
+        variables['topicContains'] = topic_contains
+    return connex_gql_query(
+        """
+        query ({}) {{
+            messages (take:$take skip:$skip
+                {}
+                order: [ {{ timestamp: ASC }}, {{ topic: ASC }} ] ) {{
+                items {{
+                    topic 
+                    timestamp 
+                    payloadAsString 
+                }}
+                pageInfo {{
+                    hasNextPage
+                }}
+            }}
+        }}
+    """.format(", ".join(declarations), messages_where_filter(conditions)), gql_client, variables, name
+    )
+
+# Fingerprint of a message, used to recognize the messages already read with the same timestamp
+def message_fingerprint(message):
+    text = json.dumps([message['topic'], message['payloadAsString']])
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+# Fingerprints of the messages already read with the cursor timestamp, that the next page returns
+# again. The API has no unique field to sort the messages by, so the messages with the same
+# timestamp and topic can be returned in a different order by each query, and skipping the ones
+# already read by their number can skip or repeat messages. Instead, the next page starts again
+# at the first message with the cursor timestamp, and the messages already read are recognized
+# by their fingerprint. When they fill a whole page the number is used instead, as the page would
+# not have any new message, and their fingerprints are no longer kept.
+def message_cursor_pending(cursor, page_size):
+    if cursor.get('skip', 0) >= page_size:
+        cursor.pop('seen', None)
+    return collections.Counter(cursor.get('seen', {}))
+
+# Move a message cursor past a message, returns False when the message was already read,
+# 'pending' are the fingerprints returned by message_cursor_pending() for its page
+def advance_message_cursor(cursor, message, pending):
+    fingerprint = message_fingerprint(message)
+    if message['timestamp'] != cursor.get('timestamp'):
+        cursor['timestamp'] = message['timestamp']
+        cursor['skip'] = 1
+        cursor['seen'] = {fingerprint: 1}
+        return True
+    if pending[fingerprint] > 0:
+        pending[fingerprint] = pending[fingerprint] - 1
+        return False
+    cursor['skip'] = cursor['skip'] + 1
+    if 'seen' in cursor:
+        cursor['seen'][fingerprint] = cursor['seen'].get(fingerprint, 0) + 1
+    return True
+
+# Iterate over MQTT messages in the database, one message at a time
+def iterate_messages(topic_contains=None, cursor=None, page_size=MESSAGES_PAGE_SIZE, until=None, gql_client=None):
+    # Uses 'messages' query : "Get all MQTT messages using paging (maximum of 50 items per page)."
+
+    # Instead of requesting each page with a growing 'skip', which forces the server to scan
+    # all the previous messages again for every page, each page starts at the timestamp of the
+    # last message read ('gte' filter). The messages already read that share that same timestamp
+    # are returned again and recognized by their fingerprint, see message_cursor_pending().
+    #
+    # The 'cursor' dictionary is updated after every yielded message, it can be saved with
+    # save_message_cursor() and passed back later to resume reading where it stopped.
+    #
+    # The filter values are passed as GraphQL variables, so there are only eight different
+    # query documents (with or without each filter), each parsed and validated only once.
+    if cursor == None:
+        cursor = {}
+    while True:
+        pending = message_cursor_pending(cursor, page_size)
+        messages = messages_page_query(cursor, topic_contains, until, page_size, gql_client)
+        for message in messages['messages']['items']:
+            # Move the cursor past this message before handing it to the caller
+            if advance_message_cursor(cursor, message, pending):
+                yield message
+        # Check if there are more pages to read
+        if not messages['messages']['pageInfo']['hasNextPage']:
+            break
+
+# Load a message cursor saved by save_message_cursor(), start from the beginning if there is none
+def load_message_cursor(cursor_file):
+    try:
+        with open(cursor_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# Save a message cursor, replacing the previous file only once the new one is complete
+def save_message_cursor(cursor_file, cursor):
+    with open(cursor_file + ".tmp", "w") as f:
+        json.dump(cursor, f)
+    os.replace(cursor_file + ".tmp", cursor_file)
+
+# Stream all MQTT messages in the database, resuming from the last saved cursor
+def stream_messages_query(topic_contains=None, cursor_file="ConneXGraphQL.cursor"):
+    # In this example we read all messages (or only the ones with topic containing 
+    # 'topic_contains') using iterate_messages(). The cursor is saved to 'cursor_file' 
+    # after each page, so if the script is stopped it continues from the last saved
+    # message on the next run.
+    cursor = load_message_cursor(cursor_file)
+    count = 0
+    for message in iterate_messages(topic_contains, cursor):
+        print(message['timestamp'] + " | " + message['topic'] + " | " + message['payloadAsString'])
+        count = count + 1
+        if count % MESSAGES_PAGE_SIZE == 0:
+            save_message_cursor(cursor_file, cursor)
+    save_message_cursor(cursor_file, cursor)
+    print(f"Messages read: {count}")
+
+# Fetch one page of all MQTT messages sorted by timestamp, returns the page and the time it took
+def fetch_messages_page(page, page_size=MESSAGES_PAGE_SIZE, gql_client=None):
+    start = time.perf_counter()
+    messages = connex_gql_query_with_retry(connex_gql_named_query, 'messages', 
+                                           {'take': page_size, 'skip': page * page_size}, gql_client)
+    return messages['messages'], time.perf_counter() - start
+
+# Export all MQTT messages in the database fetching several pages at the same time
+def export_messages_query(output_file=None, workers=EXPORT_WORKERS, page_size=MESSAGES_PAGE_SIZE):
+    # Uses 'messages' query : "Get all MQTT messages using paging (maximum of 50 items per page)."
+
+    # In this example the first page is read to get the total number of messages, then the
+    # remaining pages are requested by a pool of 'workers' threads. Pages are written to
+    # 'output_file' (CSV or Parquet, or the console) in page order, which is timestamp order,
+    # as soon as all the previous pages are written. At most 2 * 'workers' pages are kept in memory.
+    start = time.perf_counter()
+    with ExportWriter(MESSAGE_COLUMNS, output_file) as export:
+        first_page, elapsed = fetch_messages_page(0, page_size)
+        page_times = [elapsed]
+        total_messages = first_page['totalCount']
+        total_pages = (total_messages + page_size - 1) // page_size
+        print(f'Total messages found: {total_messages}', file=sys.stderr)
+        for message in first_page['items']:
+            export.write((message['timestamp'], message['topic'], message['payloadAsString']))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            next_page = 1
+            for page in range(1, total_pages):
+                # Keep the pool busy without reading too far ahead of the output
+                while next_page < total_pages and next_page - page < 2 * workers:
+                    pending[next_page] = pool.submit(lambda p: fetch_messages_page(p, page_size, thread_client()), next_page)
+                    next_page = next_page + 1
+                messages, elapsed = pending.pop(page).result()
+                page_times.append(elapsed)
+                for message in messages['items']:
+                    export.write((message['timestamp'], message['topic'], message['payloadAsString']))
+    # Print page timing summary
+    print(f"Pages: {len(page_times)}, workers: {workers}, total time: {time.perf_counter() - start:.3f}s, "
+          f"page time avg: {sum(page_times) / len(page_times):.3f}s, max: {max(page_times):.3f}s", file=sys.stderr)
+
+# Convert a ConneX timestamp, or a date and time given by the user, to a datetime with time zone
+def parse_timestamp(timestamp):
+    time = dt.datetime.fromisoformat(timestamp)
+    if time.tzinfo == None:
+        # Dates and times without time zone are local time
+        time = time.astimezone()
+    return time
+
+# Split the messages between 'since' and 'until' in time ranges of the same duration, as a list
+# of (since, until) timestamps. When 'since' or 'until' are not given the time of the first or
+# last message in the database is used, and the first or last range has no limit.
+def message_time_shards(since=None, until=None, shards=EXPORT_SHARDS):
+    since = parse_timestamp(since).isoformat() if since != None else None
+    until = parse_timestamp(until).isoformat() if until != None else None
+    if since == None or until == None:
+        time_range = connex_gql_named_query('messagesTimeRange')
+        if not time_range['first']['items']:
+            return []
+        first = since if since != None else time_range['first']['items'][0]['timestamp']
+        last = until if until != None else time_range['last']['items'][0]['timestamp']
+    else:
+        first, last = since, until
+    start = parse_timestamp(first)
+    step = (parse_timestamp(last) - start) / shards
+    if step <= dt.timedelta(0):
+        return [(since, until)]
+    bounds = [since] + [(start + step * shard).isoformat() for shard in range(1, shards)] + [until]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Add the fields of a decoded JSON payload to 'fields', as (name, value), using the path of each
+# value as its name, e.g. 'Adapter.Counters[0]'
+def flatten_payload(value, name, fields):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten_payload(item, f"{name}.{key}" if name else key, fields)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            flatten_payload(item, f"{name}[{index}]", fields)
+    elif value == None or isinstance(value, str):
+        fields.append((name, value))
+    else:
+        fields.append((name, json.dumps(value)))
+
+# Format rows as CSV text, the same text written by ExportWriter for a CSV file
+def format_csv_rows(rows):
+    text = io.StringIO()
+    csv.writer(text, lineterminator="\n").writerows(rows)
+    return text.getvalue()
+
+# Decode the payloads of a page of messages into FLAT_MESSAGE_COLUMNS rows, one row per payload
+# field. Runs in the decoding processes, when 'as_csv' is set the rows are also formatted as CSV
+# text, which is faster to send back to the main process than the rows. Returns the rows (or text),
+# the number of rows and the time it took.
+def decode_messages_page(messages, as_csv=False):
+    # CPU time of the process, the time waiting for the CPU is not counted
+    start = time.process_time()
+    rows = []
+    for message in messages:
+        fields = []
+        try:
+            flatten_payload(json.loads(message['payloadAsString']), "", fields)
+        except (TypeError, ValueError):
+            # Payloads that are not JSON are written as they are
+            fields = []
+        if not fields:
+            fields = [("", message['payloadAsString'])]
+        rows.extend((message['timestamp'], message['topic'], name, value) for name, value in fields)
+    if as_csv:
+        return format_csv_rows(rows), len(rows), time.process_time() - start
+    return rows, len(rows), time.process_time() - start
+
+# Add a page to the queue of a shard, waiting while the queue is full unless the export was stopped
+def put_shard_page(pages, page, stopped):
+    while not stopped.is_set():
+        try:
+            pages.put(page, timeout=0.5)
+            return
+        except queue.Full:
+            pass
+
+# Fetch all the messages of one time range shard in a worker thread. The pages are sent to the
+# decoding processes as soon as they are read, and added to the 'pages' queue as (decoded rows
+# future, number of messages), ending with None. Returns the number of pages and the time spent
+# waiting for the server.
+def fetch_messages_shard(since, until, page_size, as_csv, pages, decode_pool, stopped):
+    cursor = {'timestamp': since, 'skip': 0, 'seen': {}} if since != None else {}
+    count = 0
+    fetch_time = 0.0
+    try:
+        while not stopped.is_set():
+            start = time.perf_counter()
+            pending = message_cursor_pending(cursor, page_size)
+            messages = connex_gql_query_with_retry(messages_page_query, cursor, None, until, page_size, thread_client(), 'messagesShardPage')
+            fetch_time = fetch_time + time.perf_counter() - start
+            items = [message for message in messages['messages']['items'] if advance_message_cursor(cursor, message, pending)]
+            # Wait while the shard is too far ahead of the output
+            put_shard_page(pages, (decode_pool.submit(decode_messages_page, items, as_csv), len(items)), stopped)
+            count = count + 1
+            if not messages['messages']['pageInfo']['hasNextPage']:
+                break
+    finally:
+        put_shard_page(pages, None, stopped)
+    return count, fetch_time
+
+# Export the MQTT messages between 'since' and 'until' (ISO dates and times, all the messages when
+# not given) with the payloads decoded, splitting the time range in shards fetched at the same time
+def export_messages_sharded_query(output_file=None, since=None, until=None, shards=EXPORT_SHARDS, 
+                                  workers=EXPORT_WORKERS, decode_workers=DECODE_WORKERS, page_size=MESSAGES_PAGE_SIZE):
+    # Uses 'messages' query : "Get all MQTT messages using paging (maximum of 50 items per page)."
+
+    # In this example the time range is split in 'shards' ranges of the same duration, using 
+    # 'gte' and 'lt' timestamp filters, and 'workers' threads read the shards at the same time,
+    # each shard page by page following the timestamp as in iterate_messages(). Decoding the 
+    # JSON payloads takes as much time as reading them, so it is done by a pool of processes,
+    # which unlike threads can use all the CPU cores. The payload of each message is flattened
+    # in one row per field (FLAT_MESSAGE_COLUMNS), written to 'output_file' (CSV or Parquet, or
+    # the console) in shard order, that is in timestamp order. For CSV output the rows are also
+    # formatted by the decoding processes, the main process only writes them.
+    start = time.perf_counter()
+    time_shards = message_time_shards(since, until, shards)
+    stats = {'pages': 0, 'messages': 0, 'rows': 0, 'fetch': 0.0, 'decode': 0.0, 'wait': 0.0, 'write': 0.0}
+    decode_workers = decode_workers or os.cpu_count()
+    stopped = threading.Event()
+    with ExportWriter(FLAT_MESSAGE_COLUMNS, output_file) as export, \
+         ProcessPoolExecutor(max_workers=decode_workers) as decode_pool, \
+         ThreadPoolExecutor(max_workers=workers) as fetch_pool:
+        try:
+            shard_pages = [queue.Queue(EXPORT_SHARD_PAGES) for _ in time_shards]
+            shard_futures = [fetch_pool.submit(fetch_messages_shard, shard_since, shard_until, page_size, not export.parquet, 
+                                               pages, decode_pool, stopped)
+                             for (shard_since, shard_until), pages in zip(time_shards, shard_pages)]
+            for pages, shard_future in zip(shard_pages, shard_futures):
+                while True:
+                    wait_start = time.perf_counter()
+                    page = pages.get()
+                    if page == None:
+                        break
+                    rows, rows_count, decode_time = page[0].result()
+                    write_start = time.perf_counter()
+                    stats['wait'] = stats['wait'] + write_start - wait_start
+                    if export.parquet:
+                        for row in rows:
+                            export.write(row)
+                    else:
+                        export.write_csv_text(rows)
+                    stats['write'] = stats['write'] + time.perf_counter() - write_start
+                    stats['decode'] = stats['decode'] + decode_time
+                    stats['rows'] = stats['rows'] + rows_count
+                    stats['messages'] = stats['messages'] + page[1]
+                # Errors of the shard are raised here
+                pages_count, fetch_time = shard_future.result()
+                stats['pages'] = stats['pages'] + pages_count
+                stats['fetch'] = stats['fetch'] + fetch_time
+        finally:
+            stopped.set()
+    # Print stage timing summary, the fetch and decode times are added over all the threads and processes
+    total = time.perf_counter() - start
+    print(f"Shards: {len(time_shards)}, pages: {stats['pages']}, messages: {stats['messages']}, rows: {stats['rows']}, "
+          f"workers: {workers}, decode processes: {decode_workers}", file=sys.stderr)
+    print(f"Total time: {total:.3f}s, fetch: {stats['fetch']:.3f}s ({stats['fetch'] / workers:.3f}s per worker), "
+          f"decode: {stats['decode']:.3f}s ({stats['decode'] / decode_workers:.3f}s per process), "
+          f"write: {stats['write']:.3f}s, waiting: {stats['wait']:.3f}s", file=sys.stderr)
+
+# Print the number of queries and the time spent parsing, validating and executing them
+def print_query_stats():
+    print("query,count,parse(ms),validate(ms),execute(ms)")
+    with stats_lock:
+        for name, stats in query_stats.items():
+            print(f"{name},{stats['count']},{stats['parse'] * 1000:.3f},{stats['validate'] * 1000:.3f},{stats['execute'] * 1000:.3f}")
+
+# Escape a label value of the Prometheus text format
+def metric_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Text of the query metrics in Prometheus text format, the error rate is calculated by Prometheus
+# from the totals, e.g. rate(connex_graphql_errors_total[5m]) / rate(connex_graphql_requests_total[5m])
+def render_metrics():
+    with stats_lock:
+        queries = [(name, dict(stats, buckets=list(stats['buckets']))) for name, stats in sorted(query_stats.items())]
+    lines = ["# HELP connex_graphql_requests_total GraphQL queries executed, by query name",
+             "# TYPE connex_graphql_requests_total counter"]
+    lines += [f"connex_graphql_requests_total{{query=\"{metric_label(name)}\"}} {stats['count']}" for name, stats in queries]
+    lines += ["# HELP connex_graphql_errors_total GraphQL queries failed, by query name",
+              "# TYPE connex_graphql_errors_total counter"]
+    lines += [f"connex_graphql_errors_total{{query=\"{metric_label(name)}\"}} {stats['errors']}" for name, stats in queries]
+    lines += ["# HELP connex_graphql_request_seconds Time waiting for the GraphQL server response, by query name",
+              "# TYPE connex_graphql_request_seconds histogram"]
+    for name, stats in queries:
+        count = 0
+        for bound, bucket in zip(METRICS_LATENCY_BUCKETS + ["+Inf"], stats['buckets']):
+            count = count + bucket
+            lines.append(f"connex_graphql_request_seconds_bucket{{query=\"{metric_label(name)}\",le=\"{bound}\"}} {count}")
+        lines.append(f"connex_graphql_request_seconds_sum{{query=\"{metric_label(name)}\"}} {stats['execute']}")
+        lines.append(f"connex_graphql_request_seconds_count{{query=\"{metric_label(name)}\"}} {count}")
+    return "\n".join(lines) + "\n"
+
+# Helper class to answer the requests to the metrics endpoint, 'GET /metrics'
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The requests are not logged
+    def log_message(self, format, *args):
+        pass
+
+# Start the metrics endpoint in a background thread, returns the HTTP server. Useful when
+# the queries are issued by a long running program importing this script
+def start_metrics_server(port, host=METRICS_HOST):
+    server = http.server.HTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="ConneXMetrics", daemon=True).start()
+    return server
+
 # main program
 def main(): 
+    # Uncomment to serve the query metrics at http://localhost:9102/metrics while the examples run
+    # start_metrics_server(9102)
+
     # Uncomment the example you want to test    
     
     handlers_query()
@@ -315,11 +1353,26 @@ def main():
     
     # adapters_query()
 
+    # topology_query()
+
     # latest_statistics_all_adapters_query()
+
+    # latest_statistics_all_adapters_batched_query()
+
+    # latest_statistics_all_adapters_cached_query(mqtt_host="localhost")
     
     # programmingcomplete_query()
     
     # allmessages_query()
+
+    # stream_messages_query()
+
+    # export_messages_query("ConneXMessages.csv")
+
+    # export_messages_sharded_query("ConneXMessagesFields.csv")
+
+    # Uncomment to print the time spent on the queries issued by the examples
+    # print_query_stats()
     
 # Script entry point
 if __name__ == '__main__':
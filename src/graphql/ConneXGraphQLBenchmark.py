@@ -0,0 +1,457 @@
+"""
+ConneX GraphQL Benchmark sample code.
+
+ConneXGraphQLBenchmark [-h] [-a ADAPTERS] [-n MESSAGES] [-k KB] [-l MS] [-b BENCHMARK] [-p PORT] [-S] [-s NAME] [-c NAME]
+
+This script measures the query functions of ConneXGraphQL against a local
+stub GraphQL server, without a ConneX Server. The stub serves the part of
+the ConneX GraphQL schema used by ConneXGraphQL, with a generated fleet of
+handlers, programmers and adapters and a generated message history.
+
+For each query function the results are the number of round trips (HTTP
+requests) to the server, the time it takes and the peak memory allocated.
+Use '-l' to add a delay to each request, like the network and database
+time of a real ConneX Server. Use '-s NAME' to save the results as a
+baseline and '-c NAME' to compare with a saved baseline, a query function
+needing more round trips than in the baseline is reported as a regression.
+
+Use '-S' to only run the stub server, by default in the port used by
+ConneXGraphQL (5001), to try the ConneXGraphQL examples without a
+ConneX Server.
+
+This script requires that `gql` be installed within the Python
+environment you are running this script in, and the ConneXGraphQL.py
+script in the same folder.
+"""
+
+import argparse
+import bisect
+import contextlib
+import datetime as dt
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import requests
+from graphql import GraphQLError, build_schema, graphql_sync
+import ConneXGraphQL
+
+# File where the benchmark results saved as baselines are kept, by baseline name
+BASELINES_FILE = "ConneXGraphQLBenchmark.json"
+
+# Part of the ConneX GraphQL schema used by ConneXGraphQL, served by the stub server
+STUB_SCHEMA = """
+    scalar DateTime
+
+    type Entity { entityIdentifier: String entityName: String }
+    type System { handlerId: Int! entity: Entity! handlerType: String ipAddress: String hostName: String machineFactory: String }
+    type Programmer { programmerId: Int! entity: Entity! programmerType: String ipAddress: String handler: System }
+    type Adapter { adapterKey: Int! adapterId: String entity: Entity! programmer: Programmer }
+    type AdapterStatistics {
+        adapterId: String cleanCount: Int! lifetimeActuationCount: Int! lifetimeContinuityFailCount: Int!
+        lifetimeFailCount: Int! lifetimePassCount: Int! socketIndex: Int! adapterState: String
+    }
+
+    input StringOperationFilterInput { eq: String contains: String }
+    input DateTimeOperationFilterInput { eq: DateTime gt: DateTime gte: DateTime lt: DateTime lte: DateTime }
+    input MessageFilterInput { and: [MessageFilterInput!] or: [MessageFilterInput!] topic: StringOperationFilterInput timestamp: DateTimeOperationFilterInput }
+    enum SortEnumType { ASC DESC }
+    input MessageSortInput { timestamp: SortEnumType topic: SortEnumType }
+    type CollectionSegmentInfo { hasNextPage: Boolean! hasPreviousPage: Boolean! }
+    type Message { topic: String! timestamp: DateTime! payloadAsString: String }
+    type MessagesCollectionSegment { items: [Message!] pageInfo: CollectionSegmentInfo! totalCount: Int! }
+
+    type Query {
+        systems: [System!]!
+        programmers: [Programmer!]!
+        adapters: [Adapter!]!
+        latestAdapterStatistics(entityIdentifier: String!): AdapterStatistics
+        messages(skip: Int, take: Int, where: MessageFilterInput, order: [MessageSortInput!]): MessagesCollectionSegment
+    }
+"""
+
+# Shape of the generated fleet: adapters of each programmer and programmers of each handler,
+# one of every UNCONNECTED_EVERY programmers and adapters is not connected, and one of every
+# STATISTICS_MISSING_EVERY adapters has no statistics
+ADAPTERS_PER_PROGRAMMER = 4
+PROGRAMMERS_PER_HANDLER = 8
+UNCONNECTED_EVERY = 20
+STATISTICS_MISSING_EVERY = 10
+
+# Time of the first generated message, and milliseconds between two generated messages
+MESSAGES_START = dt.datetime(2023, 12, 6, 8, 0, 0, tzinfo=dt.timezone.utc)
+MESSAGE_INTERVAL_MS = 50
+
+# Topics published by each handler for each device, in order. '{machine}' and '{session}'
+# are replaced with the host name of the handler and the session ID
+MESSAGE_TOPICS = [
+    "ah700/operations/pick/{machine}/{session}",
+    "ah700/operations/place/{machine}/{session}",
+    "connex/programmer/lumenx/legacy/programmingcomplete",
+    "ah700/operations/pick/{machine}/{session}",
+    "ah700/operations/devicecomplete/{machine}/{session}",
+    "ah700/operations/place/{machine}/{session}",
+]
+
+# Maximum number of items the stub returns in one page of the 'messages' query, as the ConneX Server
+STUB_PAGE_SIZE = 50
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding optional arguments
+parser.add_argument("-a", "--adapters", type=int, default=100, help="Number of adapters of the generated fleet, default = 100")
+parser.add_argument("-n", "--messages", type=int, default=10000, help="Number of messages of the generated message history, default = 10000")
+parser.add_argument("-k", "--programming-complete-kb", type=int, default=30, help="Size in KB of the programming complete payloads, default = 30")
+parser.add_argument("-l", "--latency", type=float, default=0, metavar="MS", help="Delay in milliseconds added to each request by the stub server, default = 0")
+parser.add_argument("-b", "--benchmark", action="append", help="Benchmark to run, can be repeated, default = all")
+parser.add_argument("-p", "--port", type=int, help="Port of the stub server, default = 5001 with '-S', any free port otherwise")
+parser.add_argument("-S", "--serve", action="store_true", help="Only run the stub server until CTRL+C is pressed")
+parser.add_argument("-s", "--save", metavar="NAME", help="Save the results as a baseline with this name")
+parser.add_argument("-c", "--compare", metavar="NAME", help="Compare the results with the baseline with this name")
+
+# Helper class to generate the fleet of handlers, programmers and adapters served by the stub
+class StubFleet:
+    def __init__(self, adapters, seed=1):
+        rng = random.Random(seed)
+        programmers = (adapters + ADAPTERS_PER_PROGRAMMER - 1) // ADAPTERS_PER_PROGRAMMER
+        handlers = max(1, (programmers + PROGRAMMERS_PER_HANDLER - 1) // PROGRAMMERS_PER_HANDLER)
+        self.systems = [{
+            'handlerId': index + 1,
+            'entity': {'entityIdentifier': "%032x" % rng.getrandbits(128), 'entityName': f"HANDLER-{index:03d}"},
+            'handlerType': "PSV7000", 'ipAddress': f"10.0.{index // 250}.{index % 250 + 1}",
+            'hostName': f"dell{index:03d}", 'machineFactory': "",
+        } for index in range(handlers)]
+        self.programmers = [{
+            'programmerId': index + 1,
+            'entity': {'entityIdentifier': f"001-035-032-021-008-253-{index // 256:03d}-{index % 256:03d}-238", 'entityName': f"LX{index:04d}"},
+            'programmerType': "LUMEN_X", 'ipAddress': f"10.1.{index // 250}.{index % 250 + 1}",
+            'handler': self.systems[index // PROGRAMMERS_PER_HANDLER] if index % UNCONNECTED_EVERY != UNCONNECTED_EVERY - 1 else None,
+        } for index in range(programmers)]
+        self.adapters = [{
+            'adapterKey': index + 1, 'adapterId': "110008",
+            'entity': {'entityIdentifier': f"001-035-216-109-026-059-{index // 256:03d}-{index % 256:03d}-238"},
+            'programmer': self.programmers[index // ADAPTERS_PER_PROGRAMMER] if index % UNCONNECTED_EVERY != UNCONNECTED_EVERY - 1 else None,
+        } for index in range(adapters)]
+        self.statistics = {}
+        for index, adapter in enumerate(self.adapters):
+            if index % STATISTICS_MISSING_EVERY != STATISTICS_MISSING_EVERY - 1:
+                count = rng.randint(1000, 100000)
+                self.statistics[adapter['entity']['entityIdentifier']] = {
+                    'adapterId': "110008", 'cleanCount': count, 'lifetimeActuationCount': count, 'lifetimeContinuityFailCount': 0,
+                    'lifetimeFailCount': count // 100, 'lifetimePassCount': count - count // 100,
+                    'socketIndex': index % ADAPTERS_PER_PROGRAMMER + 1, 'adapterState': "VALIDATED",
+                }
+
+    # Resolver of the 'latestAdapterStatistics' query
+    def latest_adapter_statistics(self, info, entityIdentifier):
+        statistics = self.statistics.get(entityIdentifier)
+        if statistics == None:
+            raise GraphQLError(f"No statistics found for adapter '{entityIdentifier}'")
+        return statistics
+
+# Helper class to serve the generated message history. The messages are not kept in memory,
+# message 'i' is computed from its index: its timestamp is MESSAGE_INTERVAL_MS after the previous
+# one and its topic repeats every 'period' messages, so a page of a history of millions of
+# messages is found without looking at the previous messages.
+class StubMessages:
+    def __init__(self, count, machines, programming_complete_size, seed=1):
+        rng = random.Random(seed)
+        self.count = count
+        self.topics = []
+        for machine in machines:
+            session = "%032x" % rng.getrandbits(128)
+            self.topics.extend(topic.format(machine=machine, session=session) for topic in MESSAGE_TOPICS)
+        # The programming complete payload is the same for all the messages
+        padding = "-".join(f"{rng.getrandbits(8):02X}" for _ in range(programming_complete_size // 3))
+        self.programming_complete = json.dumps([{"Programmer": {"Class": "LumenX"}, "PartDetail": {"Result": {"Code": "0"}}, "SerialData": padding}])
+
+    # Timestamp of a message, in the format returned by the ConneX Server
+    def timestamp(self, index):
+        time = MESSAGES_START + dt.timedelta(milliseconds=index * MESSAGE_INTERVAL_MS)
+        return time.isoformat(timespec="milliseconds")
+
+    # Index of the first message with timestamp at or after 'timestamp', or after it when 'after' is set
+    def index_of(self, timestamp, after=False):
+        time = dt.datetime.fromisoformat(timestamp)
+        if time.tzinfo == None:
+            time = time.replace(tzinfo=dt.timezone.utc)
+        elapsed = (time - MESSAGES_START) // dt.timedelta(microseconds=1)
+        interval = MESSAGE_INTERVAL_MS * 1000
+        index = elapsed // interval + 1 if after else -(-elapsed // interval)
+        return min(max(index, 0), self.count)
+
+    def message(self, index):
+        topic = self.topics[index % len(self.topics)]
+        if topic.endswith("programmingcomplete"):
+            payload = self.programming_complete
+        else:
+            payload = json.dumps({"DeviceID": str(index // len(self.topics)), "Location": "Tray1", "PickHead": 1, "Status": "Pass"})
+        return {'topic': topic, 'timestamp': self.timestamp(index), 'payloadAsString': payload}
+
+    # Messages matching a 'where' filter, as the range of indexes [first, last) and the positions
+    # in the topics period of the matching topics (None for all the topics)
+    def filter(self, where):
+        first, last, positions = 0, self.count, None
+        if where == None:
+            return first, last, positions
+        if where.get('or'):
+            raise GraphQLError("The stub server does not support 'or' filters")
+        for condition in where.get('and') or []:
+            condition_first, condition_last, condition_positions = self.filter(condition)
+            first, last = max(first, condition_first), min(last, condition_last)
+            if condition_positions != None:
+                positions = condition_positions if positions == None else sorted(set(positions) & set(condition_positions))
+        timestamp = where.get('timestamp') or {}
+        if timestamp.get('gte') != None:
+            first = max(first, self.index_of(timestamp['gte']))
+        if timestamp.get('gt') != None:
+            first = max(first, self.index_of(timestamp['gt'], after=True))
+        if timestamp.get('lt') != None:
+            last = min(last, self.index_of(timestamp['lt']))
+        if timestamp.get('lte') != None:
+            last = min(last, self.index_of(timestamp['lte'], after=True))
+        if timestamp.get('eq') != None:
+            first, last = max(first, self.index_of(timestamp['eq'])), min(last, self.index_of(timestamp['eq'], after=True))
+        topic = where.get('topic') or {}
+        if topic.get('contains') != None or topic.get('eq') != None:
+            matching = [position for position, name in enumerate(self.topics)
+                        if (topic.get('contains') == None or topic['contains'] in name) and (topic.get('eq') == None or topic['eq'] == name)]
+            positions = matching if positions == None else sorted(set(positions) & set(matching))
+        return first, max(first, last), positions
+
+    # Number of messages before index 'index' with a topic in 'positions'
+    def count_before(self, index, positions):
+        return (index // len(self.topics)) * len(positions) + bisect.bisect_left(positions, index % len(self.topics))
+
+    # Resolver of the 'messages' query
+    def messages(self, info, skip=0, take=STUB_PAGE_SIZE, where=None, order=None):
+        skip = skip or 0
+        take = min(take or STUB_PAGE_SIZE, STUB_PAGE_SIZE)
+        first, last, positions = self.filter(where)
+        if positions == None:
+            total = last - first
+        else:
+            before = self.count_before(first, positions)
+            total = self.count_before(last, positions) - before
+        ranks = range(skip, min(skip + take, total))
+        if order and order[0].get('timestamp') == "DESC":
+            # Same pages counted from the last message
+            ranks = [total - 1 - rank for rank in ranks]
+        if positions == None:
+            indexes = [first + rank for rank in ranks]
+        else:
+            indexes = [((before + rank) // len(positions)) * len(self.topics) + positions[(before + rank) % len(positions)] for rank in ranks]
+        return {'items': [self.message(index) for index in indexes], 'totalCount': total,
+                'pageInfo': {'hasNextPage': skip + take < total, 'hasPreviousPage': skip > 0}}
+
+# Helper class to answer the GraphQL requests of the stub server, 'POST /graphql', and the
+# number of requests and bytes served, 'GET /stats'
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep the connections open between requests, as the ConneX Server
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        result = graphql_sync(self.server.schema, request['query'], root_value=self.server.root,
+                              variable_values=request.get('variables'), operation_name=request.get('operationName'))
+        response = {'data': result.data}
+        if result.errors:
+            response['errors'] = [error.formatted for error in result.errors]
+        body = json.dumps(response).encode()
+        with self.server.stats_lock:
+            self.server.stats['requests'] = self.server.stats['requests'] + 1
+            self.server.stats['bytes'] = self.server.stats['bytes'] + len(body)
+        self.send_body(body, "application/json")
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+        with self.server.stats_lock:
+            body = json.dumps(self.server.stats).encode()
+        self.send_body(body, "application/json")
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The requests are not logged
+    def log_message(self, format, *args):
+        pass
+
+# Create the stub server with a generated fleet and message history, 'latency' is in seconds
+def create_stub_server(port, adapters, messages, programming_complete_size, latency):
+    fleet = StubFleet(adapters)
+    history = StubMessages(messages, [system['hostName'] for system in fleet.systems], programming_complete_size)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StubRequestHandler)
+    server.daemon_threads = True
+    server.schema = build_schema(STUB_SCHEMA)
+    server.root = {
+        'systems': lambda info: fleet.systems,
+        'programmers': lambda info: fleet.programmers,
+        'adapters': lambda info: fleet.adapters,
+        'latestAdapterStatistics': fleet.latest_adapter_statistics,
+        'messages': history.messages,
+    }
+    server.latency = latency
+    server.stats = {'requests': 0, 'bytes': 0}
+    server.stats_lock = threading.Lock()
+    return server
+
+# Run the stub server in a separate process, so its time and memory are not measured with the
+# query functions. The port is sent back through 'ready' once the server is listening
+def run_stub_server(port, adapters, messages, programming_complete_size, latency, ready):
+    server = create_stub_server(port, adapters, messages, programming_complete_size, latency)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+# Benchmarked query functions, by benchmark name. The output of the functions is discarded
+BENCHMARKS = {
+    'handlers': lambda: ConneXGraphQL.handlers_query(os.devnull),
+    'programmers': lambda: ConneXGraphQL.programmers_query(os.devnull),
+    'adapters': lambda: ConneXGraphQL.adapters_query(os.devnull),
+    'topology': lambda: ConneXGraphQL.topology_query(os.devnull),
+    'statistics': lambda: ConneXGraphQL.latest_statistics_all_adapters_query(os.devnull),
+    'statistics_batched': lambda: ConneXGraphQL.latest_statistics_all_adapters_batched_query(output_file=os.devnull),
+    'programmingcomplete': lambda: ConneXGraphQL.programmingcomplete_query(),
+    'allmessages': lambda: ConneXGraphQL.allmessages_query(),
+    'iterate_messages': lambda: sum(1 for _ in ConneXGraphQL.iterate_messages()),
+    'export_messages': lambda: ConneXGraphQL.export_messages_query(os.devnull),
+    'export_messages_sharded': lambda: ConneXGraphQL.export_messages_sharded_query(os.devnull),
+}
+
+# Number of requests and bytes served by the stub server so far
+def stub_stats(url):
+    return requests.get(url + "/stats").json()
+
+# Forget the query documents and snapshots kept by ConneXGraphQL, so every benchmark starts
+# as the first query of a new run, only the schema is kept
+def reset_client_state():
+    ConneXGraphQL.named_documents.clear()
+    ConneXGraphQL.adhoc_documents.clear()
+    ConneXGraphQL.validated_documents.clear()
+    ConneXGraphQL.topology_cache['topology'] = None
+    ConneXGraphQL.adapter_statistics_cache = None
+
+# Run a query function with its output discarded, returns the round trips, bytes received and time
+def run_benchmark(function, url):
+    reset_client_state()
+    before = stub_stats(url)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    after = stub_stats(url)
+    return after['requests'] - before['requests'], after['bytes'] - before['bytes'], elapsed
+
+# Peak memory allocated by a query function, measured in a separate run because tracing the
+# memory allocations slows down the function
+def measure_memory(function):
+    reset_client_state()
+    tracemalloc.start()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Load the saved baselines
+def load_baselines():
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE) as f:
+        return json.load(f)
+
+# Print the results of one benchmark, and the change from the baseline if given. Returns True when
+# the benchmark needs more round trips than in the baseline
+def print_results(name, results, baseline=None):
+    line = f"{name:24} {results['round_trips']:11d} {results['received_kb']:13.1f} {results['time_s']:10.3f} {results['memory_mb']:12.3f}"
+    if baseline == None:
+        print(line)
+        return False
+    changes = [f"round trips {results['round_trips'] - baseline['round_trips']:+d}"]
+    for key, label in [("time_s", "time"), ("memory_mb", "memory")]:
+        if baseline.get(key):
+            changes.append(f"{label} {(results[key] - baseline[key]) * 100.0 / baseline[key]:+.1f}%")
+    regression = results['round_trips'] > baseline['round_trips']
+    print(line + "  (" + ", ".join(changes) + ")" + ("  <-- MORE ROUND TRIPS" if regression else ""))
+    return regression
+
+# main program
+def main():
+    args = parser.parse_args()
+    latency = args.latency / 1000
+    programming_complete_size = args.programming_complete_kb * 1024
+    if args.serve:
+        server = create_stub_server(args.port or 5001, args.adapters, args.messages, programming_complete_size, latency)
+        print(f"Stub ConneX GraphQL server at http://127.0.0.1:{server.server_address[1]}/graphql, "
+              f"adapters: {args.adapters}, messages: {args.messages}, press CTRL+C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    names = args.benchmark or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark '{name}', available: {', '.join(BENCHMARKS)}")
+    baselines = load_baselines()
+    fleet = {'adapters': args.adapters, 'messages': args.messages, 'programming_complete_kb': args.programming_complete_kb, 'latency_ms': args.latency}
+    baseline = None
+    if args.compare:
+        if args.compare not in baselines:
+            parser.error(f"Baseline '{args.compare}' not found in {BASELINES_FILE}")
+        baseline = baselines[args.compare]
+        if baseline['fleet'] != fleet:
+            print(f"Warning: baseline '{args.compare}' was saved with a different fleet: {baseline['fleet']}")
+
+    # Start the stub server and point ConneXGraphQL to it, the schema is fetched once before the benchmarks
+    ready = multiprocessing.Queue()
+    stub = multiprocessing.Process(target=run_stub_server, daemon=True,
+                                   args=(args.port or 0, args.adapters, args.messages, programming_complete_size, latency, ready))
+    stub.start()
+    url = f"http://127.0.0.1:{ready.get(timeout=60)}"
+    ConneXGraphQL.CONNEX_GRAPHQL_URL = url + "/graphql"
+    ConneXGraphQL.SCHEMA_CACHE_MAX_AGE = 0
+    ConneXGraphQL.get_client()
+
+    print(f"Running benchmarks, adapters: {args.adapters}, messages: {args.messages}, "
+          f"programming complete: {args.programming_complete_kb} KB, latency: {args.latency} ms")
+    print(f"{'Benchmark':24} {'Round trips':>11} {'Received (KB)':>13} {'Time (s)':>10} {'Memory (MB)':>12}")
+    results = {}
+    regressions = []
+    try:
+        for name in names:
+            round_trips, received, elapsed = run_benchmark(BENCHMARKS[name], url)
+            memory = measure_memory(BENCHMARKS[name])
+            results[name] = {'round_trips': round_trips, 'received_kb': received / 1024, 'time_s': elapsed, 'memory_mb': memory / (1024 * 1024)}
+            if print_results(name, results[name], baseline['results'].get(name) if baseline != None else None):
+                regressions.append(name)
+    finally:
+        stub.terminate()
+
+    if args.save:
+        baselines[args.save] = {'fleet': fleet, 'results': results}
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Results saved as baseline '{args.save}' in {BASELINES_FILE}")
+    if regressions:
+        print(f"Round trips regression in: {', '.join(regressions)}")
+        sys.exit(1)
+
+# Script entry point
+if __name__ == '__main__':
+    main()
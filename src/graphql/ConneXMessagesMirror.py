@@ -0,0 +1,159 @@
+"""
+ConneX Messages Mirror sample code.
+
+ConneXMessagesMirror [-h] [-d DATABASE] [-u URL] {sync,query} ...
+
+ConneXMessagesMirror sync
+ConneXMessagesMirror query [-t TOPIC] [-s SINCE] [-e UNTIL] [-l LIMIT]
+
+This script keeps a local SQLite copy of the MQTT messages stored in
+the ConneX Server database, and allows to search it without sending
+requests to the ConneX Server.
+
+The 'sync' command downloads only the messages newer than the last
+ones downloaded by the previous run. The 'query' command prints the
+local messages matching the given topic and time range.
+
+This script requires that `gql` be installed within the Python
+environment you are running this script in, and the ConneXGraphQL.py
+script in the same folder.
+"""
+
+import argparse
+import datetime as dt
+import json
+import sqlite3
+import ConneXGraphQL
+
+# Number of messages inserted in the local database in each transaction
+SYNC_BATCH_SIZE = 1000
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding optional arguments
+parser.add_argument("-d", "--database", default="ConneXMessages.db", help="Local SQLite database file, default = ConneXMessages.db")
+parser.add_argument("-u", "--url", help=f"ConneX GraphQL server URL, default = {ConneXGraphQL.CONNEX_GRAPHQL_URL}")
+# The 'required' argument of add_subparsers() is not available in Python 3.6
+commands = parser.add_subparsers(dest="command")
+commands.required = True
+commands.add_parser("sync", help="Download the messages added since the last sync")
+query_parser = commands.add_parser("query", help="Print the local messages matching the filters")
+query_parser.add_argument("-t", "--topic", help="Only messages with topic containing this text")
+query_parser.add_argument("-s", "--since", help="Only messages with timestamp at or after this ISO date and time")
+query_parser.add_argument("-e", "--until", help="Only messages with timestamp before this ISO date and time")
+query_parser.add_argument("-l", "--limit", type=int, help="Maximum number of messages to print")
+
+# Open the local database, creating the tables and indexes the first time
+def open_database(database_file):
+    db = sqlite3.connect(database_file)
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            time REAL NOT NULL,
+            topic TEXT NOT NULL,
+            payload TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+        CREATE INDEX IF NOT EXISTS messages_topic ON messages (topic, time);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+    )
+    return db
+
+# Convert a ConneX timestamp, or a date and time given by the user, to seconds since epoch
+def to_epoch(timestamp):
+    time = dt.datetime.fromisoformat(timestamp)
+    if time.tzinfo == None:
+        # Dates and times without time zone are local time
+        time = time.astimezone()
+    return time.timestamp()
+
+# Read the message cursor of the last sync, used as high water mark for the next one
+def load_sync_cursor(db):
+    row = db.execute("SELECT value FROM sync_state WHERE name = 'cursor'").fetchone()
+    return json.loads(row[0]) if row else {}
+
+# Insert a batch of messages and save the cursor in the same transaction, so an interrupted
+# sync never leaves messages stored without their cursor or the other way around. A message
+# with the same timestamp, topic and payload as a stored one is not inserted again, as the
+# cursor can repeat messages with the same timestamp (see ConneXGraphQL.message_cursor_pending),
+# returns the number of messages inserted
+def store_messages(db, rows, cursor):
+    with db:
+        changes = db.total_changes
+        db.executemany(
+            """
+            INSERT INTO messages (timestamp, time, topic, payload) SELECT ?1, ?2, ?3, ?4
+            WHERE NOT EXISTS (SELECT 1 FROM messages WHERE topic = ?3 AND time = ?2 AND timestamp = ?1 AND payload IS ?4)
+        """, rows)
+        inserted = db.total_changes - changes
+        db.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('cursor', ?)", (json.dumps(cursor),))
+    return inserted
+
+# Download the messages newer than the last sync into the local database
+def sync_messages(db):
+    # Uses ConneXGraphQL.iterate_messages() to read the messages sorted by timestamp
+    # starting at the cursor saved by the previous sync
+    cursor = load_sync_cursor(db)
+    rows = []
+    count = 0
+    read = 0
+    for message in ConneXGraphQL.iterate_messages(cursor=cursor):
+        rows.append((message['timestamp'], to_epoch(message['timestamp']), message['topic'], message['payloadAsString']))
+        read = read + 1
+        if len(rows) == SYNC_BATCH_SIZE:
+            count = count + store_messages(db, rows, cursor)
+            rows = []
+    count = count + store_messages(db, rows, cursor)
+    total = db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    print(f"New messages: {count}, duplicates: {read - count}, total messages: {total}, last timestamp: {cursor.get('timestamp')}")
+
+# Read the local messages matching the given filters, sorted by timestamp
+def query_messages(db, topic_contains=None, since=None, until=None, limit=None):
+    # Same filters as the 'where' clause of the GraphQL 'messages' query,
+    # the time range uses the index on the message time
+    conditions = []
+    parameters = []
+    if topic_contains != None:
+        conditions.append("instr(topic, ?) > 0")
+        parameters.append(topic_contains)
+    if since != None:
+        conditions.append("time >= ?")
+        parameters.append(to_epoch(since))
+    if until != None:
+        conditions.append("time < ?")
+        parameters.append(to_epoch(until))
+    sql = "SELECT timestamp, topic, payload FROM messages"
+    if conditions:
+        sql = sql + " WHERE " + " AND ".join(conditions)
+    sql = sql + " ORDER BY time, id"
+    if limit != None:
+        sql = sql + " LIMIT ?"
+        parameters.append(limit)
+    return db.execute(sql, parameters)
+
+# main program
+def main():
+    args = parser.parse_args()
+    if args.url:
+        # The GraphQL client is created on first use, so the URL can still be changed
+        ConneXGraphQL.CONNEX_GRAPHQL_URL = args.url
+    db = open_database(args.database)
+    try:
+        if args.command == "sync":
+            sync_messages(db)
+        else:
+            for timestamp, topic, payload in query_messages(db, args.topic, args.since, args.until, args.limit):
+                print(timestamp + " | " + topic + " | " + payload)
+    finally:
+        db.close()
+
+# Script entry point
+if __name__ == '__main__':
+    main()
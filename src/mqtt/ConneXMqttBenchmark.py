@@ -0,0 +1,305 @@
+"""
+ConneX MQTT Benchmark sample code.
+
+ConneXMqttBenchmark [-h] [-n COUNT] [-m {direct,broker}] [-i IPHOST] [-p PORT] [-l {none,file,queue}] [-y] [-e] [-k KB] [-s NAME] [-c NAME]
+
+This script measures how many messages per second the message callback
+of ConneXMqttClient can process, with the logging mode and handlers used.
+
+The messages are generated with the topics and payloads of a ConneX
+handler running a job: pick and place bursts, programming complete
+events of about 30 KB, device complete events and system statistics.
+
+In 'direct' mode (default) the messages are passed directly to the
+on_message() callback. In 'broker' mode they are published to a MQTT
+Broker (e.g. a local test broker, never a production one) and received
+by a client using the on_message() callback.
+
+The results are the throughput, the 50th and 99th percentile of the time
+spent in the callback and the peak memory allocated. Use '-s NAME' to save
+them as a baseline and '-c NAME' to compare with a saved baseline.
+
+This script requires that `paho.mqtt` be installed within the Python
+environment you are running this script in, and the ConneXMqttClient.py
+script in the same folder.
+"""
+
+import paho.mqtt.client as mqtt
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import ConneXMqttClient
+
+# File where the benchmark results saved as baselines are kept, by baseline name
+BASELINES_FILE = "ConneXMqttBenchmark.json"
+
+# Number of handler machines sending messages, and devices programmed at the same time by each
+BENCHMARK_MACHINES = 4
+BENCHMARK_SOCKETS = 8
+
+# Devices completed by a machine between two system statistics messages
+STATISTICS_EVERY = 10
+
+# Seconds to wait for more messages from the broker before ending the 'broker' mode benchmark
+BROKER_IDLE_TIMEOUT = 5
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding optional arguments
+parser.add_argument("-n", "--count", type=int, default=20000, help="Number of messages to generate, default = 20000")
+parser.add_argument("-m", "--mode", choices=["direct", "broker"], default="direct", help="Pass the messages directly to the callback or through a MQTT Broker, default = direct")
+parser.add_argument("-i", "--iphost", default="localhost", help="MQTT Broker IP address or host name in 'broker' mode, default = localhost")
+parser.add_argument("-p", "--port", type=int, default=1883, help="MQTT Broker port in 'broker' mode, default = 1883")
+parser.add_argument("-l", "--logging", choices=["none", "file", "queue"], default="file", help="Logging of the messages, default = file")
+parser.add_argument("-y", "--yield-handlers", action="store_true", help="Register the rolling yield statistics handlers")
+parser.add_argument("-e", "--metrics", action="store_true", help="Enable the metrics of the callback, served at a random local port")
+parser.add_argument("-k", "--programming-complete-kb", type=int, default=30, help="Size in KB of the programming complete payloads, default = 30")
+parser.add_argument("-s", "--save", metavar="NAME", help="Save the results as a baseline with this name")
+parser.add_argument("-c", "--compare", metavar="NAME", help="Compare the results with the baseline with this name")
+
+# Random dash separated hex dump of 'length' bytes, like the device details of programming complete events
+def hex_dump(rng, length):
+    return "-".join(f"{rng.getrandbits(8):02X}" for _ in range(length))
+
+# Build a programming complete payload like the ones published by the programmers, padded
+# with serial data up to about 'size' bytes
+def programming_complete_payload(rng, machine, socket, size):
+    record = {
+        "TimeStamp": "2023-12-06T16:29:45.5547158Z",
+        "Programmer": {
+            "Class": "LumenX", "FirmwareVersion": "2.1.1.44", "SerialNumber": f"001-035-032-021-008-253-056-{socket:03d}-238",
+            "SystemVersion": "2.1.1.44", "ProgrammerIP": "10.0.0.11",
+            "Adapter": {
+                "AdapterId": "110008", "AdapterSerialNumber": f"001-035-216-109-026-059-090-{socket:03d}-238",
+                "CleanCount": "99883", "LifetimeActuationCount": "99883", "LifetimeContinuityFailCount": "0",
+                "LifetimeFailCount": "1", "LifetimePassCount": "99882", "SocketIndex": str(socket), "AdapterState": "Validated",
+            },
+        },
+        "Job": {
+            "AlgorithmId": "27415240116273152", "JobId": "3df1074a-471e-4f9e-8892-bf8d768f17ef", "JobName": "Verify Memory (2GB)",
+            "JobDescription": "Memory verification job, it does not program, it only performs memory verification.",
+            "DeviceName": "KLMDG4UCTA-B041", "DeviceManufacturer": "Samsung", "DeviceType": "Emmc", "DeviceID": "24934", "AlgoVersion": "9.4.0",
+        },
+        "PartDetail": {
+            "ChipId": "", "RawChipId": "",
+            "Result": {
+                "Code": "0" if rng.random() > 0.02 else "1", "CodeName": "Success", "ProgramDuration": 0, "VerifyDuration": 24200, "Times": None,
+                "AlgoDeviceDetails": {
+                    "CID": "CID(127-0):" + hex_dump(rng, 16), "device": None, "sentrix": None, "Cnt": "2",
+                    "eCSD": "eCSD(0-511):" + hex_dump(rng, 512),
+                },
+                "BlankCheckDuration": "0", "EraseDuration": "0", "ErrorMessage": "", "BytesProgrammed": 0, "SocketIndex": str(socket), "Overhead": "3200",
+            },
+        },
+        "HandlerInfo": {
+            "Name": machine, "IpAddresses": "192.168.56.1,10.0.0.99", "Version": "30.0.8.511", "MachineSNID": "PSV7000:xxxxxxx",
+            "MachineName": "HANDLER-NVC", "FactoryName": "", "LicenseLevel": None, "PCSerialNumber": "1CXM7V3",
+        },
+        "SerialData": None,
+    }
+    padding = max(0, size - len(json.dumps([record])))
+    record["SerialData"] = hex_dump(rng, padding // 3)
+    return json.dumps([record], separators=(",", ":")).encode()
+
+# Generate the messages of the handler machines running a job, as (topic, payload) tuples. Each
+# device is picked from the tray, placed in a socket, programmed, picked from the socket and placed
+# back in the tray, the handlers publish their statistics every few devices
+def generate_messages(count, programming_complete_size, seed=1):
+    rng = random.Random(seed)
+    machines = [(f"dell{index:03d}", "%032x" % rng.getrandbits(128)) for index in range(BENCHMARK_MACHINES)]
+    # A few programming complete payloads are reused, so the generated messages do not take
+    # much more memory than the ones received from a real broker
+    programming_complete = {(machine, socket): programming_complete_payload(rng, machine, socket, programming_complete_size)
+                            for machine, _ in machines for socket in range(1, BENCHMARK_SOCKETS + 1)}
+    messages = []
+    device = 0
+    while len(messages) < count:
+        device = device + 1
+        for machine, session in machines:
+            socket = device % BENCHMARK_SOCKETS + 1
+            status = "Pass" if rng.random() > 0.02 else "Fail"
+            messages.append((f"ah700/operations/pick/{machine}/{session}", json.dumps({"DeviceID": str(device), "Location": "Tray1", "Position": device, "PickHead": 1, "Status": "Pass"}).encode()))
+            messages.append((f"ah700/operations/place/{machine}/{session}", json.dumps({"DeviceID": device, "Location": f"Prog{socket}", "Position": 2, "PickHead": 1, "Status": "Pass"}).encode()))
+            messages.append(("connex/programmer/lumenx/legacy/programmingcomplete", programming_complete[(machine, socket)]))
+            messages.append((f"ah700/operations/pick/{machine}/{session}", json.dumps({"DeviceID": str(device), "Location": f"Prog{socket}", "Position": 2, "PickHead": 1, "Status": "Pass"}).encode()))
+            messages.append((f"ah700/operations/devicecomplete/{machine}/{session}", json.dumps({"DeviceID": device, "Status": status, "ErrorCode": 2}).encode()))
+            messages.append((f"ah700/operations/place/{machine}/{session}", json.dumps({"DeviceID": device, "Location": "Tray1", "Position": device, "PickHead": 1, "Status": "Pass"}).encode()))
+            if device % STATISTICS_EVERY == 0:
+                messages.append((f"ah700/systemstatistics/{machine}/{session}", json.dumps({
+                    "HandlerIdentifier": "cae34d03-772a-4248-98cf-e68d9d062481", "TotalPass": device, "TotalFail": 0, "UPH": 1200,
+                    "SystemYield": "100.00", "HandlerYield": "100.00", "ProgrammerYield": "100.00", "DevicesFailedOnProgrammer": 0,
+                    "DevicesPickedInput": device, "JobProcessingTime": str(device), "JobAssistanceTime": "0", "JobCompletionEstimate": ""}).encode()))
+    return messages[:count]
+
+# Set up the logging of ConneXMqttClient for the benchmark, the console output is discarded and
+# the log file is written to ConneXMqttBenchmark.log. Returns the queue logging listener, if any
+def setup_logging(mode):
+    logger = ConneXMqttClient.logger
+    logger.removeHandler(ConneXMqttClient.c_handler)
+    logger.removeHandler(ConneXMqttClient.f_handler)
+    if mode == "none":
+        logger.setLevel(logging.WARNING)
+        return None
+    ConneXMqttClient.c_handler = logging.StreamHandler(open(os.devnull, "w"))
+    ConneXMqttClient.f_handler = logging.FileHandler("ConneXMqttBenchmark.log")
+    ConneXMqttClient.f_handler.setFormatter(ConneXMqttClient.f_format)
+    logger.addHandler(ConneXMqttClient.f_handler)
+    if mode == "queue":
+        return ConneXMqttClient.start_queue_logging()
+    return None
+
+# Pass the messages directly to the callback, returns the time spent in each call
+def run_direct(messages):
+    latencies = []
+    for topic, payload in messages:
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        start = time.perf_counter()
+        ConneXMqttClient.on_message(None, None, msg)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+# Publish the messages to the broker and receive them with the callback, returns the time
+# spent in each call
+def run_broker(messages, host, port):
+    latencies = []
+    received = threading.Event()
+    last_received = [time.monotonic()]
+
+    def on_message(client, userdata, msg):
+        start = time.perf_counter()
+        ConneXMqttClient.on_message(client, userdata, msg)
+        latencies.append(time.perf_counter() - start)
+        last_received[0] = time.monotonic()
+        if len(latencies) == len(messages):
+            received.set()
+
+    # Both clients are connected before starting their network threads, so nothing is left
+    # running when the broker can not be reached
+    subscriber = mqtt.Client(client_id=f"connex-mqtt-benchmark-sub-{os.getpid()}")
+    subscriber.on_message = on_message
+    subscriber.connect(host, port, 60)
+    publisher = mqtt.Client(client_id=f"connex-mqtt-benchmark-pub-{os.getpid()}")
+    publisher.connect(host, port, 60)
+    subscriber.subscribe([("ah700/#", 0), ("connex/programmer/#", 0)])
+    subscriber.loop_start()
+    publisher.loop_start()
+    # Give the broker time to register the subscriptions
+    time.sleep(0.5)
+    try:
+        for topic, payload in messages:
+            publisher.publish(topic, payload)
+        while not received.wait(0.5):
+            if time.monotonic() - last_received[0] > BROKER_IDLE_TIMEOUT:
+                print(f"Only {len(latencies)} of {len(messages)} messages received")
+                break
+    finally:
+        publisher.disconnect()
+        publisher.loop_stop()
+        subscriber.disconnect()
+        subscriber.loop_stop()
+    return latencies
+
+# Get a percentile of the sorted latencies
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+# Peak memory allocated while passing the messages to the callback, measured in a separate pass
+# because tracing the memory allocations slows down the callback
+def measure_memory(messages):
+    tracemalloc.start()
+    try:
+        run_direct(messages)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        # Wait until the log records of this pass are written, when queue logging is used
+        log_stats = ConneXMqttClient.log_stats
+        while log_stats['written'] + log_stats['dropped'] < log_stats['queued']:
+            time.sleep(0.01)
+
+# Load the saved baselines
+def load_baselines():
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE) as f:
+        return json.load(f)
+
+# Print the results, and the change from the baseline if given
+def print_results(results, baseline=None):
+    labels = [("throughput", "Throughput", "messages/s"), ("p50_ms", "Callback p50", "ms"), ("p99_ms", "Callback p99", "ms"), ("memory_mb", "Memory peak", "MB")]
+    for key, label, unit in labels:
+        line = f"{label:14}: {results[key]:12.3f} {unit}"
+        if baseline != None and baseline.get(key):
+            line = line + f"  ({(results[key] - baseline[key]) * 100.0 / baseline[key]:+.1f}% from {baseline[key]:.3f})"
+        print(line)
+
+# main program
+def main():
+    args = parser.parse_args()
+    baselines = load_baselines()
+    if args.compare and args.compare not in baselines:
+        parser.error(f"Baseline '{args.compare}' not found in {BASELINES_FILE}")
+
+    print(f"Generating {args.count} messages...")
+    messages = generate_messages(args.count, args.programming_complete_kb * 1024)
+    listener = setup_logging(args.logging)
+    if args.yield_handlers:
+        router = ConneXMqttClient.router
+        router.add("ah700/operations/devicecomplete/+/+", ConneXMqttClient.on_device_complete, "machine", "session")
+        router.add("connex/programmer/+/legacy/programmingcomplete", ConneXMqttClient.on_programming_result, "programmer_class")
+        router.add("ah700/systemstatistics/+/+", ConneXMqttClient.on_system_statistics, "machine", "session")
+
+    if args.metrics:
+        ConneXMqttClient.metrics_server = ConneXMqttClient.start_metrics_server(0, ConneXMqttClient.logger, ConneXMqttClient.render_client_metrics)
+
+    print(f"Running benchmark, mode: {args.mode}, logging: {args.logging}, yield handlers: {args.yield_handlers}, metrics: {args.metrics}")
+    memory = measure_memory(messages[:min(len(messages), 5000)])
+    start = time.perf_counter()
+    if args.mode == "direct":
+        latencies = run_direct(messages)
+    else:
+        try:
+            latencies = run_broker(messages, args.iphost, args.port)
+        except OSError as e:
+            print(f"Could not connect to the MQTT Broker, host: {args.iphost}, port: {args.port} ({e}), "
+                  f"start a local test broker or use the 'direct' mode", file=sys.stderr)
+            sys.exit(1)
+    # The messages are processed when the log records still in the queue are written
+    if listener != None:
+        listener.stop()
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        print("No messages received from the MQTT Broker", file=sys.stderr)
+        sys.exit(1)
+
+    latencies.sort()
+    results = {
+        "mode": args.mode,
+        "logging": args.logging,
+        "yield_handlers": args.yield_handlers,
+        "metrics": args.metrics,
+        "messages": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "memory_mb": memory / (1024 * 1024),
+    }
+    print_results(results, baselines.get(args.compare) if args.compare else None)
+
+    if args.save:
+        baselines[args.save] = results
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Results saved as baseline '{args.save}' in {BASELINES_FILE}")
+
+# Script entry point
+if __name__ == '__main__':
+    main()
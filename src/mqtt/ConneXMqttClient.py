@@ -1,7 +1,7 @@
 """
 ConneX MQTT Client sample code.
 
-ConneXMqttClient [-h] [-i IPHOST] [-p PORT]
+ConneXMqttClient [-h] [-i IPHOST] [-p PORT] [-q] [-r MB] [-a FOLDER] [-w WORKERS] [-o POLICY] [-d MS] [-e PORT] [-c FOLDER]
 
 This script allows the user to connect to a ConneX MQTT Broker.
 
@@ -9,16 +9,25 @@ When successful, the script will log the subscribed event messages to
 both the console and a log file named 'ConneXMqttClient.log'.
 
 This script requires that `paho.mqtt` be installed within the Python
-environment you are running this script in.
+environment you are running this script in, and the ConneXMqttCommon.py
+module in the same folder.
 
 To stop the script, simply press CTRL+C to abort the execution.
 """
 
 import paho.mqtt.client as mqtt
+import itertools
 import logging
+import queue
+import threading
 import argparse
 import datetime as dt
+import json
+import os
 import random
+import re
+import time
+from ConneXMqttCommon import CAPTURE_MAGIC, CAPTURE_RECORD_HEADER, CAPTURE_RETAIN_FLAG, LOG_ARCHIVE_SEGMENT_MB, OPERATION_KINDS, LogArchiver, OperationsStore, TopicRouter, add_connection_metric, add_message_metrics, log_stats, render_metrics, rotating_log_handler, start_log_listener, start_metrics_server
 
 # Helper class to use microseconds in logger timestamps
 class uSecsFormatter(logging.Formatter):
@@ -54,12 +63,607 @@ logger.addHandler(f_handler)
 # Set logger threshold level
 logger.setLevel(logging.INFO)
 
+# Replace the log file handler by a rotating one, starting a new file when it reaches 'max_bytes',
+# the old log files are compressed by 'archiver' when given, instead of keeping the last 5 ones
+def rotate_log_file(max_bytes, archiver=None):
+    global f_handler
+    f_handler = rotating_log_handler(logger, f_handler, max_bytes, archiver.rotate if archiver != None else None)
+
+# Send the log records through a queue, so logging a message only puts it in the queue and
+# the console and log file are written by a background thread. Returns the started listener.
+def start_queue_logging():
+    return start_log_listener(logger, [c_handler, f_handler])
+
+# Size in bytes at which a new capture segment file is started
+CAPTURE_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Helper class to append the received messages to binary capture segment files
+class CaptureWriter:
+    def __init__(self, folder, segment_size=CAPTURE_SEGMENT_SIZE):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.file = None
+        self.records = 0
+        os.makedirs(folder, exist_ok=True)
+
+    # Start a new segment file named after the current time
+    def new_segment(self):
+        if self.file != None:
+            self.file.close()
+        name = dt.datetime.now().strftime("ConneXCapture-%Y%m%d-%H%M%S-%f.bin")
+        self.file = open(os.path.join(self.folder, name), "wb", buffering=1024 * 1024)
+        self.file.write(CAPTURE_MAGIC)
+        logger.info(f"Capturing messages to '{self.file.name}'")
+
+    def write(self, msg):
+        if self.file == None or self.file.tell() >= self.segment_size:
+            self.new_segment()
+        topic = msg.topic.encode()
+        flags = msg.qos | (CAPTURE_RETAIN_FLAG if msg.retain else 0)
+        self.file.write(CAPTURE_RECORD_HEADER.pack(time.time(), len(topic), flags, len(msg.payload)))
+        self.file.write(topic)
+        self.file.write(msg.payload)
+        self.records = self.records + 1
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+# Maximum number of messages waiting in the queue of each pipeline worker
+PIPELINE_QUEUE_SIZE = 1000
+
+# Topic filters of the messages that can be dropped when a worker queue is full with the
+# 'drop-class' overflow policy, the messages of other topics wait for room in the queue
+PIPELINE_DROPPABLE_TOPICS = ["+/systemstatistics/+/+", "+/operations/pick/+/+", "+/operations/place/+/+"]
+
+# Topic filters of the messages that must be processed in the order they were received, with the
+# source of their ordering key: the index of the topic level with the handler name, or the payload
+# field with the programmer serial number. Messages with the same key are always processed by the
+# same worker, the messages of other topics are sent to the workers in turn
+PIPELINE_ORDERING_KEYS = [
+    ("ah700/+/+/+", 2),                                         # e.g. ah700/systemstatus/<machine>/<session>
+    ("ah700/+/+/+/+", 3),                                       # e.g. ah700/operations/pick/<machine>/<session>
+    ("connex/programmer/+/legacy/+", "Programmer.SerialNumber"),  # e.g. connex/programmer/lumenx/legacy/programmingcomplete
+]
+
+# Helper class to process the messages in worker threads instead of the MQTT network thread, so
+# slow handlers do not delay the keep alive of the connection. Each worker has its own bounded
+# queue, and the messages are sent to a worker by their PIPELINE_ORDERING_KEYS key, so the messages
+# of the same handler or programmer are processed in the order they were received, the messages
+# without a key are sent to the workers in turn. When the queue of a worker is full:
+#   'block'       waits for room in the queue, slowing down the network thread
+#   'drop-oldest' drops the oldest message waiting in the queue
+#   'drop-class'  drops the message if its topic matches PIPELINE_DROPPABLE_TOPICS, otherwise waits
+class MessagePipeline:
+    def __init__(self, process, workers, overflow="block", queue_size=PIPELINE_QUEUE_SIZE):
+        self.process = process
+        self.overflow = overflow
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.droppable = TopicRouter()
+        for topic_filter in PIPELINE_DROPPABLE_TOPICS:
+            self.droppable.add(topic_filter, None)
+        self.ordering = TopicRouter()
+        for topic_filter, source in PIPELINE_ORDERING_KEYS:
+            self.ordering.add(topic_filter, source)
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+        self.counts = {'queued': 0, 'processed': 0, 'dropped': 0, 'max_depth': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+        self.threads = [threading.Thread(target=self.run, args=(q,), name=f"ConneXMqttWorker{index}", daemon=True)
+                        for index, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    # Ordering key of a message, the handler name or programmer serial number, or None
+    def ordering_key(self, msg):
+        routes = self.ordering.match(msg.topic)
+        if not routes:
+            return None
+        source = routes[0][0]
+        if isinstance(source, int):
+            return msg.topic.split("/")[source]
+        try:
+            return LazyPayload(msg.payload).get(source)
+        except ValueError:
+            return None
+
+    # Queue a message for its worker, called from the MQTT network thread
+    def submit(self, msg):
+        key = self.ordering_key(msg)
+        if key == None:
+            q = self.queues[next(self.turn) % len(self.queues)]
+        else:
+            q = self.queues[hash(key) % len(self.queues)]
+        item = (msg, time.monotonic())
+        if self.overflow == "drop-oldest":
+            while True:
+                try:
+                    q.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                        self.count_dropped()
+                    except queue.Empty:
+                        pass
+        elif self.overflow == "drop-class" and self.droppable.match(msg.topic):
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                self.count_dropped()
+                return
+        else:
+            q.put(item)
+        depth = q.qsize()
+        with self.lock:
+            self.counts['queued'] = self.counts['queued'] + 1
+            if depth > self.counts['max_depth']:
+                self.counts['max_depth'] = depth
+
+    def count_dropped(self):
+        with self.lock:
+            self.counts['dropped'] = self.counts['dropped'] + 1
+
+    # Worker thread, processes the messages of its queue in order until stopped
+    def run(self, q):
+        while True:
+            item = q.get()
+            if item == None:
+                return
+            msg, queued = item
+            wait = time.monotonic() - queued
+            with self.lock:
+                self.counts['wait_total'] = self.counts['wait_total'] + wait
+                if wait > self.counts['wait_max']:
+                    self.counts['wait_max'] = wait
+            try:
+                self.process(msg)
+            except Exception:
+                logger.exception(f"Error processing message with topic '{msg.topic}'")
+            with self.lock:
+                self.counts['processed'] = self.counts['processed'] + 1
+
+    # Current queue depth and counters, with the average and maximum time waited in the queue
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['depth'] = sum(q.qsize() for q in self.queues)
+        stats['wait_average'] = stats['wait_total'] / stats['processed'] if stats['processed'] > 0 else 0.0
+        return stats
+
+    # Process the messages still in the queues and stop the workers
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+# Topic filters of the status messages published again and again with the same payload, e.g. the
+# system statistics of an idle handler every 10 seconds, used by the coalescing stage
+COALESCE_DUPLICATE_TOPICS = ["+/systemstatistics/+/+", "+/systemstatus/+/+"]
+
+# Seconds after which a repeated payload is passed anyway, so the log still shows the machine is alive
+COALESCE_DUPLICATE_MAX_AGE = 300
+
+# Topic filters of the state change messages, with 'OldState' and 'NewState' in the payload,
+# that are collapsed when the state changes several times within the coalescing window
+COALESCE_FLIP_TOPICS = ["+/lightowerchanged/+/+"]
+
+# Helper class to reduce the messages of high rate status topics before they are logged and processed.
+# A message of COALESCE_DUPLICATE_TOPICS with the same payload as the last message of its topic is
+# suppressed, the payloads are compared by a hash. The first state change of a COALESCE_FLIP_TOPICS topic
+# is passed at once, the next ones within 'window' seconds are held and passed as a single state change
+# when the window ends, from the first to the last state, with all the states in between in 'States'
+class MessageCoalescer:
+    def __init__(self, forward, window):
+        self.forward = forward
+        self.window = window
+        self.duplicate_topics = TopicRouter()
+        for topic_filter in COALESCE_DUPLICATE_TOPICS:
+            self.duplicate_topics.add(topic_filter, None)
+        self.flip_topics = TopicRouter()
+        for topic_filter in COALESCE_FLIP_TOPICS:
+            self.flip_topics.add(topic_filter, None)
+        self.last_payloads = {}
+        self.bursts = {}
+        self.lock = threading.Lock()
+        self.counts = {'received': 0, 'duplicates': 0, 'flips': 0, 'summaries': 0}
+
+    # Pass the message to 'forward' unless it is suppressed or held, 'forward' is called after
+    # releasing the lock so a slow handler does not block the other topics or the timers
+    def submit(self, msg):
+        with self.lock:
+            self.counts['received'] = self.counts['received'] + 1
+            if self.duplicate_topics.match(msg.topic) and self.is_duplicate(msg):
+                self.counts['duplicates'] = self.counts['duplicates'] + 1
+                return
+            if self.flip_topics.match(msg.topic) and self.hold_flip(msg):
+                self.counts['flips'] = self.counts['flips'] + 1
+                return
+        self.forward(msg)
+
+    # Check if the payload is the same as the last payload of the topic
+    def is_duplicate(self, msg):
+        now = time.monotonic()
+        key = (hash(msg.payload), len(msg.payload))
+        last = self.last_payloads.get(msg.topic)
+        if last != None and last[0] == key and now - last[1] < COALESCE_DUPLICATE_MAX_AGE:
+            return True
+        self.last_payloads[msg.topic] = (key, now)
+        return False
+
+    # Hold the state changes received within the window of the first one, a payload that is
+    # not a JSON object is never held
+    def hold_flip(self, msg):
+        burst = self.bursts.get(msg.topic)
+        if burst == None:
+            # First state change, passed at once, opens the window
+            timer = threading.Timer(self.window, self.flush, args=(msg.topic,))
+            timer.daemon = True
+            self.bursts[msg.topic] = {'timer': timer, 'states': [], 'last': None}
+            timer.start()
+            return False
+        try:
+            payload = json.loads(msg.payload)
+        except ValueError:
+            return False
+        if not isinstance(payload, dict):
+            return False
+        if not burst['states']:
+            burst['states'].append(payload.get("OldState"))
+        burst['states'].append(payload.get("NewState"))
+        burst['last'] = msg
+        return True
+
+    # Close the window of a topic, passing the held state changes as a single one. The burst is
+    # taken out under the lock and the summary is passed after releasing it
+    def flush(self, topic):
+        with self.lock:
+            burst = self.bursts.pop(topic, None)
+            if burst == None or burst['last'] == None:
+                return
+            self.counts['summaries'] = self.counts['summaries'] + 1
+        states = burst['states']
+        summary = mqtt.MQTTMessage(topic=topic.encode())
+        summary.payload = json.dumps({"OldState": states[0], "NewState": states[-1], "States": states}, separators=(",", ":")).encode()
+        summary.qos = burst['last'].qos
+        summary.retain = burst['last'].retain
+        self.forward(summary)
+
+    # Suppressed and collapsed message counters
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    # Pass the state changes still held
+    def stop(self):
+        with self.lock:
+            bursts = dict(self.bursts)
+        for topic, burst in bursts.items():
+            burst['timer'].cancel()
+            self.flush(topic)
+
+# Part of a payload where the first keys of the fields must start for LazyPayload.fields() to scan it
+# key by key, when a key starts further in the payload, or is not found, it is fully parsed, which is
+# faster. The value
+# of the last key can extend much further than its start, e.g. 'PartDetail' in 'programmingcomplete'
+LAZY_PAYLOAD_SCAN_FRACTION = 0.25
+
+# JSON decoder used to decode single values of a payload
+json_decoder = json.JSONDecoder()
+
+# Whitespace and separators between the keys and values of a JSON object
+json_whitespace_pattern = re.compile(r"\s*")
+json_colon_pattern = re.compile(r"\s*:\s*")
+json_comma_pattern = re.compile(r"\s*,?\s*")
+
+# Get the value at a path of keys and list indexes in a parsed JSON value, or 'default'
+def json_path_value(value, keys, default=None):
+    for key in keys:
+        try:
+            value = value[int(key)] if isinstance(value, list) else value[key]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return default
+    return value
+
+# Helper class to decode only the fields needed from a JSON payload. A field is given by the
+# path of keys to it, e.g. "Programmer.Adapter.CleanCount". Instead of parsing the whole payload,
+# the keys of the payload object are scanned once, in order, and the value of each key is decoded
+# and kept, e.g. the "Programmer" object, until the first key of the path is found. The next fields
+# continue the scan where it stopped, so each value is decoded only once, and the part of the payload
+# after the last key needed is not read. Paths starting with a list index, e.g. "1.AdapterId", use
+# the fully parsed payload. For payloads that are a list of records, like 'programmingcomplete', the
+# fields of the first record are returned.
+class LazyPayload:
+    def __init__(self, payload):
+        self.payload = payload
+        self._text = None
+        self._json = None
+        # Values of the payload object decoded so far by key, and position of the next key to
+        # decode, None until the scan starts and -1 when the payload is not an object
+        self.values = {}
+        self.position = None
+
+    # Payload decoded as text, only the first time it is needed
+    @property
+    def text(self):
+        if self._text == None:
+            self._text = self.payload.decode()
+        return self._text
+
+    # Payload fully parsed, only the first time it is needed
+    @property
+    def json(self):
+        if self._json == None:
+            self._json = json.loads(self.text)
+        return self._json
+
+    # Get the value of a field, or 'default' when the payload does not have the field
+    def get(self, path, default=None):
+        keys = path.split(".")
+        if self.position == None:
+            self.start_scan()
+        if keys[0].isdigit() or self.position == -1:
+            return self.get_parsed(keys, default)
+        if keys[0] not in self.values:
+            self.scan(keys[0])
+        if keys[0] not in self.values:
+            return default
+        return json_path_value(self.values[keys[0]], keys[1:], default)
+
+    # Find the position of the first key of the payload object, or of the first record when the
+    # payload is a list of records
+    def start_scan(self):
+        text = self.text
+        position = json_whitespace_pattern.match(text).end()
+        if text.startswith("[", position):
+            position = json_whitespace_pattern.match(text, position + 1).end()
+        if text.startswith("{", position):
+            self.position = json_whitespace_pattern.match(text, position + 1).end()
+        else:
+            self.position = -1
+
+    # Decode the next keys of the payload object and their values until 'key' is found or the
+    # object ends. Only the keys of the object itself are compared, so the same key name in the
+    # objects nested in it is never matched
+    def scan(self, key):
+        text = self.text
+        position = self.position
+        values = self.values
+        while text.startswith('"', position):
+            name, position = json.decoder.scanstring(text, position + 1)
+            position = json_colon_pattern.match(text, position).end()
+            value, position = json_decoder.raw_decode(text, position)
+            position = json_comma_pattern.match(text, position).end()
+            if name not in values:
+                values[name] = value
+            if name == key:
+                break
+        self.position = position
+
+    # Get the value of a field from the fully parsed payload
+    def get_parsed(self, keys, default=None):
+        value = self.json
+        if isinstance(value, list) and not keys[0].isdigit():
+            value = value[0] if value else None
+        return json_path_value(value, keys, default)
+
+    # Get the values of several fields as a dictionary by field path. Scanning the keys one after
+    # the other costs more per byte than parsing the whole payload at once, so when a first key of
+    # the paths is not found in the first part of the payload the fully parsed payload is used
+    def fields(self, paths):
+        text = self.text
+        limit = int(len(text) * LAZY_PAYLOAD_SCAN_FRACTION)
+        keys = {path: path.split(".") for path in paths}
+        first_keys = {path_keys[0] for path_keys in keys.values()}
+        if not all(text.find(f'"{key}"', 0, limit) != -1 and not key.isdigit() for key in first_keys):
+            return {path: self.get_parsed(path_keys) for path, path_keys in keys.items()}
+        return {path: self.get(path) for path in paths}
+
+    # Get a field with a dash separated hex dump, like the 'eCSD' and 'CID' device details,
+    # as bytes. The dump can start with a label, e.g. "CID(127-0):15-01-00-44-..."
+    def get_bytes(self, path):
+        value = self.get(path)
+        if value == None:
+            return None
+        return decode_hex_dump(value)
+
+# Convert a dash separated hex dump, e.g. "CID(127-0):15-01-00-44", to bytes
+def decode_hex_dump(dump):
+    return bytes.fromhex(dump.rpartition(":")[2].replace("-", ""))
+
+# Decorator for message handlers that only need some fields of the payload, the handler is
+# called as handler(msg, values, **fields), with 'values' a dictionary of the payload fields
+# by field path, e.g.
+#
+#   @payload_fields("PartDetail.Result.Code", "Programmer.Adapter.SocketIndex")
+#   def on_programming_complete(msg, values, programmer_class):
+def payload_fields(*paths):
+    def decorator(handler):
+        def handle(msg, **fields):
+            handler(msg, LazyPayload(msg.payload).fields(paths), **fields)
+        return handle
+    return decorator
+
+# Rolling windows of the yield statistics, by name, as (window length, number of buckets) in seconds
+YIELD_WINDOWS = {"1min": (60, 60), "15min": (900, 90)}
+
+# Helper class to count passed and failed devices in a sliding time window. The window is split
+# in buckets, adding a result only updates the current bucket and the window totals, and the
+# buckets that fall out of the window are subtracted from the totals when time moves forward
+class RollingCounter:
+    def __init__(self, length, buckets):
+        self.length = length
+        self.width = length / buckets
+        self.passed = [0] * buckets
+        self.failed = [0] * buckets
+        self.total_passed = 0
+        self.total_failed = 0
+        self.current = None
+        self.first = None
+
+    # Move the window to the bucket of 'now', clearing the buckets left behind
+    def advance(self, now):
+        bucket = int(now // self.width)
+        if self.current == None:
+            self.current = bucket
+            self.first = now
+            return
+        # At most one pass over the buckets, however long since the last result
+        for old in range(self.current + 1, min(bucket, self.current + len(self.passed)) + 1):
+            index = old % len(self.passed)
+            self.total_passed = self.total_passed - self.passed[index]
+            self.total_failed = self.total_failed - self.failed[index]
+            self.passed[index] = 0
+            self.failed[index] = 0
+        self.current = max(self.current, bucket)
+
+    def add(self, now, passed):
+        self.advance(now)
+        index = self.current % len(self.passed)
+        if passed:
+            self.passed[index] = self.passed[index] + 1
+            self.total_passed = self.total_passed + 1
+        else:
+            self.failed[index] = self.failed[index] + 1
+            self.total_failed = self.total_failed + 1
+
+    # Passed and failed devices in the window ending at 'now', and the time covered by the
+    # window, which is shorter than the window length during the first minutes
+    def counts(self, now):
+        self.advance(now)
+        return self.total_passed, self.total_failed, max(self.width, min(self.length, now - self.first))
+
+# Helper class to count passed and failed devices since the start of the job
+class JobCounter:
+    def __init__(self):
+        self.total_passed = 0
+        self.total_failed = 0
+        self.first = None
+
+    def add(self, now, passed):
+        if self.first == None:
+            self.first = now
+        if passed:
+            self.total_passed = self.total_passed + 1
+        else:
+            self.total_failed = self.total_failed + 1
+
+    def counts(self, now):
+        return self.total_passed, self.total_failed, max(1.0, now - self.first)
+
+# Helper class to keep the yield and UPH (units per hour) of the handlers, sessions, programmers
+# and sockets, updated with each device result received, over the 'YIELD_WINDOWS' windows and
+# since the start of the job. Results are added and statistics read in constant time
+class YieldAggregator:
+    def __init__(self):
+        self.counters = {}
+        self.linked_keys = {}
+        self.lock = threading.Lock()
+
+    # Add a device result to the counters of the given keys, e.g. ("handler", "dell004")
+    def add(self, keys, passed, now=None):
+        if now == None:
+            now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                counters = self.counters.get(key)
+                if counters == None:
+                    counters = {name: RollingCounter(*window) for name, window in YIELD_WINDOWS.items()}
+                    counters["job"] = JobCounter()
+                    self.counters[key] = counters
+                for counter in counters.values():
+                    counter.add(now, passed)
+
+    # Start a new job for the given key, e.g. when a handler starts a new session
+    def reset(self, key):
+        with self.lock:
+            self.counters.pop(key, None)
+
+    # Statistics of a key for each window: passed, failed, yield (%) and UPH
+    def statistics(self, key, now=None):
+        if now == None:
+            now = time.monotonic()
+        result = {}
+        with self.lock:
+            counters = self.counters.get(key)
+            if counters == None:
+                return None
+            for name, counter in counters.items():
+                passed, failed, elapsed = counter.counts(now)
+                total = passed + failed
+                result[name] = {
+                    "passed": passed,
+                    "failed": failed,
+                    "yield": 100.0 * passed / total if total > 0 else None,
+                    "uph": 3600.0 * total / elapsed,
+                }
+        return result
+
+    # Link keys to a handler, e.g. the programmer and socket that programmed a device of the handler
+    def link(self, handler, keys):
+        with self.lock:
+            self.linked_keys.setdefault(handler, set()).update(keys)
+
+    # Keys linked to a handler, sorted so they are always logged in the same order
+    def linked(self, handler):
+        with self.lock:
+            return sorted(self.linked_keys.get(handler, ()))
+
+    # Keys with statistics, optionally only the ones of a kind, e.g. "socket"
+    def keys(self, kind=None):
+        with self.lock:
+            return [key for key in self.counters if kind == None or key[0] == kind]
+
+# Yield statistics of the device results received, updated by on_device_complete() and
+# on_programming_result()
+yield_statistics = YieldAggregator()
+
+# Operations store of all the machines
+operations = OperationsStore()
+
+# Metrics endpoint, set when it is started with the '--metrics-port' argument
+metrics_server = None
+
+# Text of the metrics, with the queue depth and drops of the pipeline workers when they are used
+def render_client_metrics():
+    lines = []
+    if pipeline != None:
+        stats = pipeline.stats()
+        lines += ["# HELP connex_pipeline_queue_depth Messages waiting in the queues of the pipeline workers",
+                  "# TYPE connex_pipeline_queue_depth gauge",
+                  f"connex_pipeline_queue_depth {stats['depth']}",
+                  "# HELP connex_pipeline_dropped_total Messages dropped because a pipeline worker queue was full",
+                  "# TYPE connex_pipeline_dropped_total counter",
+                  f"connex_pipeline_dropped_total {stats['dropped']}"]
+    return render_metrics(lines)
+
+# Topic router used by on_message() to call the handlers of each message
+router = TopicRouter()
+
 # Initialize argument parser
 parser = argparse.ArgumentParser(usage=__doc__)
 
 # Adding optional arguments
 parser.add_argument("-i", "--iphost", help="ConneX MQTT Broker IP address or host name, default = localhost")
 parser.add_argument("-p", "--port", type=int, help="ConneX MQTT Broker port, default = 1883")
+parser.add_argument("-q", "--queue-logging", action="store_true", help="Write the log from a background thread, the message callback only queues the log records")
+parser.add_argument("-r", "--rotate-log", type=int, metavar="MB", help="Start a new log file when it reaches this size in MB, keeping the last 5 log files")
+parser.add_argument("-a", "--archive", metavar="FOLDER", help="Compress and index the rotated log files in this folder, they can be searched with ConneXMqttLogQuery")
+parser.add_argument("-w", "--workers", type=int, help="Process the messages in this number of worker threads instead of the MQTT network thread")
+parser.add_argument("-o", "--overflow", choices=["block", "drop-oldest", "drop-class"], default="block", help="What to do when a worker queue is full, default = block")
+parser.add_argument("-d", "--coalesce", type=int, metavar="MS", help="Suppress repeated status messages and collapse the light tower changes within this window in milliseconds")
+parser.add_argument("-e", "--metrics-port", type=int, metavar="PORT", help="Serve the metrics in Prometheus text format at http://localhost:PORT/metrics")
+parser.add_argument("-c", "--capture", metavar="FOLDER", help="Also save the raw messages to binary capture files in this folder, they can be replayed with ConneXMqttReplay")
+
+# Capture writer, set when the messages are captured to binary files
+capture = None
+
+# Message pipeline, set when the messages are processed in worker threads
+pipeline = None
+
+# Message coalescer, set when repeated status messages are suppressed
+coalescer = None
 
 # Subscribe to specified topic
 def subscribe(client, topic):
@@ -73,6 +677,7 @@ def subscribe(client, topic):
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
+        add_connection_metric('connects')
         logger.info(f"Successfully connected to ConneX MQTT Broker!!!, client_id: {client._client_id.decode()}")
         
         # Subscribing in on_connect() means that if we lose the connection and
@@ -96,10 +701,105 @@ def on_connect(client, userdata, flags, rc):
 
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
+    start = time.perf_counter()
+    if capture != None:
+        capture.write(msg)
+    if coalescer != None:
+        coalescer.submit(msg)
+    else:
+        forward_message(msg)
+    if metrics_server != None:
+        add_message_metrics(msg.topic, len(msg.payload), time.perf_counter() - start)
+
+# Process the message in a pipeline worker or in the MQTT network thread
+def forward_message(msg):
+    if pipeline != None:
+        pipeline.submit(msg)
+    else:
+        process_message(msg)
+
+# Log the message and call its handlers, in the MQTT network thread or in a pipeline worker
+def process_message(msg):
     logger.info(f"{msg.topic} | {msg.payload.decode()}")
+    router.dispatch(msg)
+
+# Example handler for pick operations, the machine name and session ID are taken from the topic
+def on_pick(msg, machine, session):
+    logger.info(f"==========> Pick operation in machine '{machine}', session '{session}'")
+
+# Example handler for programming complete events, the programmer class is taken from the topic
+# and only the result code, adapter serial number and socket index are decoded from the payload
+@payload_fields("PartDetail.Result.Code", "Programmer.Adapter.AdapterSerialNumber", "Programmer.Adapter.SocketIndex")
+def on_programming_complete(msg, values, programmer_class):
+    logger.info(f"==========> Programming complete in a '{programmer_class}' programmer, "
+                f"result code: {values['PartDetail.Result.Code']}, "
+                f"adapter: {values['Programmer.Adapter.AdapterSerialNumber']}, "
+                f"socket: {values['Programmer.Adapter.SocketIndex']}")
+
+# Handler for device complete events, counts the result of each device for the handler and session
+@payload_fields("Status")
+def on_device_complete(msg, values, machine, session):
+    yield_statistics.add((("handler", machine), ("session", session)), values["Status"] == "Pass")
+
+# Handler for programming complete events, counts the result of each device for the programmer
+# and socket, a result code of 0 is a device programmed successfully. The programmer and socket
+# are linked to the handler named in the payload, the topic does not include the handler
+@payload_fields("Programmer.SerialNumber", "Programmer.Adapter.SocketIndex", "PartDetail.Result.Code", "HandlerInfo.Name")
+def on_programming_result(msg, values, programmer_class):
+    programmer = values["Programmer.SerialNumber"]
+    socket = f"{programmer}/{values['Programmer.Adapter.SocketIndex']}"
+    keys = (("programmer", programmer), ("socket", socket))
+    yield_statistics.add(keys, str(values["PartDetail.Result.Code"]) == "0")
+    if values["HandlerInfo.Name"] != None:
+        yield_statistics.link(str(values["HandlerInfo.Name"]).lower(), keys)
+
+# Handler for startup events, a new session starts a new job for the handler
+def on_handler_startup(msg, machine, session):
+    yield_statistics.reset(("handler", machine))
+
+# Handler for system statistics events, the handler publishes them every few seconds,
+# used to log the rolling yield statistics of the handler, its session and the programmers and
+# sockets that programmed its devices, the other handlers log theirs with their own events
+def on_system_statistics(msg, machine, session):
+    for key in [("handler", machine), ("session", session)] + yield_statistics.linked(machine.lower()):
+        statistics = yield_statistics.statistics(key)
+        if statistics == None:
+            continue
+        summary = ", ".join(
+            f"{name}: {s['passed']}/{s['passed'] + s['failed']} passed, yield {s['yield']:.1f}%, UPH {s['uph']:.0f}"
+            if s['yield'] != None else f"{name}: no devices"
+            for name, s in statistics.items())
+        logger.info(f"==========> Yield {key[0]} '{key[1]}': {summary}")
+
+# Handler for pick, place and device complete operations, kept for the socket and pick head analytics
+def on_operation(msg, operation, machine, session):
+    if operation in OPERATION_KINDS:
+        operations.add(operation, machine, session, msg.payload)
+
+# Register the handlers of the messages that need processing besides logging them
+def register_handlers():
+    # Uncomment the example you want to test
+
+    # Handle pick operations of all machines
+    #router.add("ah700/operations/pick/+/+", on_pick, "machine", "session")
+
+    # Handle programming complete events of all programmers
+    #router.add("connex/programmer/+/legacy/programmingcomplete", on_programming_complete, "programmer_class")
+
+    # Keep rolling yield and UPH statistics, logged with each system statistics event
+    #router.add("ah700/operations/devicecomplete/+/+", on_device_complete, "machine", "session")
+    #router.add("connex/programmer/+/legacy/programmingcomplete", on_programming_result, "programmer_class")
+    #router.add("ah700/startup/+/+", on_handler_startup, "machine", "session")
+    #router.add("ah700/systemstatistics/+/+", on_system_statistics, "machine", "session")
+
+    # Keep the operations for the socket dwell time, pick head balance and socket fail rate analytics,
+    # logged when the script ends
+    #router.add("ah700/operations/+/+/+", on_operation, "operation", "machine", "session")
+    return
 
 # The callback for when a disconnect happens.
 def on_disconnect(client, rc, properties):
+    add_connection_metric('disconnects')
     logger.info(f"Disconnected... client: {client._client_id.decode()}, return code: {rc}, properties: {properties}")
 
 # Parse command line arguments
@@ -113,17 +813,35 @@ def parseArguments():
         host = args.iphost
     if args.port:
         port = int(args.port)
-    return (host, port)
+    return (host, port, args)
 
 # main program
 def main():
+    global capture, pipeline, coalescer, metrics_server
     # Get host and port values to use for connecting to ConneX MQTT Broker
-    host, port = parseArguments()
+    host, port, args = parseArguments()
+
+    # Set up the optional logging modes
+    archiver = LogArchiver(args.archive, logger) if args.archive else None
+    if args.rotate_log or archiver != None:
+        rotate_log_file((args.rotate_log or LOG_ARCHIVE_SEGMENT_MB) * 1024 * 1024, archiver)
+    listener = start_queue_logging() if args.queue_logging else None
+    if args.capture:
+        capture = CaptureWriter(args.capture)
+    if args.workers:
+        pipeline = MessagePipeline(process_message, args.workers, args.overflow)
+    if args.coalesce:
+        coalescer = MessageCoalescer(forward_message, args.coalesce / 1000)
     
     # Add log start header, useful when several logs are appended to the same file
     logger.info("----------------------------------------------------------------------")
     logger.info("-------------------------- Starting new log --------------------------")
     logger.info("----------------------------------------------------------------------")
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_port, logger, render_client_metrics)
+
+    # Register the message handlers before any message is received
+    register_handlers()
 
     # Initialize MQTT client, generate random id
     client = mqtt.Client(client_id=f'connex-mqtt-{random.randint(0, 1000)}')
@@ -141,9 +859,41 @@ def main():
         # Other loop*() functions are available that give a threaded interface and a
         # manual interface.
         client.loop_forever()
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         logger.exception("An exception occurred, could not connect to ConneX MQTT Broker...") 
         input("Press any key to continue...")
+    finally:
+        if coalescer != None:
+            coalescer.stop()
+            stats = coalescer.stats()
+            logger.info(f"Messages received: {stats['received']}, repeats suppressed: {stats['duplicates']}, "
+                        f"state changes collapsed: {stats['flips']} into {stats['summaries']}")
+        if pipeline != None:
+            pipeline.stop()
+            stats = pipeline.stats()
+            logger.info(f"Messages processed: {stats['processed']}, dropped: {stats['dropped']}, maximum queue depth: {stats['max_depth']}, "
+                        f"queue wait average: {stats['wait_average'] * 1000:.1f}ms, maximum: {stats['wait_max'] * 1000:.1f}ms")
+        if operations.rejected > 0:
+            logger.info(f"Operations rejected: {operations.rejected}")
+        if operations.size > 0:
+            try:
+                for line in operations.summary_lines():
+                    logger.info(f"==========> {line}")
+            except RuntimeError as e:
+                logger.info(f"Operations stored: {operations.size}, {e}")
+        if capture != None:
+            capture.close()
+            logger.info(f"Messages captured: {capture.records}")
+        # Wait until the rotated log files are archived, before the log records still in
+        # the queue are written, so the archiver messages are also written
+        if archiver != None:
+            archiver.stop()
+        # Write the log records still in the queue
+        if listener != None:
+            listener.stop()
+            print(f"Log records queued: {log_stats['queued']}, written: {log_stats['written']}, dropped: {log_stats['dropped']}")
 
 # Script entry point
 if __name__ == '__main__':
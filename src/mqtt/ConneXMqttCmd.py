@@ -1,7 +1,7 @@
 """
 ConneX MQTT Command sample code.
 
-ConneXMqttCmd [-h] [-i IPHOST] [-p PORT]
+ConneXMqttCmd [-h] [-i IPHOST] [-p PORT] [-q] [-r MB] [-l FILE] [-e PORT] [-m MACHINES]
 
 This script allows the user to connect to a ConneX MQTT Broker and
 issue commands to a machine manager to launch DMS or TaskLink. 
@@ -14,21 +14,32 @@ Press 'd' to publish machine manager command to launch DMS
 Press 't' to publish machine manager command to launch TaskLink
 Press 'p' to publish automated handler 'pause' command
 Press 'a' to publish automated handler 'abort' command
+Press 'l' to log the command latencies
 Press 'q' to exit script
 
+The commands are published to the machines given with '-m', by default
+the automated handler commands are published to all the machines with
+an active session at the same time.
+
 This script requires the following libraries to be installed within 
-the Python environment: `paho.mqtt` and `keyboard`.
+the Python environment: `paho.mqtt` and `keyboard`, and the
+ConneXMqttCommon.py module in the same folder.
 
 Alternatively, we can also press CTRL+C to abort the execution.
 """
 
 import paho.mqtt.client as mqtt
+import bisect
+import csv
+import json
 import logging
+import threading
 import argparse
 import datetime as dt
 import random
 import time
 import keyboard
+from ConneXMqttCommon import TopicRouter, add_connection_metric, add_message_metrics, log_stats, rotating_log_handler, start_log_listener, start_metrics_server
 
 # Helper class to use microseconds in logger timestamps
 class uSecsFormatter(logging.Formatter):
@@ -64,16 +75,211 @@ logger.addHandler(f_handler)
 # Set logger threshold level
 logger.setLevel(logging.INFO)
 
+# Replace the log file handler by a rotating one, starting a new file when it reaches 'max_bytes'
+def rotate_log_file(max_bytes):
+    global f_handler
+    f_handler = rotating_log_handler(logger, f_handler, max_bytes)
+
+# Send the log records through a queue, so logging a message only puts it in the queue and
+# the console and log file are written by a background thread. Returns the started listener.
+def start_queue_logging():
+    return start_log_listener(logger, [c_handler, f_handler])
+
+# Seconds without messages from a handler session after which the session is considered ended,
+# in case its 'shutdown' message was missed
+SESSION_IDLE_TIMEOUT = 600
+
+# Seconds to wait for the broker to acknowledge the commands published together
+COMMAND_ACK_TIMEOUT = 5
+
+# Helper class to keep the active session of each automated handler, by machine name. A session
+# starts with the 'startup' message of the handler and ends with its 'shutdown' message, or
+# when no message is received from it for SESSION_IDLE_TIMEOUT seconds.
+class SessionRegistry:
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def start(self, handler_type, machine, session):
+        with self.lock:
+            self.sessions[machine] = {'handler_type': handler_type, 'session': session, 'last_seen': time.monotonic()}
+
+    # End the session of the machine, unless a newer session was already started
+    def end(self, machine, session):
+        with self.lock:
+            entry = self.sessions.get(machine)
+            if entry != None and entry['session'] == session:
+                del self.sessions[machine]
+
+    # Note a message from the session, so it does not expire while the handler is running
+    def touch(self, machine, session):
+        with self.lock:
+            entry = self.sessions.get(machine)
+            if entry != None and entry['session'] == session:
+                entry['last_seen'] = time.monotonic()
+
+    # Active sessions by machine name, as (handler_type, session), removing the expired ones
+    def active(self):
+        now = time.monotonic()
+        with self.lock:
+            for machine in [machine for machine, entry in self.sessions.items() if now - entry['last_seen'] > self.idle_timeout]:
+                del self.sessions[machine]
+            return {machine: (entry['handler_type'], entry['session']) for machine, entry in self.sessions.items()}
+
+# Seconds to wait for the automated handler to change its state after a command, the
+# commands without a state change after this time are counted as timeouts
+COMMAND_LATENCY_TIMEOUT = 30
+
+# Upper bounds in milliseconds of the command latency histogram buckets, the last bucket
+# has the latencies above the last bound
+COMMAND_LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# 'RunState' values of the automated handler 'systemstatus' messages. An aborted job is reported
+# as paused while the handler finishes the devices in process, and as idle when the job ends
+RUN_STATE_IDLE = 0
+RUN_STATE_RUNNING = 1
+RUN_STATE_PAUSED = 2
+
+# RunStates reached by the automated handler after each command, the commands not listed here
+# are completed by any change of the RunState
+COMMAND_RUN_STATES = {"pausejob": (RUN_STATE_PAUSED,), "abortjob": (RUN_STATE_PAUSED, RUN_STATE_IDLE)}
+
+# Helper class to measure the time from publishing a command to an automated handler until the
+# handler responds to it ('response', the 'commandresponse' message) and until its state changes
+# ('state', the first 'systemstatus' message of the same machine and session with a RunState of
+# COMMAND_RUN_STATES different from the RunState when the command was sent). The latencies are
+# kept in histograms by command, machine and stage.
+class CommandLatencyTracker:
+    def __init__(self, timeout=COMMAND_LATENCY_TIMEOUT):
+        self.timeout = timeout
+        self.pending = {}
+        self.run_states = {}
+        self.histograms = {}
+        self.timeouts = {}
+        self.lock = threading.Lock()
+
+    # Stamp a command published to the session of a machine, with the last RunState of the machine
+    def sent(self, command, machine, session):
+        with self.lock:
+            self.expire(time.monotonic())
+            self.pending.setdefault((machine, session), []).append({'command': command, 'sent': time.monotonic(), 'responded': False, 'changed': False,
+                                                                    'run_state': self.run_states.get((machine, session))})
+
+    # The handler responded to a command
+    def response(self, command, machine, session):
+        now = time.monotonic()
+        with self.lock:
+            for entry in self.pending.get((machine, session), []):
+                if entry['command'] == command and not entry['responded']:
+                    entry['responded'] = True
+                    latency = self.add(command, machine, "response", now - entry['sent'])
+                    logger.info(f"==========> Command '{command}' to '{machine}' response time: {latency:.1f}ms")
+                    break
+            self.remove_completed(machine, session)
+
+    # The handler reported its RunState, it completes the commands waiting for it when it is
+    # one of the RunStates of the command and different from the RunState when it was sent
+    def state_changed(self, machine, session, run_state):
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            self.run_states[(machine, session)] = run_state
+            for entry in self.pending.get((machine, session), []):
+                expected = COMMAND_RUN_STATES.get(entry['command'], (run_state,))
+                if not entry['changed'] and run_state != entry['run_state'] and run_state in expected:
+                    entry['changed'] = True
+                    latency = self.add(entry['command'], machine, "state", now - entry['sent'])
+                    logger.info(f"==========> Command '{entry['command']}' to '{machine}' state change time: {latency:.1f}ms")
+            self.remove_completed(machine, session)
+
+    # Stop waiting for the commands with both the response and the state change
+    def remove_completed(self, machine, session):
+        waiting = [entry for entry in self.pending.get((machine, session), []) if not (entry['responded'] and entry['changed'])]
+        if waiting:
+            self.pending[(machine, session)] = waiting
+        else:
+            self.pending.pop((machine, session), None)
+
+    # Stop waiting for the commands sent more than 'timeout' seconds ago, the ones without
+    # a state change are counted as timeouts
+    def expire(self, now):
+        for key in list(self.pending):
+            waiting = []
+            for entry in self.pending[key]:
+                if now - entry['sent'] <= self.timeout:
+                    waiting.append(entry)
+                elif not entry['changed']:
+                    timeout_key = (entry['command'], key[0])
+                    self.timeouts[timeout_key] = self.timeouts.get(timeout_key, 0) + 1
+                    logger.info(f"==========> Command '{entry['command']}' to '{key[0]}' timed out, no state change after {self.timeout}s")
+            if waiting:
+                self.pending[key] = waiting
+            else:
+                del self.pending[key]
+
+    # Add a latency in seconds to its histogram, returns it in milliseconds
+    def add(self, command, machine, stage, latency):
+        milliseconds = latency * 1000
+        histogram = self.histograms.get((command, machine, stage))
+        if histogram == None:
+            histogram = {'buckets': [0] * (len(COMMAND_LATENCY_BUCKETS) + 1), 'count': 0, 'total': 0.0, 'max': 0.0}
+            self.histograms[(command, machine, stage)] = histogram
+        histogram['buckets'][bisect.bisect_left(COMMAND_LATENCY_BUCKETS, milliseconds)] += 1
+        histogram['count'] = histogram['count'] + 1
+        histogram['total'] = histogram['total'] + milliseconds
+        histogram['max'] = max(histogram['max'], milliseconds)
+        return milliseconds
+
+    # Rows with the histograms, by command, machine and stage, with the timeouts of the command
+    def rows(self):
+        with self.lock:
+            self.expire(time.monotonic())
+            keys = sorted(set(self.histograms) | {(command, machine, "state") for command, machine in self.timeouts})
+            rows = []
+            for command, machine, stage in keys:
+                histogram = self.histograms.get((command, machine, stage), {'buckets': [0] * (len(COMMAND_LATENCY_BUCKETS) + 1), 'count': 0, 'total': 0.0, 'max': 0.0})
+                timeouts = self.timeouts.get((command, machine), 0) if stage == "state" else 0
+                average = histogram['total'] / histogram['count'] if histogram['count'] > 0 else 0.0
+                rows.append([command, machine, stage, histogram['count'], timeouts, round(average, 1), round(histogram['max'], 1)] + histogram['buckets'])
+            return rows
+
+    # Log a summary of the latencies
+    def log_summary(self):
+        for command, machine, stage, count, timeouts, average, maximum, *_ in self.rows():
+            logger.info(f"==========> Command '{command}' to '{machine}' {stage} time, count: {count}, average: {average}ms, maximum: {maximum}ms, timeouts: {timeouts}")
+
+    # Write the histograms to a CSV file
+    def export(self, file_name):
+        with open(file_name, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["command", "machine", "stage", "count", "timeouts", "average_ms", "max_ms"] +
+                            [f"le_{bound}ms" for bound in COMMAND_LATENCY_BUCKETS] + [f"gt_{COMMAND_LATENCY_BUCKETS[-1]}ms"])
+            writer.writerows(self.rows())
+
+# Metrics endpoint, set when it is started with the '--metrics-port' argument
+metrics_server = None
+
+# Topic router used by on_message() to call the handlers of each message
+router = TopicRouter()
+
 # Initialize argument parser
 parser = argparse.ArgumentParser(usage=__doc__)
 
 # Adding optional arguments
 parser.add_argument("-i", "--iphost", help="ConneX MQTT Broker IP address or host name, default = localhost")
 parser.add_argument("-p", "--port", type=int, help="ConneX MQTT Broker port, default = 1883")
+parser.add_argument("-q", "--queue-logging", action="store_true", help="Write the log from a background thread, the message callback only queues the log records")
+parser.add_argument("-r", "--rotate-log", type=int, metavar="MB", help="Start a new log file when it reaches this size in MB, keeping the last 5 log files")
+parser.add_argument("-l", "--latency-file", metavar="FILE", help="CSV file where the command latency histograms are written when the script ends")
+parser.add_argument("-e", "--metrics-port", type=int, metavar="PORT", help="Serve the metrics in Prometheus text format at http://localhost:PORT/metrics")
+parser.add_argument("-m", "--machines", help="Comma separated names of the machines the commands are published to, default = dell004 for machine manager commands and all the machines with an active session for automated handler commands")
 
 # Initialize auxiliary global variables
 connected = False
-sessionid = "Undefined"
+sessions = SessionRegistry()
+latencies = CommandLatencyTracker()
+machines = None
 keep_running = True
 
 # Subscribe to specified topic
@@ -89,6 +295,7 @@ def subscribe(client, topic):
 def on_connect(client, userdata, flags, rc):
     global connected
     if rc == 0:
+        add_connection_metric('connects')
         logger.info(f"Successfully connected to ConneX MQTT Broker!!!, client_id: {client._client_id.decode()}")
         
         # Subscribing in on_connect() means that if we lose the connection and
@@ -103,16 +310,51 @@ def on_connect(client, userdata, flags, rc):
 
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
-    global sessionid
+    start = time.perf_counter()
     logger.info(f"{msg.topic} | {msg.payload.decode()}")
-    # When the topic contains 'startup', update sessionid
-    if "startup" in msg.topic:
-        sessionid = msg.topic.split("/")[3]
-        logger.info(f"==========> Updated sessionid: {sessionid}")
-        
+    router.dispatch(msg)
+    if metrics_server != None:
+        add_message_metrics(msg.topic, len(msg.payload), time.perf_counter() - start)
+
+# The handler for 'startup' messages, register the session of the machine
+def on_startup(msg, handler_type, machine, session):
+    sessions.start(handler_type, machine, session)
+    logger.info(f"==========> Started session of '{machine}': {session}")
+
+# The handler for 'shutdown' messages, remove the session of the machine
+def on_shutdown(msg, handler_type, machine, session):
+    sessions.end(machine, session)
+    logger.info(f"==========> Ended session of '{machine}': {session}")
+
+# The handler for 'systemstatistics' messages, published every few seconds while the session is active
+def on_session_activity(msg, handler_type, machine, session):
+    sessions.touch(machine, session)
+
+# The handler for 'commandresponse' messages, the response of the handler to a command. A payload
+# that is not a JSON object is logged and ignored, an exception would stop the MQTT network thread
+def on_command_response(msg, handler_type, machine, session):
+    try:
+        payload = json.loads(msg.payload)
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        logger.info(f"==========> Invalid command response from '{machine}', session '{session}'")
+        return
+    latencies.response(payload.get("CommandTopic"), machine, session)
+
+# The handler for 'systemstatus' messages, the handler reports its RunState, the messages
+# without a RunState are ignored
+def on_state_change(msg, handler_type, machine, session):
+    try:
+        payload = json.loads(msg.payload)
+    except ValueError:
+        return
+    if isinstance(payload, dict) and payload.get("RunState") != None:
+        latencies.state_changed(machine, session, payload["RunState"])
 
 # The callback for when a disconnect happens.
 def on_disconnect(client, rc, properties):
+    add_connection_metric('disconnects')
     logger.info(f"Disconnected... client: {client._client_id.decode()}, return code: {rc}, properties: {properties}")
     
 # Parse command line arguments
@@ -126,29 +368,44 @@ def parseArguments():
         host = args.iphost
     if args.port:
         port = int(args.port)
-    return (host, port)
+    return (host, port, args)
+
+# Publish the same command to several topics at once with QoS 1, then wait until the broker
+# acknowledges all of them, returns the topics not acknowledged
+def publish(client, topics, payload, timeout=COMMAND_ACK_TIMEOUT):
+    start = time.monotonic()
+    results = [(topic, client.publish(topic, payload, qos=1)) for topic in topics]
+    failed = []
+    for topic, result in results:
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            result.wait_for_publish(max(0.0, timeout - (time.monotonic() - start)))
+        if result.rc == mqtt.MQTT_ERR_SUCCESS and result.is_published():
+            logger.info(f"Published topic '{topic}' with payload '{payload}'")
+        else:
+            logger.info(f"Failed to publish topic '{topic}'")
+            failed.append(topic)
+    logger.info(f"Commands published: {len(topics)}, acknowledged: {len(topics) - len(failed)}, time: {(time.monotonic() - start) * 1000:.1f}ms")
+    return failed
 
-# Publish command to MQTT broker
-def publish(client, topic, payload):
-    result = client.publish(topic, payload)
-    if result.rc == 0:
-        logger.info(f"Published topic '{topic}' with payload '{payload}'")
-    else:
-        logger.info(f"Failed to publish topic '{topic}'")
-        
 # The callback for when the user presses a key to send command to machine manager
-def on_machine_manager_command(client, topic, payload):    
+def on_machine_manager_command(client, application, command, payload):    
     logger.info(f"==========> User requested to publish machine manager command!")
-    publish(client, topic, payload)
+    publish(client, [f"command/{application}/{command}/{machine}" for machine in (machines or ["dell004"])], payload)
 
 # The callback for when the user presses a key to send command to automated handler
-def on_handler_command(client, topic, payload):
-    global sessionid
-    if sessionid == "Undefined":
-        logger.info(f"==========> Unable to publish automated handler command!, sessionid is not defined yet.")
+def on_handler_command(client, command, payload):
+    active = sessions.active()
+    targets = [machine for machine in (machines or active) if machine in active]
+    for machine in machines or []:
+        if machine not in active:
+            logger.info(f"==========> Unable to publish automated handler command to '{machine}'!, it has no active session.")
+    if not targets:
+        logger.info(f"==========> Unable to publish automated handler command!, no machine with an active session.")
     else:
         logger.info(f"==========> User requested to publish automated handler command!")
-        publish(client, f"{topic}/{sessionid}", payload)
+        for machine in targets:
+            latencies.sent(command, machine, active[machine][1])
+        publish(client, [f"command/{active[machine][0]}/{command}/{machine}/{active[machine][1]}" for machine in targets], payload)
 
 # The callback for when the user presses 'q' to stop the script
 def on_quit():
@@ -160,13 +417,31 @@ def on_quit():
 def main():
     global connected
     global keep_running
+    global machines
+    global metrics_server
     # Get host and port values to use for connecting to ConneX MQTT Broker
-    host, port = parseArguments()
+    host, port, args = parseArguments()
+
+    # Set up the optional logging modes
+    if args.rotate_log:
+        rotate_log_file(args.rotate_log * 1024 * 1024)
+    listener = start_queue_logging() if args.queue_logging else None
+    if args.machines:
+        machines = [machine.strip() for machine in args.machines.split(",")]
 
     # Add log start header, useful when several logs are appended to the same file
     logger.info("----------------------------------------------------------------------")
     logger.info("-------------------------- Starting new log --------------------------")
     logger.info("----------------------------------------------------------------------")
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_port, logger)
+
+    # Register the message handlers, the machine name and session ID are the 3rd and 4th levels of the topics
+    router.add("+/startup/+/+", on_startup, "handler_type", "machine", "session")
+    router.add("+/shutdown/+/+", on_shutdown, "handler_type", "machine", "session")
+    router.add("+/systemstatistics/+/+", on_session_activity, "handler_type", "machine", "session")
+    router.add("+/commandresponse/+/+", on_command_response, "handler_type", "machine", "session")
+    router.add("+/systemstatus/+/+", on_state_change, "handler_type", "machine", "session")
 
     # Initialize MQTT client, generate random id
     client = mqtt.Client(client_id=f'connex-mqtt-{random.randint(0, 1000)}')
@@ -176,15 +451,18 @@ def main():
 
     # Define shortcut keys to process machine manager commands
     keyboard.add_hotkey('d', on_machine_manager_command, 
-                        args=[client, "command/dms/launchdms/dell004", 
+                        args=[client, "dms", "launchdms", 
                               "{\"JobName\":\"Verify Memory (2GB)\",\"Quantity\":10}"])
     keyboard.add_hotkey('t', on_machine_manager_command, 
-                        args=[client, "command/tasklink/launchtasklink/dell004", 
+                        args=[client, "tasklink", "launchtasklink", 
                               "{\"TaskName\":\"TEST\",\"AdministratorMode\":true,\"BatchMode\":true,\"Quantity\":10}"])
 
     # Define shortcut keys to process automated handler commands
-    keyboard.add_hotkey('p', on_handler_command, args=[client, "command/ah700/pausejob/dell004", "{}"])
-    keyboard.add_hotkey('a', on_handler_command, args=[client, "command/ah700/abortjob/dell004", "{}"])
+    keyboard.add_hotkey('p', on_handler_command, args=[client, "pausejob", "{}"])
+    keyboard.add_hotkey('a', on_handler_command, args=[client, "abortjob", "{}"])
+
+    # Define shortcut key to log the command latencies
+    keyboard.add_hotkey('l', latencies.log_summary)
 
     # Define shortcut key to stop script
     keyboard.add_hotkey('q', on_quit)
@@ -208,6 +486,7 @@ def main():
         # User can press 't' to publish machine manager command to launch TaskLink
         # User can press 'p' to publish automated handler 'pause' command
         # User can press 'a' to publish automated handler 'abort' command
+        # User can press 'l' to log the command latencies
         while keep_running:
             time.sleep(1)
 
@@ -216,6 +495,15 @@ def main():
     except Exception as e:
         logger.exception("An exception occurred, could not connect to ConneX MQTT Broker...") 
         input("Press any key to continue...")
+    finally:
+        latencies.log_summary()
+        if args.latency_file:
+            latencies.export(args.latency_file)
+            logger.info(f"Command latencies written to '{args.latency_file}'")
+        # Write the log records still in the queue
+        if listener != None:
+            listener.stop()
+            print(f"Log records queued: {log_stats['queued']}, written: {log_stats['written']}, dropped: {log_stats['dropped']}")
 
 # Script entry point
 if __name__ == '__main__':
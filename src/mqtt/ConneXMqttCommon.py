@@ -0,0 +1,623 @@
+"""
+ConneX MQTT common helpers.
+
+This module holds the helpers shared by the ConneX MQTT sample scripts,
+it is not a script to run. Importing it does not set up any logging or
+create any file, so a script can use the helpers without the side effects
+of importing ConneXMqttClient, which creates the 'ConneXMqttClient.log'
+file.
+
+The capture file format constants are used by the capture writer of
+ConneXMqttClient and the capture reader of ConneXMqttReplay. The topic
+router sends each message to the handlers of the topic filters it
+matches. The metrics helpers keep the message and connection metrics
+and serve them in Prometheus text format. The queue logging helpers write
+the log records of ConneXMqttClient and ConneXMqttCmd in a background
+thread, the log archive helpers compress and index the log files of
+ConneXMqttClient, and are used by ConneXMqttLogQuery to archive existing
+log files. The operations store keeps the pick, place and device complete
+operations of the handlers for the analytics of ConneXMqttClient and
+ConneXMqttOperations, which require `numpy`.
+"""
+
+import array
+import bisect
+import datetime as dt
+import http.server
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+# The operations analytics are only available when 'numpy' is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Capture files of ConneXMqttClient, read by ConneXMqttReplay, start with this marker, followed by the message records. Each record is a
+# header (receive time in seconds since epoch, topic length, QoS and retain flags, payload
+# length) followed by the topic and the raw payload bytes.
+CAPTURE_MAGIC = b"CNXCAP1\n"
+CAPTURE_RECORD_HEADER = struct.Struct("<dHBI")
+CAPTURE_RETAIN_FLAG = 0x04
+
+# Maximum number of topics whose matching handlers are remembered by the topic router
+ROUTE_CACHE_SIZE = 4096
+
+# Helper class for one level of the topic router tree
+class TopicNode:
+    __slots__ = ("children", "plus", "hash_handlers", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        self.plus = None
+        self.hash_handlers = []
+        self.handlers = []
+
+# Helper class to send each message to the handlers registered for the topic filters it matches.
+# The topic filters are stored in a tree with one level per topic level, so finding the handlers 
+# of a topic only depends on the number of levels of the topic, not on the number of handlers.
+class TopicRouter:
+    def __init__(self):
+        self.root = TopicNode()
+        self.cache = {}
+
+    # Register a handler for a MQTT topic filter, e.g. "ah700/operations/pick/+/+". The handler is 
+    # called as handler(msg, **fields), where the fields are the topic levels matched by each '+'
+    # wildcard, named by 'names' in the same order, e.g. ("machine", "session").
+    def add(self, topic_filter, handler, *names):
+        node = self.root
+        levels = topic_filter.split("/")
+        for index, level in enumerate(levels):
+            if level == "#":
+                if index != len(levels) - 1:
+                    raise ValueError(f"Invalid topic filter '{topic_filter}', '#' must be the last level")
+                node.hash_handlers.append((handler, names))
+                self.cache.clear()
+                return
+            if level == "+":
+                if node.plus == None:
+                    node.plus = TopicNode()
+                node = node.plus
+            else:
+                node = node.children.setdefault(level, TopicNode())
+        node.handlers.append((handler, names))
+        self.cache.clear()
+
+    # Find the handlers for a topic, with the topic levels matched by the '+' wildcards
+    def match(self, topic):
+        routes = self.cache.get(topic)
+        if routes != None:
+            return routes
+        routes = []
+        levels = topic.split("/")
+        # Nodes reached so far, with the topic levels matched by '+' on the way to them
+        nodes = [(self.root, ())]
+        for level in levels:
+            next_nodes = []
+            for node, values in nodes:
+                for handler, names in node.hash_handlers:
+                    routes.append((handler, dict(zip(names, values))))
+                child = node.children.get(level)
+                if child != None:
+                    next_nodes.append((child, values))
+                if node.plus != None:
+                    next_nodes.append((node.plus, values + (level,)))
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node, values in nodes:
+            # '#' also matches the parent level, e.g. "ah700/#" matches "ah700"
+            for handler, names in node.handlers + node.hash_handlers:
+                routes.append((handler, dict(zip(names, values))))
+        if len(self.cache) >= ROUTE_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[topic] = routes
+        return routes
+
+    # Call the handlers registered for the topic of the message
+    def dispatch(self, msg):
+        for handler, fields in self.match(msg.topic):
+            handler(msg, **fields)
+
+# Address the metrics endpoint listens on, only this computer by default, use "0.0.0.0"
+# to allow a Prometheus server in another computer to read the metrics
+METRICS_HOST = "127.0.0.1"
+
+# Upper bounds in seconds of the on_message time histogram buckets
+METRICS_LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0]
+
+# Number of topic levels of the topic class the message metrics are kept by, e.g. 'ah700/operations/pick'
+METRICS_TOPIC_LEVELS = 3
+
+# Message metrics by topic class: messages and bytes received, and histogram of the on_message time
+message_metrics = {}
+
+# Message metrics of the last topics received, so the topic class is only found for new topics
+metrics_by_topic = {}
+
+# Connection metrics: connections to the broker and disconnections
+connection_metrics = {'connects': 0, 'disconnects': 0}
+metrics_lock = threading.Lock()
+
+# Add a message received and the time spent in on_message to the metrics of its topic class
+def add_message_metrics(topic, size, elapsed):
+    with metrics_lock:
+        metrics = metrics_by_topic.get(topic)
+        if metrics == None:
+            topic_class = "/".join(topic.split("/", METRICS_TOPIC_LEVELS)[:METRICS_TOPIC_LEVELS])
+            metrics = message_metrics.get(topic_class)
+            if metrics == None:
+                metrics = {'messages': 0, 'bytes': 0, 'seconds': 0.0, 'buckets': [0] * (len(METRICS_LATENCY_BUCKETS) + 1)}
+                message_metrics[topic_class] = metrics
+            if len(metrics_by_topic) >= ROUTE_CACHE_SIZE:
+                metrics_by_topic.clear()
+            metrics_by_topic[topic] = metrics
+        metrics['messages'] = metrics['messages'] + 1
+        metrics['bytes'] = metrics['bytes'] + size
+        metrics['seconds'] = metrics['seconds'] + elapsed
+        metrics['buckets'][bisect.bisect_left(METRICS_LATENCY_BUCKETS, elapsed)] += 1
+
+# Count a connection or disconnection in the connection metrics
+def add_connection_metric(name):
+    with metrics_lock:
+        connection_metrics[name] = connection_metrics[name] + 1
+
+# Escape a label value of the Prometheus text format
+def metric_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Lines of a histogram in Prometheus text format, the bucket counts are cumulative
+def histogram_lines(name, labels, buckets, total):
+    lines = []
+    count = 0
+    for bound, bucket in zip(METRICS_LATENCY_BUCKETS + ["+Inf"], buckets):
+        count = count + bucket
+        lines.append(f"{name}_bucket{{{labels},le=\"{bound}\"}} {count}")
+    lines.append(f"{name}_sum{{{labels}}} {total}")
+    lines.append(f"{name}_count{{{labels}}} {count}")
+    return lines
+
+# Text of the metrics in Prometheus text format, the rates (e.g. messages per second) are
+# calculated by Prometheus from the totals, the extra lines are added at the end
+def render_metrics(extra_lines=()):
+    with metrics_lock:
+        messages = [(topic_class, dict(metrics, buckets=list(metrics['buckets']))) for topic_class, metrics in sorted(message_metrics.items())]
+        connections = dict(connection_metrics)
+    lines = ["# HELP connex_mqtt_messages_total Messages received, by topic class",
+             "# TYPE connex_mqtt_messages_total counter"]
+    lines += [f"connex_mqtt_messages_total{{topic_class=\"{metric_label(topic_class)}\"}} {metrics['messages']}" for topic_class, metrics in messages]
+    lines += ["# HELP connex_mqtt_bytes_total Payload bytes received, by topic class",
+              "# TYPE connex_mqtt_bytes_total counter"]
+    lines += [f"connex_mqtt_bytes_total{{topic_class=\"{metric_label(topic_class)}\"}} {metrics['bytes']}" for topic_class, metrics in messages]
+    lines += ["# HELP connex_mqtt_on_message_seconds Time spent in the on_message callback, by topic class",
+              "# TYPE connex_mqtt_on_message_seconds histogram"]
+    for topic_class, metrics in messages:
+        lines += histogram_lines("connex_mqtt_on_message_seconds", f"topic_class=\"{metric_label(topic_class)}\"", metrics['buckets'], metrics['seconds'])
+    lines += ["# HELP connex_mqtt_connects_total Successful connections to the ConneX MQTT Broker",
+              "# TYPE connex_mqtt_connects_total counter",
+              f"connex_mqtt_connects_total {connections['connects']}",
+              "# HELP connex_mqtt_disconnects_total Disconnections from the ConneX MQTT Broker",
+              "# TYPE connex_mqtt_disconnects_total counter",
+              f"connex_mqtt_disconnects_total {connections['disconnects']}",
+              "# HELP connex_log_records_dropped_total Log records dropped because the log queue was full",
+              "# TYPE connex_log_records_dropped_total counter",
+              f"connex_log_records_dropped_total {log_stats['dropped']}"]
+    lines += extra_lines
+    return "\n".join(lines) + "\n"
+
+# Helper class to answer the requests to the metrics endpoint, 'GET /metrics'
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The requests are not logged
+    def log_message(self, format, *args):
+        pass
+
+# Start the metrics endpoint in a background thread, returns the HTTP server. The text of the
+# metrics is returned by the render function, e.g. to add the metrics of a script
+def start_metrics_server(port, logger, render=render_metrics, host=METRICS_HOST):
+    server = http.server.HTTPServer((host, port), MetricsRequestHandler)
+    server.render = render
+    threading.Thread(target=server.serve_forever, name="ConneXMetrics", daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{server.server_port}/metrics")
+    return server
+
+# Maximum number of log records waiting to be written when queue logging is enabled,
+# records logged while the queue is full are dropped and counted
+LOG_QUEUE_SIZE = 10000
+
+# Maximum number of log records written together by the queue logging listener
+LOG_BATCH_SIZE = 500
+
+# Number of old log files kept when the log file is rotated
+LOG_BACKUP_COUNT = 5
+
+# Queue logging counters: records queued, written and dropped because the queue was full. They are
+# updated from the threads logging the messages and the listener thread
+log_stats = {'queued': 0, 'written': 0, 'dropped': 0}
+log_stats_lock = threading.Lock()
+
+# Helper class to put log records in the queue without waiting, counting the records
+# dropped when the queue is full
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The record is formatted later by the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            counter = 'queued'
+        except queue.Full:
+            counter = 'dropped'
+        with log_stats_lock:
+            log_stats[counter] = log_stats[counter] + 1
+
+# Helper class to format and write the queued log records in a background thread,
+# writing all the records waiting in the queue together and flushing once per batch.
+# The warnings about dropped records are written as records of 'logger'
+class BatchLogListener(threading.Thread):
+    def __init__(self, log_queue, handlers, logger):
+        super().__init__(name="log-listener", daemon=True)
+        self.log_queue = log_queue
+        self.handlers = handlers
+        self.logger = logger
+
+    def run(self):
+        reported_dropped = 0
+        while True:
+            record = self.log_queue.get()
+            if record == None:
+                break
+            batch = [record]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    record = self.log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record == None:
+                    self.log_queue.put(None)
+                    break
+                batch.append(record)
+            # Report the records dropped since the last batch
+            with log_stats_lock:
+                dropped = log_stats['dropped']
+            if dropped != reported_dropped:
+                batch.append(self.logger.makeRecord(self.logger.name, logging.WARNING, __file__, 0, 
+                    f"{dropped - reported_dropped} log records dropped, log queue full", None, None))
+                reported_dropped = dropped
+            self.write_batch(batch)
+            with log_stats_lock:
+                log_stats['written'] = log_stats['written'] + len(batch)
+
+    def write_batch(self, batch):
+        for handler in self.handlers:
+            handler.acquire()
+            try:
+                for record in batch:
+                    if record.levelno < handler.level:
+                        continue
+                    if isinstance(handler, logging.handlers.RotatingFileHandler) and handler.shouldRollover(record):
+                        handler.doRollover()
+                    handler.stream.write(handler.format(record) + handler.terminator)
+                handler.flush()
+            except Exception:
+                handler.handleError(batch[-1])
+            finally:
+                handler.release()
+
+    # Write the records still in the queue and stop the listener
+    def stop(self):
+        self.log_queue.put(None)
+        self.join()
+
+# Replace the file handler of 'logger' by a rotating one with the same file, level and format,
+# starting a new file when it reaches 'max_bytes'. The old log files are passed to 'rotator'
+# when given, instead of keeping the last LOG_BACKUP_COUNT ones. Returns the new handler
+def rotating_log_handler(logger, handler, max_bytes, rotator=None):
+    logger.removeHandler(handler)
+    handler.close()
+    rotating = logging.handlers.RotatingFileHandler(handler.baseFilename, maxBytes=max_bytes, backupCount=LOG_BACKUP_COUNT)
+    if rotator != None:
+        rotating.rotator = rotator
+    rotating.setLevel(handler.level)
+    rotating.setFormatter(handler.formatter)
+    logger.addHandler(rotating)
+    return rotating
+
+# Send the log records of 'logger' through a queue, so logging a message only puts it in the
+# queue and 'handlers' are written by a background thread. Returns the started listener
+def start_log_listener(logger, handlers):
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = BatchLogListener(log_queue, handlers, logger)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    listener.start()
+    return listener
+
+# Size in MB of the log files archived with the '--archive' argument, when '--rotate-log' is not given
+LOG_ARCHIVE_SEGMENT_MB = 64
+
+# Size in bytes of the log text compressed in each block of an archived log file, only the
+# blocks matching a query are decompressed by ConneXMqttLogQuery
+LOG_ARCHIVE_BLOCK_SIZE = 256 * 1024
+
+# Number of topic levels kept in the index of an archived log file, e.g. 'ah700/operations/pick'
+LOG_ARCHIVE_TOPIC_LEVELS = 3
+
+# The session ID of the automated handler topics, e.g. 'db332112966446dbb7ae521d856fe59c'
+log_session_pattern = re.compile(r"[0-9a-f]{32}")
+
+# Compress a log file to 'target' in independent blocks, and write the index of the blocks to
+# 'target' + '.idx': for each block its offset and length in the compressed file, the time of
+# its first and last records, and the topic prefixes and session IDs of its messages
+def archive_log_file(source, target):
+    blocks = []
+    with open(source, "rb") as f, open(target + ".tmp", "wb") as out:
+        block = []
+        block_size = 0
+        for line in f:
+            # A log record can have several lines, e.g. an exception, the block ends only before a new record
+            if block_size >= LOG_ARCHIVE_BLOCK_SIZE and line.startswith(b"["):
+                blocks.append(write_log_block(out, block))
+                block = []
+                block_size = 0
+            block.append(line)
+            block_size = block_size + len(line)
+        if block:
+            blocks.append(write_log_block(out, block))
+    os.replace(target + ".tmp", target)
+    # The index is written last, a log file without index is not queried
+    with open(target + ".idx", "w") as f:
+        json.dump({'source': os.path.basename(source), 'blocks': blocks}, f)
+    return blocks
+
+# Compress a block of log lines, returns its index entry
+def write_log_block(out, lines):
+    entry = {'offset': out.tell(), 'first': None, 'last': None, 'records': 0}
+    topics = set()
+    sessions = set()
+    for line in lines:
+        # Log records are '[LEVEL] | time | topic | payload' or '[LEVEL] | time | text'
+        fields = line.decode(errors="replace").split(" | ", 3)
+        if len(fields) < 3 or not fields[0].startswith("["):
+            continue
+        entry['first'] = entry['first'] or fields[1]
+        entry['last'] = fields[1]
+        entry['records'] = entry['records'] + 1
+        if len(fields) == 4:
+            levels = fields[2].split("/")
+            topics.add("/".join(levels[:LOG_ARCHIVE_TOPIC_LEVELS]))
+            sessions.update(level for level in levels if log_session_pattern.fullmatch(level))
+    out.write(zlib.compress(b"".join(lines)))
+    entry['length'] = out.tell() - entry['offset']
+    entry['topics'] = sorted(topics)
+    entry['sessions'] = sorted(sessions)
+    return entry
+
+# Helper class to compress and index the rotated log files in a background thread, used as rotator
+# of the rotating log file handler. The rotated file is only moved to the archive folder when the
+# log handler rotates it, so writing the log is not delayed while the file is compressed. The
+# archived files are reported to 'logger', the logger of the script
+class LogArchiver(threading.Thread):
+    def __init__(self, folder, logger):
+        super().__init__(name="ConneXLogArchiver", daemon=True)
+        self.folder = folder
+        self.logger = logger
+        self.pending = queue.Queue()
+        os.makedirs(folder, exist_ok=True)
+        # Files rotated but not archived when the script was stopped the last time
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(".pending"):
+                self.pending.put(os.path.join(folder, name))
+        self.start()
+
+    # Called by the log handler instead of renaming the log file to a backup file
+    def rotate(self, source, dest):
+        pending = os.path.join(self.folder, dt.datetime.now().strftime("ConneXLog-%Y%m%d-%H%M%S-%f.pending"))
+        shutil.move(source, pending)
+        self.pending.put(pending)
+
+    def run(self):
+        while True:
+            pending = self.pending.get()
+            if pending == None:
+                return
+            try:
+                target = pending[:-len(".pending")] + ".logz"
+                blocks = archive_log_file(pending, target)
+                os.remove(pending)
+                self.logger.info(f"Log file archived to '{target}', blocks: {len(blocks)}")
+            except Exception:
+                self.logger.exception(f"Could not archive log file '{pending}'")
+
+    # Wait until the rotated files are archived. The active log file is not archived, it is
+    # continued by the next run of the script and archived when it is rotated
+    def stop(self):
+        self.pending.put(None)
+        self.join()
+
+# Operations kept by the operations store, the index in this list is stored in the 'kind' column
+OPERATION_KINDS = ["pick", "place", "devicecomplete"]
+
+# Columns of the operations store and the type code of the array used for each one
+OPERATIONS_COLUMNS = {'time': 'd', 'kind': 'B', 'session': 'I', 'device': 'i', 'location': 'I', 'position': 'h', 'head': 'b', 'status': 'b'}
+
+# Value stored in the 'status' column for each operation status, -1 for any other status
+OPERATION_STATUS = {"Pass": 1, "Fail": 0}
+
+# Number of rows added to the operations store columns each time they are full
+OPERATIONS_CHUNK_SIZE = 65536
+
+# Locations starting with this text are programmer sockets, e.g. 'Prog10', the others are trays
+SOCKET_LOCATION_PREFIX = "Prog"
+
+# Helper class to keep the pick, place and device complete operations of the handlers in memory, for the
+# socket and pick head analytics. The operations are stored by column in typed arrays, about 25 bytes per
+# operation, and the repeated texts (machine, session and location) are stored once and referenced by
+# index. The analytics are computed on whole columns with NumPy, without a Python loop per operation.
+# An operation with a payload that can not be stored, e.g. not JSON or a value out of the range of its
+# column, is not added and is counted in 'rejected'
+class OperationsStore:
+    def __init__(self):
+        self.size = 0
+        self.columns = {name: array.array(typecode) for name, typecode in OPERATIONS_COLUMNS.items()}
+        self.machines = []
+        self.machine_index = {}
+        self.sessions = []
+        self.session_index = {}
+        self.session_machines = []
+        self.locations = []
+        self.location_index = {}
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    # Index of a text in a table of unique texts, added the first time
+    def intern(self, table, index, value):
+        position = index.get(value)
+        if position == None:
+            position = len(table)
+            table.append(value)
+            index[value] = position
+        return position
+
+    # Add an operation, 'kind' is one of OPERATION_KINDS and 'payload' the JSON payload of its message.
+    # Returns False when the operation is rejected, it is called from the MQTT callback so it never raises
+    def add(self, kind, machine, session, payload, now=None):
+        try:
+            values = json.loads(payload)
+            device = int(values.get("DeviceID", -1))
+            location = str(values.get("Location", ""))
+            position = int(values.get("Position", -1))
+            head = int(values.get("PickHead", -1))
+            status = OPERATION_STATUS.get(values.get("Status"), -1)
+        except (ValueError, TypeError, AttributeError):
+            with self.lock:
+                self.rejected = self.rejected + 1
+            return False
+        with self.lock:
+            if self.size == len(self.columns['time']):
+                for column in self.columns.values():
+                    column.frombytes(bytes(OPERATIONS_CHUNK_SIZE * column.itemsize))
+            if (machine, session) not in self.session_index:
+                self.session_machines.append(self.intern(self.machines, self.machine_index, machine))
+            # The row is only counted in 'size' when all its columns are set, a value out of
+            # range leaves it to be written again by the next operation
+            row = self.size
+            try:
+                self.columns['time'][row] = time.time() if now == None else now
+                self.columns['kind'][row] = OPERATION_KINDS.index(kind)
+                self.columns['session'][row] = self.intern(self.sessions, self.session_index, (machine, session))
+                self.columns['device'][row] = device
+                self.columns['location'][row] = self.intern(self.locations, self.location_index, location)
+                self.columns['position'][row] = position
+                self.columns['head'][row] = head
+                self.columns['status'][row] = status
+            except OverflowError:
+                self.rejected = self.rejected + 1
+                return False
+            self.size = row + 1
+        return True
+
+    # The used rows of the columns as NumPy arrays, the data is copied so operations can still be
+    # added while the analytics are computed
+    def arrays(self):
+        if numpy == None:
+            raise RuntimeError("the operations analytics require the 'numpy' library")
+        with self.lock:
+            columns = {name: numpy.frombuffer(column[:self.size], dtype=column.typecode) for name, column in self.columns.items()}
+            sockets = numpy.array([location.startswith(SOCKET_LOCATION_PREFIX) for location in self.locations], dtype=bool)
+            session_machines = numpy.array(self.session_machines, dtype=numpy.int64)
+        # A device is identified by its session and device ID, a socket by its location and position
+        columns['device_key'] = (columns['session'].astype(numpy.int64) << 32) | (columns['device'].astype(numpy.int64) & 0xFFFFFFFF)
+        columns['socket'] = (columns['location'].astype(numpy.int64) << 16) | (columns['position'].astype(numpy.int64) & 0xFFFF)
+        columns['in_socket'] = sockets[columns['location']]
+        columns['machine'] = session_machines[columns['session']]
+        return columns
+
+    # Name of a socket from its index in the 'socket' column, e.g. 'Prog10/2'
+    def socket_name(self, socket):
+        return f"{self.locations[socket >> 16]}/{socket & 0xFFFF}"
+
+    # Time between placing a device in a socket and picking it from the same socket, by socket
+    def socket_dwell_times(self, columns=None):
+        c = self.arrays() if columns == None else columns
+        rows = numpy.flatnonzero(c['in_socket'] & (c['kind'] <= 1))
+        rows = rows[numpy.lexsort((c['time'][rows], c['socket'][rows], c['device_key'][rows]))]
+        device, socket, placed, seconds = c['device_key'][rows], c['socket'][rows], c['kind'][rows] == 1, c['time'][rows]
+        # A dwell time is a place followed by a pick of the same device in the same socket
+        dwell = placed[:-1] & ~placed[1:] & (device[:-1] == device[1:]) & (socket[:-1] == socket[1:])
+        times = seconds[1:][dwell] - seconds[:-1][dwell]
+        sockets, inverse = numpy.unique(socket[:-1][dwell], return_inverse=True)
+        counts = numpy.bincount(inverse, minlength=len(sockets))
+        totals = numpy.bincount(inverse, weights=times, minlength=len(sockets))
+        maximums = numpy.zeros(len(sockets))
+        numpy.maximum.at(maximums, inverse, times)
+        return {self.socket_name(int(s)): {'count': int(n), 'average': t / n, 'max': m} for s, n, t, m in zip(sockets, counts, totals, maximums)}
+
+    # Number of picks of each pick head, by machine, with the balance as the picks of the least
+    # used head divided by the picks of the most used one
+    def pick_head_balance(self, columns=None):
+        c = self.arrays() if columns == None else columns
+        picks = c['kind'] == 0
+        codes, counts = numpy.unique((c['machine'][picks] << 8) | (c['head'][picks].astype(numpy.int64) & 0xFF), return_counts=True)
+        balance = {}
+        for code, count in zip(codes, counts):
+            machine = balance.setdefault(self.machines[int(code) >> 8], {'picks': {}})
+            machine['picks'][int(code) & 0xFF] = int(count)
+        for machine in balance.values():
+            machine['balance'] = min(machine['picks'].values()) / max(machine['picks'].values())
+        return balance
+
+    # Devices completed and failed by socket, a device is counted in the last socket it was picked from
+    def socket_fail_rates(self, columns=None):
+        c = self.arrays() if columns == None else columns
+        rows = numpy.flatnonzero(c['in_socket'] & (c['kind'] == 0))
+        rows = rows[numpy.lexsort((c['time'][rows], c['device_key'][rows]))]
+        picked, socket = c['device_key'][rows], c['socket'][rows]
+        completed = (c['kind'] == 2) & (c['status'] >= 0)
+        devices, failed = c['device_key'][completed], c['status'][completed] == 0
+        index = numpy.searchsorted(picked, devices, side="right") - 1
+        found = index >= 0
+        found[found] = picked[index[found]] == devices[found]
+        sockets, inverse = numpy.unique(socket[index[found]], return_inverse=True)
+        counts = numpy.bincount(inverse, minlength=len(sockets))
+        fails = numpy.bincount(inverse, weights=failed[found], minlength=len(sockets))
+        return {self.socket_name(int(s)): {'devices': int(n), 'failed': int(f), 'fail_rate': f * 100.0 / n} for s, n, f in zip(sockets, counts, fails)}
+
+    # Lines with the summary of all the analytics
+    def summary_lines(self):
+        columns = self.arrays()
+        dwell = self.socket_dwell_times(columns)
+        fails = self.socket_fail_rates(columns)
+        lines = []
+        for socket in sorted(set(dwell) | set(fails)):
+            line = f"Socket '{socket}'"
+            if socket in fails:
+                line = line + f", devices: {fails[socket]['devices']}, failed: {fails[socket]['failed']} ({fails[socket]['fail_rate']:.1f}%)"
+            if socket in dwell:
+                line = line + f", dwell time average: {dwell[socket]['average']:.1f}s, maximum: {dwell[socket]['max']:.1f}s"
+            lines.append(line)
+        for machine, heads in sorted(self.pick_head_balance(columns).items()):
+            picks = ", ".join(f"head {head}: {count}" for head, count in sorted(heads['picks'].items()))
+            lines.append(f"Pick heads '{machine}', {picks}, balance: {heads['balance'] * 100:.1f}%")
+        return lines
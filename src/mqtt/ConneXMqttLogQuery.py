@@ -0,0 +1,148 @@
+"""
+ConneX MQTT Log Query sample code.
+
+ConneXMqttLogQuery [-h] [-a FOLDER] {archive,query} ...
+
+ConneXMqttLogQuery archive LOG [LOG ...]
+ConneXMqttLogQuery query [-t TOPIC] [-j SESSION] [-s SINCE] [-e UNTIL] [-l LIMIT]
+
+This script searches the log files archived by ConneXMqttClient with
+the '--archive' argument. The archived log files are compressed in
+blocks, with an index of the time range, topics and sessions of each
+block, so only the blocks that can match the query are decompressed.
+
+The 'archive' command compresses and indexes existing log files, e.g.
+a 'ConneXMqttClient.log' written without '--archive', the log files
+are not changed. The 'query' command prints the log records matching
+the given topic, session and time range.
+
+This script requires the ConneXMqttCommon.py module in the same folder,
+it only uses the Python standard library.
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import sys
+import time
+import zlib
+import ConneXMqttCommon
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding arguments
+parser.add_argument("-a", "--archive", metavar="FOLDER", default="ConneXLogArchive", help="Folder with the archived log files, default = ConneXLogArchive")
+# The 'required' argument of add_subparsers() is not available in Python 3.6
+commands = parser.add_subparsers(dest="command")
+commands.required = True
+archive_parser = commands.add_parser("archive", help="Compress and index existing log files")
+archive_parser.add_argument("logs", nargs="+", metavar="LOG", help="Log files to archive")
+query_parser = commands.add_parser("query", help="Print the archived log records matching the filters")
+query_parser.add_argument("-t", "--topic", help="Only messages with topic starting with this text")
+query_parser.add_argument("-j", "--session", help="Only messages of this automated handler session ID")
+query_parser.add_argument("-s", "--since", help="Only records with time at or after this date and time, e.g. 2023-12-06 16:00")
+query_parser.add_argument("-e", "--until", help="Only records with time before this date and time")
+query_parser.add_argument("-l", "--limit", type=int, help="Maximum number of records to print")
+
+# Compress and index existing log files into the archive folder
+def archive_logs(folder, logs):
+    os.makedirs(folder, exist_ok=True)
+    for log in logs:
+        start = time.perf_counter()
+        target = os.path.join(folder, dt.datetime.now().strftime("ConneXLog-%Y%m%d-%H%M%S-%f.logz"))
+        blocks = ConneXMqttCommon.archive_log_file(log, target)
+        print(f"Archived '{log}' to '{target}', size: {os.path.getsize(log)} -> {os.path.getsize(target)} bytes, "
+              f"blocks: {len(blocks)}, time: {time.perf_counter() - start:.2f}s")
+
+# Read the indexes of the archived log files, as (archived file, blocks), in name order
+def load_indexes(folder):
+    indexes = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(".logz.idx"):
+            with open(os.path.join(folder, name)) as f:
+                indexes.append((os.path.join(folder, name[:-len(".idx")]), json.load(f)['blocks']))
+    return indexes
+
+# Check if a block can have records matching the query, using only its index entry
+def block_matches(block, topic, session, since, until):
+    if block['first'] == None:
+        return False
+    if since != None and block['last'] < since:
+        return False
+    if until != None and block['first'] >= until:
+        return False
+    if session != None and session not in block['sessions']:
+        return False
+    # The index has the first levels of the topics, a longer topic is checked in the records
+    if topic != None and not any(prefix.startswith(topic) or topic.startswith(prefix) for prefix in block['topics']):
+        return False
+    return True
+
+# Split the text of a block in log records, a record can have several lines
+def split_records(text):
+    record = None
+    for line in text.splitlines(keepends=True):
+        if line.startswith("[") and record != None:
+            yield record
+            record = None
+        record = line if record == None else record + line
+    if record != None:
+        yield record
+
+# Check if a log record matches the query
+def record_matches(record, topic, session, since, until):
+    fields = record.split(" | ", 3)
+    if len(fields) < 3:
+        return False
+    if since != None and fields[1] < since:
+        return False
+    if until != None and fields[1] >= until:
+        return False
+    if topic != None and (len(fields) < 4 or not fields[2].startswith(topic)):
+        return False
+    if session != None and (len(fields) < 4 or session not in fields[2].split("/")):
+        return False
+    return True
+
+# Read the archived log records matching the query, decompressing only the blocks that can match
+def query_logs(folder, topic=None, session=None, since=None, until=None, stats=None):
+    # Times are compared as text, with the same format used in the log records
+    since = since.replace("T", " ") if since != None else None
+    until = until.replace("T", " ") if until != None else None
+    for archived, blocks in load_indexes(folder):
+        matching = [block for block in blocks if block_matches(block, topic, session, since, until)]
+        if stats != None:
+            stats['blocks'] = stats['blocks'] + len(blocks)
+            stats['read'] = stats['read'] + len(matching)
+        if not matching:
+            continue
+        with open(archived, "rb") as f:
+            for block in matching:
+                f.seek(block['offset'])
+                text = zlib.decompress(f.read(block['length'])).decode(errors="replace")
+                for record in split_records(text):
+                    if record_matches(record, topic, session, since, until):
+                        yield record
+
+# main program
+def main():
+    args = parser.parse_args()
+    if args.command == "archive":
+        archive_logs(args.archive, args.logs)
+        return
+
+    start = time.perf_counter()
+    stats = {'blocks': 0, 'read': 0}
+    count = 0
+    for record in query_logs(args.archive, args.topic, args.session, args.since, args.until, stats):
+        if args.limit != None and count >= args.limit:
+            break
+        sys.stdout.write(record)
+        count = count + 1
+    print(f"Records: {count}, blocks read: {stats['read']} of {stats['blocks']}, time: {time.perf_counter() - start:.3f}s", file=sys.stderr)
+
+# Script entry point
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+ConneX MQTT Multi-Broker Client sample code.
+
+ConneXMqttMulti [-h] [-f FILE] [-t TOPIC] [BROKER ...]
+
+This script connects to several ConneX MQTT Brokers at the same time,
+e.g. the ConneX Servers of different factory sites, from a single process
+and thread using asyncio.
+
+BROKER is 'host', 'host:port' or 'name=host:port', the name is used to tag
+the messages of the broker (by default 'host:port'). The brokers can also be
+read from a file with '-f', one broker per line.
+
+The messages of all the brokers are logged, tagged with the broker name,
+to both the console and a log file named 'ConneXMqttMulti.log'. When the
+connection to a broker is lost, the script connects again waiting longer
+after each failed attempt.
+
+This script requires that `paho.mqtt` be installed within the Python
+environment you are running this script in.
+
+To stop the script, simply press CTRL+C to abort the execution.
+"""
+
+import paho.mqtt.client as mqtt
+import argparse
+import asyncio
+import datetime as dt
+import hashlib
+import logging
+import random
+import socket
+import threading
+
+# Helper class to use microseconds in logger timestamps
+class uSecsFormatter(logging.Formatter):
+    converter = dt.datetime.fromtimestamp
+    def formatTime(self, record, datefmt=None):
+        ct = self.converter(record.created)
+        if datefmt:
+            s = ct.strftime(datefmt)
+        else:
+            t = ct.strftime("%Y-%m-%d %H:%M:%S")
+            s = "%s.%03d" % (t, record.msecs)
+        return s
+
+# Create a custom logger
+logger = logging.getLogger(__name__)
+
+# Create two log handlers, one for console output and one for file output
+c_handler = logging.StreamHandler()
+f_handler = logging.FileHandler("ConneXMqttMulti.log")
+c_handler.setLevel(logging.INFO)
+f_handler.setLevel(logging.INFO)
+
+# Create formatters and add them to handlers
+c_format = uSecsFormatter(fmt="[%(levelname)s] | %(asctime)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S.%f")
+f_format = uSecsFormatter(fmt="[%(levelname)s] | %(asctime)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S.%f")
+c_handler.setFormatter(c_format)
+f_handler.setFormatter(f_format)
+
+# Add handlers to the logger
+logger.addHandler(c_handler)
+logger.addHandler(f_handler)
+
+# Set logger threshold level
+logger.setLevel(logging.INFO)
+
+# Seconds to wait before connecting again to a broker, doubled after each failed attempt
+# up to the maximum, and reset after a successful connection
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# Maximum number of received messages waiting to be processed, messages received while
+# the queue is full are dropped and counted
+MESSAGE_QUEUE_SIZE = 10000
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding arguments
+parser.add_argument("brokers", nargs="*", metavar="BROKER", help="ConneX MQTT Broker as host, host:port or name=host:port")
+parser.add_argument("-f", "--file", help="File with one ConneX MQTT Broker per line")
+parser.add_argument("-t", "--topic", action="append", help="Topic to subscribe to, can be repeated, default = #")
+
+# Parse a broker argument, 'host', 'host:port' or 'name=host:port', as (name, host, port)
+def parse_broker(text):
+    name, _, address = text.rpartition("=")
+    host, _, port = address.partition(":")
+    port = int(port) if port else 1883
+    return (name or f"{host}:{port}", host, port)
+
+# Client ID used for a broker, always the same for the same broker and computer, so
+# the broker can recognize the client after a reconnection and the IDs of different
+# brokers and computers do not collide
+def client_id_for(host, port):
+    digest = hashlib.sha1(f"{socket.gethostname()}|{host}:{port}".encode()).hexdigest()
+    return f"connex-mqtt-multi-{digest[:12]}"
+
+# Helper class to run the connection to one broker in the asyncio event loop. The paho client
+# does not start its own thread, its socket is watched by the event loop, which calls the
+# client to read or write only when the socket is ready
+class BrokerConnection:
+    def __init__(self, name, host, port, topics, messages, stats):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.topics = topics
+        self.messages = messages
+        self.stats = stats
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.disconnected = None
+        self.misc_task = None
+        self.client = mqtt.Client(client_id=client_id_for(host, port))
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # The socket callbacks can be called from the thread that opens the connection,
+    # the event loop is only changed from its own thread
+    def call_in_loop(self, function, *args):
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call_in_loop(self.watch_socket, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call_in_loop(self.unwatch_socket, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock)
+
+    def watch_socket(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def unwatch_socket(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.misc_task != None:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+    # Send the keep alive messages and detect a broker that stopped answering
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    # The callback for when the client receives a CONNACK response from the broker
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info(f"{self.name} | Connected to ConneX MQTT Broker, client: {client._client_id.decode()}")
+            self.delay = RECONNECT_MIN_DELAY
+            for topic in self.topics:
+                client.subscribe(topic)
+        else:
+            logger.info(f"{self.name} | Failed to connect to ConneX MQTT Broker, result code: {rc}")
+
+    # The callback for when a PUBLISH message is received, the message is tagged with the
+    # broker name and added to the stream of messages of all the brokers
+    def on_message(self, client, userdata, msg):
+        try:
+            self.messages.put_nowait((self.name, msg))
+        except asyncio.QueueFull:
+            self.stats['dropped'] = self.stats['dropped'] + 1
+
+    # The callback for when a disconnect happens
+    def on_disconnect(self, client, userdata, rc):
+        logger.info(f"{self.name} | Disconnected, return code: {rc}")
+        if self.disconnected != None and not self.disconnected.done():
+            self.disconnected.set_result(rc)
+
+    # Keep connected to the broker, connecting again after each disconnection
+    async def run(self):
+        self.delay = RECONNECT_MIN_DELAY
+        while True:
+            self.disconnected = self.loop.create_future()
+            try:
+                logger.info(f"{self.name} | Attempting connection to ConneX MQTT Broker... Host: {self.host}, Port: {self.port}")
+                # Resolving the host name and opening the socket can take a while,
+                # done in a worker thread so the other connections are not stopped
+                await self.loop.run_in_executor(None, self.client.connect, self.host, self.port, 60)
+                await self.disconnected
+            except (OSError, ValueError) as e:
+                logger.info(f"{self.name} | Could not connect to ConneX MQTT Broker: {e}")
+            # Wait before connecting again, with some random variation so the brokers
+            # lost at the same time are not all connected again at the same time
+            delay = self.delay * random.uniform(0.8, 1.2)
+            self.delay = min(self.delay * 2, RECONNECT_MAX_DELAY)
+            logger.info(f"{self.name} | Connecting again in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def close(self):
+        self.disconnected = None
+        self.client.disconnect()
+        if self.misc_task != None:
+            self.misc_task.cancel()
+
+# Process the merged stream of messages of all the brokers
+async def process_messages(messages, stats):
+    while True:
+        name, msg = await messages.get()
+        stats['received'] = stats['received'] + 1
+        logger.info(f"{name} | {msg.topic} | {msg.payload.decode(errors='replace')}")
+
+# Connect to all the brokers and process their messages until stopped
+async def run(brokers, topics):
+    messages = asyncio.Queue(MESSAGE_QUEUE_SIZE)
+    stats = {'received': 0, 'dropped': 0}
+    connections = [BrokerConnection(name, host, port, topics, messages, stats) for name, host, port in brokers]
+    loop = asyncio.get_event_loop()
+    tasks = [loop.create_task(connection.run()) for connection in connections]
+    tasks.append(loop.create_task(process_messages(messages, stats)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for connection in connections:
+            connection.close()
+        # Wait until the cancelled tasks end, before the event loop is closed
+        misc_tasks = [connection.misc_task for connection in connections if connection.misc_task != None]
+        await asyncio.gather(*tasks, *misc_tasks, return_exceptions=True)
+        logger.info(f"Brokers: {len(connections)}, messages received: {stats['received']}, dropped: {stats['dropped']}")
+
+# main program
+def main():
+    args = parser.parse_args()
+    brokers = list(args.brokers)
+    if args.file:
+        with open(args.file) as f:
+            brokers.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    if not brokers:
+        brokers = ["localhost"]
+
+    # Add log start header, useful when several logs are appended to the same file
+    logger.info("----------------------------------------------------------------------")
+    logger.info("-------------------------- Starting new log --------------------------")
+    logger.info("----------------------------------------------------------------------")
+
+    # The event loop is created and run explicitly instead of with asyncio.run(), which
+    # is not available in Python 3.6
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    main_task = loop.create_task(run([parse_broker(broker) for broker in brokers], args.topic or ["#"]))
+    try:
+        loop.run_until_complete(main_task)
+    except KeyboardInterrupt:
+        # Cancel the connections, the totals are logged when run() ends
+        main_task.cancel()
+        try:
+            loop.run_until_complete(main_task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.close()
+
+# Script entry point
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+ConneX MQTT Operations sample code.
+
+ConneXMqttOperations [-h] CAPTURE [CAPTURE ...]
+
+This script reads the binary capture files saved by ConneXMqttClient
+with the '--capture' argument, e.g. the capture of a whole shift, and
+keeps the pick, place and device complete operations of the automated
+handlers in memory to print:
+
+- The devices, failed devices and dwell time of each programmer socket,
+  the dwell time is the time between placing a device in the socket
+  and picking it from the socket.
+- The number of picks of each pick head, and how balanced they are.
+
+CAPTURE can be capture files or folders with capture files.
+
+This script requires that `numpy` and `paho.mqtt` be installed within
+the Python environment you are running this script in, and the
+ConneXMqttCommon.py and ConneXMqttReplay.py scripts in the same folder.
+"""
+
+import argparse
+import time
+import ConneXMqttReplay
+from ConneXMqttCommon import OPERATION_KINDS, OperationsStore
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding arguments
+parser.add_argument("capture", nargs="+", help="Capture files or folders with capture files")
+
+# Add the captured operations to the store, the topics are of the form
+# 'ah700/operations/{operation}/{hostname}/{xhsessionid}'
+def load_operations(store, files):
+    for file_name in files:
+        print(f"Reading '{file_name}'...")
+        for received, topic, qos, retain, payload in ConneXMqttReplay.read_capture(file_name):
+            levels = topic.split("/")
+            if len(levels) == 5 and levels[1] == "operations" and levels[2] in OPERATION_KINDS:
+                store.add(levels[2], levels[3], levels[4], payload, received)
+
+# main program
+def main():
+    args = parser.parse_args()
+    store = OperationsStore()
+
+    start = time.perf_counter()
+    load_operations(store, ConneXMqttReplay.capture_files(args.capture))
+    loaded = time.perf_counter()
+    lines = store.summary_lines()
+    analyzed = time.perf_counter()
+
+    for line in lines:
+        print(line)
+    print(f"Operations: {store.size}, rejected: {store.rejected}, read time: {loaded - start:.2f}s, analytics time: {analyzed - loaded:.2f}s")
+
+# Script entry point
+if __name__ == '__main__':
+    main()
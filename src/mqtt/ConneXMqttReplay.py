@@ -0,0 +1,164 @@
+"""
+ConneX MQTT Replay sample code.
+
+ConneXMqttReplay [-h] [-i IPHOST] [-p PORT] [-s SPEED] [-l] CAPTURE [CAPTURE ...]
+
+This script reads the binary capture files saved by ConneXMqttClient
+with the '--capture' argument, and publishes the captured messages again
+to a MQTT Broker, with the same topic, payload, QoS and retain flag.
+
+CAPTURE can be capture files or folders with capture files, the files
+are replayed in name order, which is the order they were captured.
+
+By default the messages are published with the same time between them
+as when they were captured. Use '-s' to replay faster or slower
+(e.g. '-s 10' is ten times faster) or '-s 0' to publish as fast as possible.
+Use '-l' to list the captured messages instead of publishing them.
+
+This script requires that `paho.mqtt` be installed within the Python
+environment you are running this script in, and the ConneXMqttCommon.py
+module in the same folder.
+
+Be careful to not replay captured commands to a production ConneX MQTT Broker.
+"""
+
+import paho.mqtt.client as mqtt
+import argparse
+import collections
+import datetime as dt
+import mmap
+import os
+import random
+import time
+from ConneXMqttCommon import CAPTURE_MAGIC, CAPTURE_RECORD_HEADER, CAPTURE_RETAIN_FLAG
+
+
+# Maximum seconds to wait at the end of the replay for the broker to acknowledge the messages
+# still in flight, the messages not acknowledged when the client disconnects are lost
+REPLAY_ACK_TIMEOUT = 30
+
+# Initialize argument parser
+parser = argparse.ArgumentParser(usage=__doc__)
+
+# Adding arguments
+parser.add_argument("capture", nargs="+", help="Capture files or folders with capture files")
+parser.add_argument("-i", "--iphost", default="localhost", help="MQTT Broker IP address or host name, default = localhost")
+parser.add_argument("-p", "--port", type=int, default=1883, help="MQTT Broker port, default = 1883")
+parser.add_argument("-s", "--speed", type=float, default=1.0, help="Replay speed factor, 0 = as fast as possible, default = 1")
+parser.add_argument("-l", "--list", action="store_true", help="List the captured messages instead of publishing them")
+
+# Get the list of capture files to replay, in name order
+def capture_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".bin")))
+        else:
+            files.append(path)
+    return files
+
+# Read the captured messages of a capture file, as tuples of (time, topic, qos, retain, payload)
+def read_capture(file_name):
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(CAPTURE_MAGIC):
+            return
+        # Map the file in memory, the records are read without copying the whole file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+                raise ValueError(f"'{file_name}' is not a ConneX capture file")
+            offset = len(CAPTURE_MAGIC)
+            while offset + CAPTURE_RECORD_HEADER.size <= len(data):
+                received, topic_length, flags, payload_length = CAPTURE_RECORD_HEADER.unpack_from(data, offset)
+                offset = offset + CAPTURE_RECORD_HEADER.size
+                if offset + topic_length + payload_length > len(data):
+                    # Last record not completely written, e.g. the capture was interrupted
+                    break
+                topic = data[offset:offset + topic_length].decode()
+                offset = offset + topic_length
+                payload = data[offset:offset + payload_length]
+                offset = offset + payload_length
+                yield (received, topic, flags & 0x03, bool(flags & CAPTURE_RETAIN_FLAG), payload)
+
+# Remove from 'pending' the messages at its head already published, waiting up to 'timeout' seconds
+# for them. A message is published when the broker acknowledges it (QoS 1 and 2) or when it is sent
+# (QoS 0). Returns the number of messages published, the messages the client could not queue are
+# removed without counting them
+def collect_published(pending, timeout=0):
+    published = 0
+    deadline = time.monotonic() + timeout
+    while pending:
+        info = pending[0]
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_AGAIN):
+            pending.popleft()
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            info.wait_for_publish(remaining)
+        if not info.is_published():
+            break
+        pending.popleft()
+        published = published + 1
+    return published
+
+# Publish the captured messages keeping the original time between them, scaled by 'speed'. Only the
+# messages acknowledged by the broker before the end of the replay are counted as published
+def replay(client, files, speed):
+    count = 0
+    published = 0
+    pending = collections.deque()
+    first_received = None
+    start = time.monotonic()
+    try:
+        for file_name in files:
+            print(f"Replaying '{file_name}'...")
+            for received, topic, qos, retain, payload in read_capture(file_name):
+                if first_received == None:
+                    first_received = received
+                if speed > 0:
+                    # Wait until the time of the message, relative to the first message
+                    delay = start + (received - first_received) / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                pending.append(client.publish(topic, payload, qos, retain))
+                count = count + 1
+                published = published + collect_published(pending)
+    except KeyboardInterrupt:
+        print("Replay interrupted...")
+    # Wait for the messages still in flight, the client would drop them when disconnecting
+    published = published + collect_published(pending, REPLAY_ACK_TIMEOUT)
+    elapsed = time.monotonic() - start
+    print(f"Messages published: {published}, time: {elapsed:.3f}s, rate: {published / elapsed if elapsed > 0 else 0:.0f} messages/s")
+    if published < count:
+        print(f"Messages not acknowledged by the broker: {count - published} of {count}")
+
+# List the captured messages, with the same format used by ConneXMqttClient log
+def list_messages(files):
+    for file_name in files:
+        for received, topic, qos, retain, payload in read_capture(file_name):
+            timestamp = dt.datetime.fromtimestamp(received).strftime("%Y-%m-%d %H:%M:%S.%f")
+            print(f"{timestamp} | {topic} | qos: {qos}, retain: {retain} | {payload.decode(errors='replace')}")
+
+# main program
+def main():
+    args = parser.parse_args()
+    files = capture_files(args.capture)
+    if args.list:
+        list_messages(files)
+        return
+
+    # Initialize MQTT client, generate random id
+    client = mqtt.Client(client_id=f'connex-mqtt-replay-{random.randint(0, 1000)}')
+    print(f"Attempting connection to MQTT Broker... Host: {args.iphost}, Port: {args.port}")
+    client.connect(args.iphost, args.port, 60)
+
+    # Process network traffic in a background thread while publishing
+    client.loop_start()
+    try:
+        replay(client, files, args.speed)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+# Script entry point
+if __name__ == '__main__':
+    main()